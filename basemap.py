@@ -0,0 +1,216 @@
+import io
+import math
+import os
+from collections import namedtuple
+
+import contextily as ctx
+import mercantile as mt
+import numpy as np
+from PIL import Image
+from xyzservices import TileProvider
+
+from scaricatore_tile import scaricatore_predefinito
+from strumentazione import conta, fase
+from tile_cache import cache_predefinita
+from webmercator import RAGGIO
+
+# === Costanti ===
+SORGENTE_PREDEFINITA = ctx.providers.OpenStreetMap.Mapnik
+if os.environ.get("VELOX_TILE_URL"):
+    # es. VELOX_TILE_URL=http://127.0.0.1:8765/{z}/{x}/{y}.png con server_tile_locale.py
+    SORGENTE_PREDEFINITA = TileProvider(name="Locale", url=os.environ["VELOX_TILE_URL"], attribution="")
+MAX_TILE_MOSAICO = 4096  # tile di un mosaico regionale (spazio riservato, non memoria occupata); oltre si scarica per unità
+MAX_TILE_RENDER = 400  # tile per render con lo zoom automatico (~100 MB di mosaico RGBA); oltre si scende di zoom
+TOLLERANZA_ZOOM = 0.25  # ingrandimento accettato (2**0.25 = 1.19x) prima di passare allo zoom successivo
+LATO_TILE = 256
+ZOOM_MAX = 19  # se il provider non indica max_zoom
+
+# === Zoom scelto per un render ===
+# zoom_ideale: zoom (frazionario) con un pixel di tile per pixel di uscita; tile e memoria
+# (byte del mosaico RGBA decodificato) sono stimati prima di scaricare qualsiasi tile.
+PianoZoom = namedtuple("PianoZoom", ["zoom", "zoom_ideale", "tile", "memoria", "pixel_per_metro"])
+
+
+# === Tile XYZ che coprono un'estensione in EPSG:3857 ===
+def tile_estensione(xmin, ymin, xmax, ymax, zoom):
+    ovest, sud = mt.lnglat(xmin, ymin)
+    est, nord = mt.lnglat(xmax, ymax)
+    return list(mt.tiles(ovest, sud, est, nord, [zoom]))
+
+
+def decodifica_tile(dati):
+    with Image.open(io.BytesIO(dati)) as immagine:
+        return np.asarray(immagine.convert("RGBA"))
+
+
+# === Numero di tile XYZ che coprono un'estensione (dagli angoli, senza elencarle) ===
+def numero_tile(xmin, ymin, xmax, ymax, zoom):
+    alto_sinistra = mt.tile(*mt.lnglat(xmin, ymax), zoom)
+    basso_destra = mt.tile(*mt.lnglat(xmax, ymin), zoom)
+    return (basso_destra.x - alto_sinistra.x + 1) * (basso_destra.y - alto_sinistra.y + 1)
+
+
+# === Zoom con la risoluzione delle tile più vicina a quella dell'immagine di uscita ===
+# larghezza_px/altezza_px: pixel dell'area dati nell'immagine salvata (dimensione figura,
+# dpi e margini già applicati). Le estensioni sono in EPSG:3857 come le tile: il rapporto
+# pixel/metro non dipende dalla latitudine. Si prende lo zoom più basso che non ingrandisce
+# le tile oltre TOLLERANZA_ZOOM, poi si scende finché le tile stanno in max_tile.
+def pianifica_zoom(xmin, ymin, xmax, ymax, larghezza_px, altezza_px, source=SORGENTE_PREDEFINITA,
+                   max_tile=MAX_TILE_RENDER, zoom_min=0):
+    pixel_per_metro = min(larghezza_px / (xmax - xmin), altezza_px / (ymax - ymin))
+    zoom_ideale = math.log2(pixel_per_metro * 2 * math.pi * RAGGIO / LATO_TILE)
+    zoom_max = source.get("max_zoom", ZOOM_MAX) if isinstance(source, dict) else ZOOM_MAX
+    zoom = min(max(math.ceil(zoom_ideale - TOLLERANZA_ZOOM), zoom_min), zoom_max)
+
+    tile = numero_tile(xmin, ymin, xmax, ymax, zoom)
+    while max_tile and tile > max_tile and zoom > zoom_min:
+        zoom -= 1
+        tile = numero_tile(xmin, ymin, xmax, ymax, zoom)
+    return PianoZoom(zoom, zoom_ideale, tile, tile * LATO_TILE * LATO_TILE * 4, pixel_per_metro)
+
+
+# === Zoom automatico per gli assi: limiti attuali e dimensione degli assi al dpi di uscita ===
+def zoom_per_assi(ax, dpi, source=SORGENTE_PREDEFINITA, max_tile=MAX_TILE_RENDER):
+    ax.apply_aspect()  # con aspect "equal" la dimensione degli assi cambia al disegno
+    riquadro = ax.get_window_extent()
+    scala = dpi / ax.get_figure(root=True).dpi
+    xmin, xmax, ymin, ymax = ax.axis()
+    piano = pianifica_zoom(xmin, ymin, xmax, ymax, riquadro.width * scala, riquadro.height * scala, source, max_tile)
+    limitato = " (limite tile)" if piano.zoom < math.ceil(piano.zoom_ideale - TOLLERANZA_ZOOM) else ""
+    print(f"  [i] Zoom automatico {piano.zoom}{limitato}, ideale {piano.zoom_ideale:.1f}: "
+          f"{piano.tile} tile, ~{piano.memoria / 1024 / 1024:.0f} MB di mosaico")
+    return piano
+
+
+# === Mosaico delle tile con la sua estensione (left, right, bottom, top) in EPSG:3857 ===
+# Tile scaricate e decodificate in parallelo (scaricatore_tile.py), non una dopo l'altra.
+def mosaico(xmin, ymin, xmax, ymax, zoom, source=SORGENTE_PREDEFINITA, cache=None, scaricatore=None):
+    scaricatore = scaricatore or scaricatore_predefinito()
+    tiles = tile_estensione(xmin, ymin, xmax, ymax, zoom)
+    return scaricatore.mosaico(tiles, zoom, source, cache or cache_predefinita())
+
+
+# === Mosaico condiviso dalle unità di una stessa regione ===
+# Il runner imposta la regione dell'unità corrente; per ogni zoom si alloca un solo array
+# sull'estensione della regione, riempito tile per tile alla prima richiesta: ogni tile è
+# letta e decodificata una volta per regione e ogni unità ne ritaglia una vista. Le pagine
+# mai scritte di np.zeros non occupano memoria, quindi conta solo l'area davvero usata.
+# Il ritaglio segue la griglia delle tile: l'immagine è identica a quella di mosaico().
+class MosaicoRegionale:
+    def __init__(self, max_tile=MAX_TILE_MOSAICO):
+        self.max_tile = max_tile
+        self.nome = None
+        self.estensione = None
+        self._mosaici = {}
+        self.contatori = dict.fromkeys(
+            ["ritagli", "fuori_mosaico", "tile_richieste", "bytes_richiesti", "tile_lette", "bytes_letti"], 0)
+
+    # estensione: (xmin, ymin, xmax, ymax) in EPSG:3857; nome None = nessuna regione
+    def imposta(self, nome, estensione=None):
+        if nome != self.nome:
+            self._mosaici.clear()  # un solo gruppo di mosaici in memoria per processo
+        self.nome, self.estensione = nome, estensione
+
+    def _mosaico(self, zoom, source):
+        chiave = (zoom, source.get("url") if isinstance(source, dict) else source)
+        if chiave not in self._mosaici:
+            xmin, ymin, xmax, ymax = self.estensione
+            alto_sinistra = mt.tile(*mt.lnglat(xmin, ymax), zoom)
+            basso_destra = mt.tile(*mt.lnglat(xmax, ymin), zoom)
+            if numero_tile(xmin, ymin, xmax, ymax, zoom) > self.max_tile:
+                self._mosaici[chiave] = None
+            else:
+                self._mosaici[chiave] = {
+                    "img": None, "lato": None, "dimensioni": {},
+                    "x0": alto_sinistra.x, "y0": alto_sinistra.y, "x1": basso_destra.x, "y1": basso_destra.y,
+                }
+        return self._mosaici[chiave]
+
+    def _riempi(self, regionale, tile, dati, array):
+        if regionale["img"] is None:
+            lato = array.shape[0]
+            regionale["lato"] = lato
+            regionale["img"] = np.zeros(((regionale["y1"] - regionale["y0"] + 1) * lato,
+                                         (regionale["x1"] - regionale["x0"] + 1) * lato, array.shape[2]), dtype=np.uint8)
+        lato = regionale["lato"]
+        riga, colonna = tile.y - regionale["y0"], tile.x - regionale["x0"]
+        regionale["img"][riga * lato:(riga + 1) * lato, colonna * lato:(colonna + 1) * lato] = array
+        regionale["dimensioni"][(tile.x, tile.y)] = len(dati)
+        self.contatori["tile_lette"] += 1
+        self.contatori["bytes_letti"] += len(dati)
+
+    # (img, extent) come mosaico(), oppure None se l'estensione non è coperta
+    def ritaglio(self, xmin, ymin, xmax, ymax, zoom, source, cache):
+        if self.nome is None:
+            return None
+        regionale = self._mosaico(zoom, source)
+        tiles = tile_estensione(xmin, ymin, xmax, ymax, zoom)
+        x0, y0 = min(t.x for t in tiles), min(t.y for t in tiles)
+        x1, y1 = max(t.x for t in tiles), max(t.y for t in tiles)
+        if regionale is None or x0 < regionale["x0"] or y0 < regionale["y0"] \
+                or x1 > regionale["x1"] or y1 > regionale["y1"]:
+            self.contatori["fuori_mosaico"] += 1
+            return None
+
+        mancanti = [tile for tile in tiles if (tile.x, tile.y) not in regionale["dimensioni"]]
+        for tile, dati, array in scaricatore_predefinito().tile_decodificate(source, mancanti, cache):
+            self._riempi(regionale, tile, dati, array)
+        lato = regionale["lato"]
+        riga, colonna = y0 - regionale["y0"], x0 - regionale["x0"]
+        vista = regionale["img"][riga * lato:(riga + y1 - y0 + 1) * lato, colonna * lato:(colonna + x1 - x0 + 1) * lato]
+
+        self.contatori["ritagli"] += 1
+        self.contatori["tile_richieste"] += len(tiles)
+        self.contatori["bytes_richiesti"] += sum(regionale["dimensioni"][(t.x, t.y)] for t in tiles)
+
+        alto_sinistra = mt.xy_bounds(mt.Tile(x0, y0, zoom))
+        basso_destra = mt.xy_bounds(mt.Tile(x1, y1, zoom))
+        return vista, (alto_sinistra.left, basso_destra.right, basso_destra.bottom, alto_sinistra.top)
+
+    def statistiche(self):
+        return dict(self.contatori)
+
+
+_regionale = MosaicoRegionale()
+
+
+def mosaico_regionale():
+    return _regionale
+
+
+# === Sostituto di ctx.add_basemap per assi già in EPSG:3857, con tile dalla cache su disco ===
+# zoom None = automatico (zoom_per_assi) per un salvataggio a dpi, entro max_tile tile.
+# Restituisce gli artist aggiunti (immagine ed eventuale attribuzione).
+@fase("basemap")
+def aggiungi_basemap(ax, zoom=None, source=SORGENTE_PREDEFINITA, attribution_size=ctx.plotting.ATTRIBUTION_SIZE,
+                     cache=None, dpi=None, max_tile=MAX_TILE_RENDER):
+    cache = cache or cache_predefinita()
+    hit, miss, scaricati = cache.hit, cache.miss, cache.bytes_scaricati
+
+    if zoom is None:
+        zoom = zoom_per_assi(ax, dpi or ax.get_figure(root=True).dpi, source, max_tile).zoom
+    xmin, xmax, ymin, ymax = ax.axis()
+    ritaglio = _regionale.ritaglio(xmin, ymin, xmax, ymax, zoom, source, cache)
+    if ritaglio is None:
+        img, extent = mosaico(xmin, ymin, xmax, ymax, zoom, source=source, cache=cache)
+    else:
+        img, extent = ritaglio
+    artist = [ax.imshow(img, extent=extent, interpolation="bilinear", aspect=ax.get_aspect())]
+    ax.axis((xmin, xmax, ymin, ymax))
+
+    attribution = source.get("attribution") if isinstance(source, dict) else None
+    if attribution:
+        artist.append(ctx.add_attribution(ax, attribution, font_size=attribution_size))
+
+    conta("tile_cache", cache.hit - hit)
+    conta("tile_scaricate", cache.miss - miss)
+    conta("bytes_scaricati", cache.bytes_scaricati - scaricati)
+    if ritaglio is not None:
+        conta("basemap_da_mosaico_regionale")
+
+    if ritaglio is None:
+        print(f"  [i] Tile: {cache.hit - hit} dalla cache, {cache.miss - miss} scaricate")
+    else:
+        print(f"  [i] Tile: ritaglio dal mosaico di {_regionale.nome} "
+              f"({cache.hit - hit} dalla cache, {cache.miss - miss} scaricate)")
+    return artist
@@ -0,0 +1,127 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from indice_spaziale import IndiceMarker, distanza_m
+
+# === Costanti ===
+NUMERO_MARKER = 1_000_000
+NUMERO_FILE = 20  # il milione di marker è diviso in file come le cartelle di marker reali
+NUMERO_CENTRI = 300  # i marker sintetici si addensano attorno a centri (città), più un fondo uniforme
+ESTENSIONE = (6.6, 36.6, 18.5, 47.1)  # lon/lat minimi e massimi, circa l'Italia
+QUERY_RAGGIO = 10_000
+RAGGIO_M = 200
+K = 5
+TRACCE = 100
+PUNTI_TRACCIA = 500
+CAMPIONE_CONTROLLO = 200  # query verificate contro la forza bruta
+
+
+# === Marker sintetici raggruppati, divisi in file CSV longitude,latitude ===
+def marker_sintetici(cartella, n=NUMERO_MARKER, numero_file=NUMERO_FILE, seme=0):
+    rng = np.random.default_rng(seme)
+    lon_min, lat_min, lon_max, lat_max = ESTENSIONE
+    centri = np.column_stack([rng.uniform(lon_min, lon_max, NUMERO_CENTRI), rng.uniform(lat_min, lat_max, NUMERO_CENTRI)])
+    raggruppati = int(n * 0.8)
+    scelti = rng.integers(0, NUMERO_CENTRI, raggruppati)
+    lon = np.concatenate([centri[scelti, 0] + rng.normal(0, 0.05, raggruppati), rng.uniform(lon_min, lon_max, n - raggruppati)])
+    lat = np.concatenate([centri[scelti, 1] + rng.normal(0, 0.04, raggruppati), rng.uniform(lat_min, lat_max, n - raggruppati)])
+    ordine = rng.permutation(n)
+    percorsi = []
+    for numero, blocco in enumerate(np.array_split(ordine, numero_file)):
+        percorso = os.path.join(cartella, f"sintetici_{numero:02d}.csv")
+        np.savetxt(percorso, np.column_stack([lon[blocco], lat[blocco]]), fmt="%.6f", delimiter=",",
+                   header="longitude,latitude", comments="")
+        percorsi.append(percorso)
+    return percorsi, centri
+
+
+def _tempo(funzione, *args, **kwargs):
+    inizio = time.perf_counter()
+    risultato = funzione(*args, **kwargs)
+    return risultato, time.perf_counter() - inizio
+
+
+# === Tracce GPS sintetiche: passeggiate casuali di punti_traccia punti (circa 100 m l'uno) ===
+def tracce_sintetiche(centri, tracce=TRACCE, punti_traccia=PUNTI_TRACCIA, seme=1):
+    rng = np.random.default_rng(seme)
+    risultato = []
+    for partenza in centri[rng.integers(0, len(centri), tracce)]:
+        direzione = np.cumsum(rng.normal(0, 0.2, punti_traccia)) + rng.uniform(0, 2 * np.pi)
+        passi = np.column_stack([np.cos(direzione) * 0.0012, np.sin(direzione) * 0.0009])
+        risultato.append(partenza + np.cumsum(passi, axis=0))
+    return risultato
+
+
+# === Verifica su un campione: stessi marker entro il raggio e stesse k distanze della forza bruta ===
+def controlla(indice, lon, lat, punti, marker, distanze_k):
+    errori = 0
+    for numero in range(min(CAMPIONE_CONTROLLO, len(lon))):
+        distanze = distanza_m(lon[numero], lat[numero], indice.longitudine, indice.latitudine)
+        if set(np.nonzero(distanze <= RAGGIO_M)[0]) != set(marker[punti == numero]):
+            errori += 1
+        if not np.allclose(np.sort(distanze)[:K], distanze_k[numero]):
+            errori += 1
+    return errori
+
+
+# === Costruzione, aggiornamento incrementale e query su un milione di marker sintetici ===
+# Uso: python bench_indice.py [--marker N] [--cartella DIR]  (senza cartella: temporanea, poi eliminata)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dell'indice spaziale dei marker")
+    parser.add_argument("--marker", type=int, default=NUMERO_MARKER)
+    parser.add_argument("--cartella", help="cartella di lavoro (marker sintetici, cache e indice)")
+    args = parser.parse_args()
+
+    cartella = os.path.abspath(args.cartella or tempfile.mkdtemp(prefix="bench_indice_"))
+    dati = os.path.join(cartella, "marker")
+    os.makedirs(dati, exist_ok=True)
+    cartella_indice = os.path.join(cartella, "indice")
+    os.chdir(cartella)  # anche la cache di marker_loader dei file sintetici resta nella cartella di lavoro
+    try:
+        (percorsi, centri), durata = _tempo(marker_sintetici, dati, args.marker)
+        print(f"[i] {args.marker} marker sintetici in {len(percorsi)} file ({durata:.1f}s)")
+        shutil.rmtree(cartella_indice, ignore_errors=True)
+
+        _, fredda = _tempo(IndiceMarker, [dati], cartella_indice)
+        indice, calda = _tempo(IndiceMarker, [dati], cartella_indice)
+        with open(percorsi[0], "a", encoding="utf-8") as fh:
+            fh.write("12.496400,41.902800\n")
+        _, incrementale = _tempo(indice.aggiorna)
+        print(f"{'costruzione':<28} | {'s':>8}")
+        print(f"{'fredda (lettura file)':<28} | {fredda:>8.2f}")
+        print(f"{'calda (indice salvato)':<28} | {calda:>8.2f}")
+        print(f"{'1 file modificato':<28} | {incrementale:>8.2f}")
+
+        rng = np.random.default_rng(2)
+        vicino = rng.random(QUERY_RAGGIO) < 0.8  # come i marker: query per lo più in città
+        partenze = centri[rng.integers(0, len(centri), QUERY_RAGGIO)]
+        lon = np.where(vicino, partenze[:, 0] + rng.normal(0, 0.05, QUERY_RAGGIO),
+                       rng.uniform(ESTENSIONE[0], ESTENSIONE[2], QUERY_RAGGIO))
+        lat = np.where(vicino, partenze[:, 1] + rng.normal(0, 0.04, QUERY_RAGGIO),
+                       rng.uniform(ESTENSIONE[1], ESTENSIONE[3], QUERY_RAGGIO))
+        tracce = tracce_sintetiche(centri)
+
+        (punti, marker, _), raggio = _tempo(indice.entro, lon, lat, RAGGIO_M)
+        (_, distanze_1), vicino_1 = _tempo(indice.piu_vicini, lon, lat, 1)
+        (_, distanze_k), vicini_k = _tempo(indice.piu_vicini, lon, lat, K)
+        (_, marker_percorso, _), percorso = _tempo(indice.vicino_a_percorso, tracce, RAGGIO_M)
+
+        print(f"\n{'query':<28} | {'chiamata':>9} | {'per punto':>10} | risultati")
+        print(f"{f'entro {RAGGIO_M} m':<28} | {raggio:>8.2f}s | {raggio / QUERY_RAGGIO * 1e6:>8.1f}us | {len(marker)}")
+        print(f"{'k=1 più vicino':<28} | {vicino_1:>8.2f}s | {vicino_1 / QUERY_RAGGIO * 1e6:>8.1f}us | "
+              f"mediana {np.median(distanze_1):.0f} m")
+        print(f"{f'k={K} più vicini':<28} | {vicini_k:>8.2f}s | {vicini_k / QUERY_RAGGIO * 1e6:>8.1f}us | "
+              f"mediana {np.median(distanze_k[:, -1]):.0f} m")
+        print(f"{f'{TRACCE} tracce x {PUNTI_TRACCIA} punti':<28} | {percorso:>8.2f}s | "
+              f"{percorso / (TRACCE * PUNTI_TRACCIA) * 1e6:>8.1f}us | {len(marker_percorso)}")
+
+        errori = controlla(indice, lon, lat, punti, marker, distanze_k)
+        print(f"\n[{'+' if not errori else '!'}] Controllo con forza bruta su {CAMPIONE_CONTROLLO} query: {errori} differenze")
+    finally:
+        if not args.cartella:
+            shutil.rmtree(cartella, ignore_errors=True)
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+
+from marker_batch import imscatter as imscatter_batch
+
+# === Costanti ===
+MARKER_IMAGE_PATH = "autovelox-icon.png"
+NUMERI_MARKER = [10, 1_000, 100_000]
+DPI = 300
+# Estensione di una provincia tipo (circa 100 km di lato) in EPSG:3857
+ESTENSIONE = (1_000_000, 5_000_000, 1_100_000, 5_100_000)
+
+
+# === imscatter originale (un AnnotationBbox per punto), come riferimento ===
+def imscatter_annotation(x, y, ax, zoom=0.015, image_path="autovelox-icon.png"):
+    img = plt.imread(image_path)
+    im = OffsetImage(img, zoom=zoom)
+    for xi, yi in zip(x, y):
+        ab = AnnotationBbox(im, (xi, yi), frameon=False, xycoords='data', box_alignment=(0.5, 0), zorder=10)
+        ax.add_artist(ab)
+
+
+def misura(funzione, x, y):
+    fig, ax = plt.subplots(figsize=(8.75, 8.75), dpi=DPI)
+    ax.set_xlim(ESTENSIONE[0], ESTENSIONE[2])
+    ax.set_ylim(ESTENSIONE[1], ESTENSIONE[3])
+    ax.set_axis_off()
+
+    inizio = time.perf_counter()
+    funzione(x, y, ax=ax, zoom=0.015, image_path=MARKER_IMAGE_PATH)
+    creazione = time.perf_counter() - inizio
+
+    inizio = time.perf_counter()
+    fig.canvas.draw()
+    disegno = time.perf_counter() - inizio
+
+    immagine = np.asarray(fig.canvas.buffer_rgba()).copy()
+    plt.close(fig)
+    return creazione, disegno, immagine
+
+
+# === Confronto tempi (creazione artist + draw Agg a 300 dpi) per 10, 1k e 100k marker ===
+# Uso: python bench_marker.py [--solo-batch]  (l'originale a 100k richiede diversi minuti)
+if __name__ == "__main__":
+    if not os.path.exists(MARKER_IMAGE_PATH):
+        print(f"[!] Icona marker non trovata: {MARKER_IMAGE_PATH}")
+        sys.exit(1)
+
+    solo_batch = "--solo-batch" in sys.argv
+    rng = np.random.default_rng(0)
+
+    print(f"{'marker':>8} | {'metodo':<12} | {'creazione':>10} | {'draw':>10} | {'totale':>10}")
+    for n in NUMERI_MARKER:
+        x = rng.uniform(ESTENSIONE[0], ESTENSIONE[2], n)
+        y = rng.uniform(ESTENSIONE[1], ESTENSIONE[3], n)
+
+        metodi = [("batch", imscatter_batch)]
+        if not solo_batch:
+            metodi.insert(0, ("annotation", imscatter_annotation))
+
+        immagini = {}
+        for nome, funzione in metodi:
+            creazione, disegno, immagini[nome] = misura(funzione, x, y)
+            print(f"{n:>8} | {nome:<12} | {creazione:>9.3f}s | {disegno:>9.3f}s | {creazione + disegno:>9.3f}s")
+
+        if len(immagini) == 2:
+            differenza = np.abs(immagini["batch"].astype(int) - immagini["annotation"].astype(int))
+            print(f"{'':>8} | differenza media per canale: {differenza.mean():.3f} / 255")
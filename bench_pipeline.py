@@ -0,0 +1,228 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# === Costanti ===
+REGIONI_PATH = "regioni.geojson"
+REGIONE = "Lombardia"  # i marker sintetici cadono dentro questa regione
+NUMERI_MARKER = [10, 1_000, 100_000, 1_000_000]
+RIPETIZIONI = 3  # render a cache calda per scenario (più uno a cache fredda)
+ZOOM = 11
+DPI = 300
+MARKER_IMAGE_PATH = "autovelox-icon.png"
+OUTPUT_JSON = "bench_risultati.json"
+
+# Fasi di un render a cache calda, nell'ordine della pipeline
+FASI_RENDER = ["caricamento_marker", "to_crs", "figura", "basemap", "marker_artist", "disegno_marker", "savefig"]
+
+
+def _picco_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows: nessun ru_maxrss
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco / 1024 / 1024 if platform.system() == "Darwin" else picco / 1024  # macOS in byte, Linux in KiB
+
+
+# === Punti casuali uniformi dentro il poligono (campionamento per rifiuto sul bbox) ===
+def punti_sintetici(geometria, n, seme=0):
+    import shapely
+
+    rng = np.random.default_rng(seme)
+    xmin, ymin, xmax, ymax = geometria.bounds
+    shapely.prepare(geometria)
+    lon, lat = np.empty(0), np.empty(0)
+    while len(lon) < n:
+        x = rng.uniform(xmin, xmax, 2 * n)
+        y = rng.uniform(ymin, ymax, 2 * n)
+        dentro = shapely.contains_xy(geometria, x, y)
+        lon, lat = np.concatenate([lon, x[dentro]]), np.concatenate([lat, y[dentro]])
+    return lon[:n], lat[:n]
+
+
+@contextmanager
+def _fase(tempi, nome):
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tempi[nome] = tempi.get(nome, 0.0) + time.perf_counter() - inizio
+
+
+# === Un render completo della regione, fase per fase (come regioni.py/prov.py) ===
+def _render(confine, cartella_marker, cache_marker, cache_tile, sorgente, percorso):
+    import matplotlib.pyplot as plt
+    from basemap import aggiungi_basemap
+    from marker_batch import imscatter
+    from marker_loader import carica_marker
+
+    tempi = {}
+    with _fase(tempi, "caricamento_marker"):
+        gdf = carica_marker("sintetici", cartella_marker, cache_dir=cache_marker)
+    with _fase(tempi, "to_crs"):
+        gdf_webmerc = gdf.to_crs(epsg=3857)
+
+    with _fase(tempi, "figura"):
+        fig, ax = plt.subplots(figsize=(8.75, 8.75))
+        confine.boundary.plot(ax=ax, color="black", linewidth=0.25, zorder=1)
+        xmin, ymin, xmax, ymax = confine.total_bounds
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+        ax.set_axis_off()
+    with _fase(tempi, "basemap"):
+        aggiungi_basemap(ax, zoom=ZOOM, source=sorgente, attribution_size=2, cache=cache_tile)
+    with _fase(tempi, "marker_artist"):
+        artist = imscatter(gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values, ax=ax, zoom=0.015,
+                           image_path=MARKER_IMAGE_PATH)
+
+    # Il disegno dei marker avviene dentro savefig: lo si misura a parte avvolgendo draw()
+    disegna = artist.draw
+
+    def draw_misurato(renderer):
+        with _fase(tempi, "disegno_marker"):
+            disegna(renderer)
+
+    artist.draw = draw_misurato
+    tempi["disegno_marker"] = 0.0
+    inizio = time.perf_counter()
+    fig.savefig(percorso, dpi=DPI, bbox_inches="tight", pad_inches=0)
+    tempi["savefig"] = time.perf_counter() - inizio - tempi["disegno_marker"]
+    plt.close(fig)
+
+    tempi["totale"] = sum(tempi[fase] for fase in FASI_RENDER)
+    return tempi
+
+
+# === Scenario con n marker, eseguito in un processo separato (picco RSS per scenario) ===
+def esegui_scenario(n, ripetizioni=RIPETIZIONI):
+    import matplotlib
+    matplotlib.use("Agg")
+    import geopandas as gpd
+    import pandas as pd
+    from marker_loader import coordinate_marker
+    from server_tile_locale import avvia_server, provider_locale
+    from tile_cache import TileCache
+
+    risultato = {"marker": n, "fasi_iniziali": {}}
+    server = avvia_server()
+    sorgente = provider_locale(server)
+
+    with tempfile.TemporaryDirectory(prefix="velox-bench-") as cartella:
+        inizio = time.perf_counter()
+        regioni = gpd.read_file(REGIONI_PATH)
+        risultato["fasi_iniziali"]["lettura_confini"] = time.perf_counter() - inizio
+
+        inizio = time.perf_counter()
+        regioni = regioni.to_crs(epsg=3857)
+        risultato["fasi_iniziali"]["proiezione_confini"] = time.perf_counter() - inizio
+
+        confine = regioni[regioni["reg_name"] == REGIONE]
+        lon, lat = punti_sintetici(confine.to_crs(epsg=4326).geometry.iloc[0], n)
+        cartella_marker = os.path.join(cartella, "marker")
+        os.makedirs(cartella_marker)
+        percorso_csv = os.path.join(cartella_marker, "sintetici.csv")
+        pd.DataFrame({"latitude": lat, "longitude": lon}).to_csv(percorso_csv, index=False, float_format="%.6f")
+
+        # Parsing del CSV senza cache binaria (prima esecuzione notturna)
+        cache_marker = os.path.join(cartella, "marker_cache")
+        inizio = time.perf_counter()
+        coordinate_marker(percorso_csv, cache_dir=cache_marker)
+        risultato["fasi_iniziali"]["parsing_marker"] = time.perf_counter() - inizio
+
+        # Primo render a cache tile vuota: le tile arrivano dal server locale
+        cache_tile = TileCache(os.path.join(cartella, "tile_cache"), offline=False)
+        percorso = os.path.join(cartella, "render.png")
+        risultato["render_freddo"] = _render(confine, cartella_marker, cache_marker, cache_tile, sorgente, percorso)
+        risultato["tile"] = {"richieste_server": server.richieste, **cache_tile.statistiche()}
+
+        render = [_render(confine, cartella_marker, cache_marker, cache_tile, sorgente, percorso)
+                  for _ in range(ripetizioni)]
+        risultato["output_bytes"] = os.path.getsize(percorso)
+
+    server.shutdown()
+    risultato["fasi"] = {fase: statistics.median(r[fase] for r in render) for fase in FASI_RENDER + ["totale"]}
+    risultato["render_al_minuto"] = 60 / risultato["fasi"]["totale"]
+    risultato["picco_rss_mb"] = _picco_rss_mb()
+    return risultato
+
+
+def _versione():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def stampa_tabella(scenari, riferimento=None):
+    precedenti = {s["marker"]: s for s in (riferimento or {}).get("scenari", [])}
+    intestazione = f"{'marker':>9} | " + " | ".join(f"{fase[:14]:>14}" for fase in FASI_RENDER)
+    print(intestazione + f" | {'totale':>8} | {'render/min':>10} | {'RSS MB':>7}")
+    for s in scenari:
+        riga = f"{s['marker']:>9} | " + " | ".join(f"{s['fasi'][fase]:>13.3f}s" for fase in FASI_RENDER)
+        rss = f"{s['picco_rss_mb']:.0f}" if s["picco_rss_mb"] is not None else "-"
+        riga += f" | {s['fasi']['totale']:>7.3f}s | {s['render_al_minuto']:>10.1f} | {rss:>7}"
+        print(riga)
+        if s["marker"] in precedenti:
+            prima = precedenti[s["marker"]]["fasi"]
+            print(f"{'rapporto':>9} | " + " | ".join(
+                f"{s['fasi'][fase] / prima[fase]:>13.2f}x" if prima.get(fase) else f"{'-':>14}"
+                for fase in FASI_RENDER) + f" | {s['fasi']['totale'] / prima['totale']:>7.2f}x |")
+
+    for s in scenari:
+        iniziali = ", ".join(f"{fase} {durata:.3f}s" for fase, durata in s["fasi_iniziali"].items())
+        freddo = s["render_freddo"]
+        print(f"  [i] {s['marker']} marker: {iniziali}; render a cache fredda {freddo['totale']:.3f}s "
+              f"(basemap {freddo['basemap']:.3f}s, {s['tile']['richieste_server']} tile dal server)")
+
+
+# === Benchmark della pipeline di rendering, fase per fase ===
+# Uso: python bench_pipeline.py [--marker 10 1000] [--output risultati.json] [--confronta precedente.json]
+# Tile da un server locale (server_tile_locale.py) e cache temporanee: risultati ripetibili, senza rete.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per fase della pipeline di rendering")
+    parser.add_argument("--marker", type=int, nargs="+", default=NUMERI_MARKER)
+    parser.add_argument("--ripetizioni", type=int, default=RIPETIZIONI)
+    parser.add_argument("--output", default=OUTPUT_JSON)
+    parser.add_argument("--confronta", help="JSON di un'esecuzione precedente da confrontare")
+    args = parser.parse_args()
+
+    # Un processo nuovo per scenario: il picco RSS di uno non si somma a quello del successivo
+    contesto = mp.get_context("spawn")
+    scenari = []
+    for n in args.marker:
+        print(f"[i] Scenario: {n} marker")
+        with contesto.Pool(1) as pool:
+            scenari.append(pool.apply(esegui_scenario, (n, args.ripetizioni)))
+
+    risultati = {
+        "versione": _versione(),
+        "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "piattaforma": platform.platform(),
+        "regione": REGIONE,
+        "zoom": ZOOM,
+        "dpi": DPI,
+        "scenari": scenari,
+    }
+
+    riferimento = None
+    if args.confronta:
+        with open(args.confronta, encoding="utf-8") as fh:
+            riferimento = json.load(fh)
+    print()
+    stampa_tabella(scenari, riferimento)
+
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(risultati, fh, indent=2)
+    print(f"\n[+] Risultati salvati: {args.output}")
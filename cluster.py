@@ -0,0 +1,68 @@
+import numpy as np
+import shapely
+
+# === Costanti ===
+RAGGIO_CLUSTER = 15  # punti tipografici (1/72 in), circa l'altezza dell'icona a zoom 0.015: sotto, le icone si coprono
+DIMENSIONE_CONTEGGIO = 0.3  # dimensione del numero, in frazione dell'altezza dell'icona
+
+
+# === Raggruppa punti in pixel: griglia, poi fusione golosa delle celle vicine ===
+# 1) ogni punto va in una cella quadrata con diagonale pari al raggio (punti della stessa
+#    cella sono sempre abbastanza vicini); 2) le celle, dalla più popolosa, assorbono le
+#    celle libere il cui baricentro è entro il raggio (STRtree sui baricentri).
+# O(n log n) sui punti, poi lavoro solo sulle celle occupate (al più pixel / raggio²).
+# Restituisce per ogni gruppo la posizione (baricentro dei punti), il numero di punti e il
+# gruppo di ogni punto; i gruppi seguono l'ordine del loro primo punto in input.
+def raggruppa(px, py, raggio):
+    px = np.asarray(px, dtype=float)
+    py = np.asarray(py, dtype=float)
+    if not len(px):
+        return np.empty(0), np.empty(0), np.empty(0, np.int64), np.empty(0, np.int64)
+
+    lato = raggio / np.sqrt(2)
+    cx = np.floor(px / lato).astype(np.int64)
+    cy = np.floor(py / lato).astype(np.int64)
+    _, cella, numero = np.unique(np.column_stack([cx, cy]), axis=0, return_inverse=True, return_counts=True)
+    cella = cella.ravel()
+    centro_x = np.bincount(cella, px) / numero
+    centro_y = np.bincount(cella, py) / numero
+
+    # Coppie di celle vicine, ordinate per la prima cella
+    centri = shapely.points(centro_x, centro_y)
+    prima, seconda = shapely.STRtree(centri).query(centri, predicate="dwithin", distance=raggio)
+    ordine_coppie = np.argsort(prima, kind="stable")
+    prima, seconda = prima[ordine_coppie], seconda[ordine_coppie]
+    inizi = np.searchsorted(prima, np.arange(len(numero)))
+    fini = np.searchsorted(prima, np.arange(len(numero)), side="right")
+
+    gruppo_cella = np.full(len(numero), -1, dtype=np.int64)
+    for c in np.lexsort((np.arange(len(numero)), -numero)):  # più popolose prima, a parità l'ordine della cella
+        if gruppo_cella[c] >= 0:
+            continue
+        vicine = seconda[inizi[c]:fini[c]]
+        gruppo_cella[vicine[gruppo_cella[vicine] < 0]] = c
+
+    # Gruppi numerati nell'ordine del primo punto in input
+    gruppo = gruppo_cella[cella]
+    primo = np.full(len(numero), len(px), dtype=np.int64)
+    np.minimum.at(primo, gruppo, np.arange(len(px)))
+    validi = np.flatnonzero(primo < len(px))
+    validi = validi[np.argsort(primo[validi], kind="stable")]
+    rinumera = np.empty(len(numero), dtype=np.int64)
+    rinumera[validi] = np.arange(len(validi))
+    gruppo = rinumera[gruppo]
+
+    conteggi = np.bincount(gruppo, minlength=len(validi))
+    return np.bincount(gruppo, px) / conteggi, np.bincount(gruppo, py) / conteggi, conteggi, gruppo
+
+
+# === Raggruppa punti in coordinate dati come appaiono negli assi (limiti e aspetto definitivi) ===
+# raggio in punti tipografici: stesso risultato a qualunque dpi di salvataggio.
+# Restituisce x, y (dati) dei gruppi e il numero di punti di ciascuno.
+def raggruppa_in_assi(ax, x, y, raggio=RAGGIO_CLUSTER):
+    ax.apply_aspect()
+    punti = ax.transData.transform(np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)]))
+    scala = ax.get_figure(root=True).dpi / 72
+    gx, gy, conteggi, _ = raggruppa(punti[:, 0] / scala, punti[:, 1] / scala, raggio)
+    dati = ax.transData.inverted().transform(np.column_stack([gx * scala, gy * scala]))
+    return dati[:, 0], dati[:, 1], conteggi
@@ -0,0 +1,180 @@
+import argparse
+import io
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+from file_util import scrivi_atomico
+from strumentazione import unita_corrente
+
+# === Costanti ===
+FORMATO = os.environ.get("VELOX_FORMATO", "png")  # "png", "png8" (palette di 256 colori) o "webp"
+COMPRESSIONE = None  # png/png8: livello zlib 0-9 (None = 6, come matplotlib); webp: qualità 0-100 (None = 90)
+THREAD_CODIFICA = int(os.environ.get("VELOX_THREAD_CODIFICA", "2"))  # 0 = codifica nel thread che disegna
+ESTENSIONI = {"png": ".png", "png8": ".png", "webp": ".webp"}
+PAD_INCHES = 0.1  # come savefig(bbox_inches="tight")
+
+_pool = None
+_in_corso = {}  # percorso assoluto -> future della codifica
+_statistiche = {}  # formato -> {"immagini", "s", "bytes"} in questo processo
+_lock = threading.Lock()
+
+
+def estensione_formato(formato=FORMATO):
+    if formato not in ESTENSIONI:
+        raise ValueError(f"formato non supportato: {formato} (disponibili: {', '.join(ESTENSIONI)})")
+    return ESTENSIONI[formato]
+
+
+# === Pixel RGBA della figura al dpi di uscita, con un solo disegno ===
+# bbox_inches="tight": il riquadro stretto è misurato sul renderer appena usato e ritagliato
+# dal buffer di Agg, invece di ridisegnare la figura come savefig. Il contenuto che esce dai
+# bordi della figura resta escluso (savefig allargherebbe l'immagine).
+# finestra=True: restituisce anche (riga, colonna) dell'angolo in alto a sinistra del
+# ritaglio nel buffer della figura intera (sfondi.py).
+def rasterizza(fig, dpi, bbox_inches="tight", pad_inches=PAD_INCHES, finestra=False):
+    canvas = fig.canvas if isinstance(fig.canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
+    dpi_originale = fig.dpi
+    fig.set_dpi(dpi)
+    try:
+        canvas.draw()
+        rgba = np.asarray(canvas.buffer_rgba())
+        riga = colonna = 0
+        if bbox_inches == "tight":
+            riquadro = fig.get_tightbbox(canvas.get_renderer()).padded(pad_inches)
+            # Stessa dimensione in pixel di savefig (FigureCanvasBase.get_width_height), dentro il buffer
+            altezza, larghezza = rgba.shape[:2]
+            lato_x = min(int(riquadro.width * dpi + 1e-8), larghezza)
+            lato_y = min(int(riquadro.height * dpi + 1e-8), altezza)
+            x0 = min(max(round(riquadro.x0 * dpi), 0), larghezza - lato_x)
+            y0 = min(max(round(riquadro.y0 * dpi), 0), altezza - lato_y)
+            riga, colonna = altezza - y0 - lato_y, x0
+            rgba = rgba[riga:altezza - y0, x0:x0 + lato_x]
+        rgba = rgba.copy()  # il buffer di Agg viene riusato dal disegno successivo
+        return (rgba, (riga, colonna)) if finestra else rgba
+    finally:
+        fig.set_dpi(dpi_originale)
+
+
+# === Byte dell'immagine nel formato richiesto ===
+# Se tutti i pixel sono opachi si codifica RGB: un quarto di dati in meno da comprimere.
+def codifica(rgba, formato=FORMATO, compressione=COMPRESSIONE, dpi=None):
+    estensione_formato(formato)
+    immagine = Image.fromarray(rgba, "RGBA")
+    if rgba[..., 3].min() == 255:
+        immagine = immagine.convert("RGB")
+    opzioni = {"dpi": (dpi, dpi)} if dpi else {}
+
+    buffer = io.BytesIO()
+    if formato == "webp":
+        immagine.save(buffer, format="WEBP", quality=90 if compressione is None else compressione, method=4)
+    else:
+        if formato == "png8":
+            immagine = immagine.quantize(256, method=Image.Quantize.FASTOCTREE)
+        immagine.save(buffer, format="PNG", compress_level=6 if compressione is None else compressione, **opzioni)
+    return buffer.getvalue()
+
+
+def _registra(formato, durata, dimensione, metriche):
+    with _lock:
+        destinazioni = [_statistiche]
+        if metriche is not None:
+            destinazioni.append(metriche.setdefault("codifica", {}))
+        for statistiche in destinazioni:
+            voce = statistiche.setdefault(formato, {"immagini": 0, "s": 0.0, "bytes": 0})
+            voce["immagini"] += 1
+            voce["s"] = round(voce["s"] + durata, 4)
+            voce["bytes"] += dimensione
+
+
+def _scrivi(rgba, percorso, formato, compressione, dpi, metriche):
+    inizio = time.perf_counter()
+    dati = codifica(rgba, formato, compressione, dpi)
+    scrivi_atomico(percorso, lambda fh: fh.write(dati))
+    _registra(formato, time.perf_counter() - inizio, len(dati), metriche)
+
+
+# === Salva la figura: disegno qui, codifica e scrittura in un thread in background ===
+# Sostituisce fig.savefig(percorso, dpi=dpi, bbox_inches=..., pad_inches=...): la codifica
+# dell'immagine si sovrappone al disegno della successiva. Il file è completo dopo
+# attendi_codifiche(); tempo e byte per formato finiscono nelle metriche dell'unità corrente.
+def salva(fig, percorso, dpi, bbox_inches="tight", pad_inches=PAD_INCHES, formato=FORMATO, compressione=COMPRESSIONE):
+    estensione_formato(formato)
+    salva_rgba(rasterizza(fig, dpi, bbox_inches, pad_inches), percorso, dpi, formato, compressione)
+
+
+# === Salva pixel RGBA già pronti (es. sfondo più marker di sfondi.py), codifica in background ===
+def salva_rgba(rgba, percorso, dpi, formato=FORMATO, compressione=COMPRESSIONE):
+    global _pool
+    estensione_formato(formato)
+    metriche = unita_corrente()
+    if not THREAD_CODIFICA:
+        _scrivi(rgba, percorso, formato, compressione, dpi, metriche)
+        return
+
+    chiave = os.path.abspath(percorso)
+    with _lock:
+        precedente = _in_corso.get(chiave)
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=THREAD_CODIFICA, thread_name_prefix="codifica")
+    if precedente is not None:
+        precedente.exception()  # stesso file richiesto di nuovo: le scritture restano in ordine
+    future = _pool.submit(_scrivi, rgba, percorso, formato, compressione, dpi, metriche)
+    with _lock:
+        _in_corso[chiave] = future
+
+
+# === Attende le codifiche dei percorsi indicati (None = tutte) ===
+# Restituisce {percorso: traceback} delle codifiche fallite.
+def attendi_codifiche(percorsi=None):
+    with _lock:
+        if percorsi is None:
+            chiavi = list(_in_corso)
+        else:
+            chiavi = [os.path.abspath(percorso) for percorso in percorsi]
+        future = {chiave: _in_corso.pop(chiave) for chiave in chiavi if chiave in _in_corso}
+
+    errori = {}
+    for chiave, attesa in future.items():
+        errore = attesa.exception()
+        if errore is not None:
+            errori[chiave] = "".join(traceback.format_exception(errore))
+    return errori
+
+
+# === Tempo e byte di codifica per formato ({formato: {"immagini", "s", "bytes"}}) ===
+def statistiche_codifica():
+    with _lock:
+        return {formato: dict(voce) for formato, voce in _statistiche.items()}
+
+
+def stampa_codifica(statistiche):
+    for formato, voce in sorted(statistiche.items()):
+        print(f"[i] Codifica {formato}: {voce['immagini']} immagini in {voce['s']:.1f}s, "
+              f"{voce['bytes'] / 1024 / 1024:.1f} MB ({voce['bytes'] / max(voce['immagini'], 1) / 1024:.0f} KB/immagine)")
+
+
+# === Confronto dei formati su un'immagine già salvata: tempo di codifica e byte ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tempo e dimensione di un'immagine in ogni formato di uscita")
+    parser.add_argument("immagine")
+    parser.add_argument("--ripetizioni", type=int, default=3)
+    args = parser.parse_args()
+
+    rgba = np.asarray(Image.open(args.immagine).convert("RGBA"))
+    print(f"[i] {args.immagine}: {rgba.shape[1]}x{rgba.shape[0]} px, {os.path.getsize(args.immagine) / 1024:.0f} KB")
+    prove = [("png", livello) for livello in (1, 6, 9)] + [("png8", 6), ("png8", 9)]
+    prove += [("webp", qualita) for qualita in (75, 90)] + [("webp", 100)]
+    for formato, compressione in prove:
+        durate = []
+        for _ in range(args.ripetizioni):
+            inizio = time.perf_counter()
+            dati = codifica(rgba, formato, compressione)
+            durate.append(time.perf_counter() - inizio)
+        print(f"  [i] {formato:5} {compressione:>3}: {min(durate) * 1000:7.0f} ms, {len(dati) / 1024:8.0f} KB")
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import pickle
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from file_util import impronta_file, scrivi_atomico
+from strumentazione import fase
+
+# === Costanti ===
+CONFINI_CACHE = "confini_cache"
+PIXEL_USCITA = 2625  # lato dell'immagine in pixel (8.75 in a 300 dpi)
+MARGINE = 0.05  # margine attorno al confine, come in prov3.py/prov4.py
+FRAZIONE_PIXEL = 0.5  # tolleranza di semplificazione in frazioni di pixel
+VERSIONE_CACHE = 1
+
+
+# === Tolleranza (metri) per cui la semplificazione resta sotto il pixel ===
+def tolleranza_per_estensione(larghezza_m, pixel_uscita=PIXEL_USCITA):
+    return larghezza_m / pixel_uscita * FRAZIONE_PIXEL
+
+
+# === Catalogo dei confini in EPSG:3857, riproiettato e semplificato una sola volta ===
+# Colonne aggiunte: xmin/ymin/xmax/ymax (bounds proiettati), "semplificata" (confine
+# semplificato per un'immagine di pixel_uscita pixel sull'estensione dell'unità) e
+# "tolleranza" usata. Il risultato è salvato in CONFINI_CACHE e riletto finché il
+# GeoJSON non cambia (mtime e dimensione, poi SHA-1).
+def carica_confini(geojson_path, pixel_uscita=PIXEL_USCITA, cache_dir=CONFINI_CACHE):
+    os.makedirs(cache_dir, exist_ok=True)
+    chiave = hashlib.sha1(f"{os.path.abspath(geojson_path)}|{pixel_uscita}".encode("utf-8")).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{chiave}.pkl")
+    info = os.stat(geojson_path)
+
+    salvato = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as fh:
+                salvato = pickle.load(fh)
+        except Exception:
+            salvato = None  # cache corrotta o di un'altra versione di geopandas: si ricostruisce
+    if salvato and salvato.get("versione") != VERSIONE_CACHE:
+        salvato = None
+
+    if salvato and salvato["mtime_ns"] == info.st_mtime_ns and salvato["size"] == info.st_size:
+        return salvato["confini"]
+
+    sha1 = impronta_file(geojson_path)
+    if salvato and salvato["sha1"] == sha1:
+        confini = salvato["confini"]
+    else:
+        print(f"[i] Proiezione e semplificazione confini: {geojson_path}")
+        confini = _costruisci(geojson_path, pixel_uscita)
+
+    salvato = {"versione": VERSIONE_CACHE, "mtime_ns": info.st_mtime_ns, "size": info.st_size,
+               "sha1": sha1, "confini": confini}
+    scrivi_atomico(cache_path, lambda fh: pickle.dump(salvato, fh, protocol=pickle.HIGHEST_PROTOCOL))
+    return confini
+
+
+def _costruisci(geojson_path, pixel_uscita):
+    confini = gpd.read_file(geojson_path).to_crs(epsg=3857)
+
+    limiti = confini.geometry.bounds
+    confini["xmin"], confini["ymin"] = limiti["minx"], limiti["miny"]
+    confini["xmax"], confini["ymax"] = limiti["maxx"], limiti["maxy"]
+
+    # Una tolleranza per unità, dalla sua estensione con margine (semplificazione vettoriale)
+    lato = np.maximum(confini["xmax"] - confini["xmin"], confini["ymax"] - confini["ymin"]) * (1 + 2 * MARGINE)
+    confini["tolleranza"] = tolleranza_per_estensione(lato.to_numpy(), pixel_uscita)
+    confini["semplificata"] = gpd.GeoSeries(
+        shapely.simplify(confini.geometry.values, confini["tolleranza"].to_numpy(), preserve_topology=True),
+        index=confini.index, crs=confini.crs,
+    )
+
+    vertici_prima = shapely.get_num_coordinates(confini.geometry.values).sum()
+    vertici_dopo = shapely.get_num_coordinates(confini["semplificata"].values).sum()
+    print(f"  [i] Vertici: {vertici_prima} -> {vertici_dopo}")
+    return confini
+
+
+# === Confine di un'unità adatto a un'estensione visualizzata di larghezza_m metri ===
+# Usa la versione semplificata del catalogo se abbastanza precisa; con estensioni più
+# piccole (es. ZOOM_MODE "marker") semplifica la geometria completa alla tolleranza giusta.
+@fase("confine")
+def confine_per_estensione(unita, larghezza_m, pixel_uscita=PIXEL_USCITA):
+    tolleranza = tolleranza_per_estensione(larghezza_m, pixel_uscita)
+    if tolleranza >= unita["tolleranza"]:
+        geometria = unita["semplificata"]
+    else:
+        geometria = shapely.simplify(unita.geometry, tolleranza, preserve_topology=True)
+    return gpd.GeoSeries([geometria], crs="EPSG:3857")
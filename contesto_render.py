@@ -0,0 +1,44 @@
+import threading
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Contesti di questo thread: figsize -> ContestoRender
+_locale = threading.local()
+
+
+# === Figura Agg riusata tra un'unità e l'altra, senza pyplot ===
+# Figura, assi, canvas e buffer del renderer restano gli stessi: tra due unità si svuotano
+# solo gli assi (basemap, confine, marker, testi) e si ripristinano dimensione e posizione.
+# Nessuno stato globale di pyplot, quindi niente figure da chiudere né memoria che cresce
+# nei batch lunghi; ogni thread (e processo worker) ha i propri contesti.
+class ContestoRender:
+    def __init__(self, figsize):
+        self.figsize = tuple(figsize)
+        self.fig = Figure(figsize=self.figsize)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self.posizione = self.ax.get_position()
+        self.dpi = self.fig.dpi
+        self.usi = 0
+
+    def azzera(self):
+        self.ax.clear()  # anche limiti, aspetto e assi visibili tornano ai valori iniziali
+        self.fig.set_dpi(self.dpi)
+        self.fig.set_size_inches(self.figsize)
+        self.ax.set_position(self.posizione)
+        self.ax.set_in_layout(True)
+        self.usi += 1
+        return self.fig, self.ax
+
+
+# === (fig, ax) vuoti della dimensione richiesta, al posto di plt.subplots(figsize=...) ===
+# Non va chiusa: la stessa figura torna, svuotata, alla chiamata successiva del thread.
+def figura(figsize=(8.75, 8.75)):
+    contesti = getattr(_locale, "contesti", None)
+    if contesti is None:
+        contesti = _locale.contesti = {}
+    contesto = contesti.get(tuple(figsize))
+    if contesto is None:
+        contesto = contesti[tuple(figsize)] = ContestoRender(figsize)
+    return contesto.azzera()
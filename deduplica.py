@@ -0,0 +1,143 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from file_util import scrivi_atomico
+from ingestione import ingerisci
+from marker_loader import ESTENSIONI, coordinate_marker
+from webmercator import lonlat_a_webmerc
+
+# === Costanti ===
+# Cartelle di file marker, in ordine di priorità: a parità di posizione resta il punto della
+# prima fonte. Non si scende nelle sottocartelle (es. le partizioni scritte da ingestione.py).
+CARTELLE = ["dati_marker", "dati_marker/Nuova cartella"]
+DISTANZA_M = 25  # metri sul terreno entro cui due marker sono la stessa postazione
+CANONICO = "dati_marker/canonico/marker.csv"  # archivio unico: latitude, longitude, fonti, provenienza
+PARTIZIONA = True  # ripartisce l'archivio per provincia/regione con ingestione.py (dati_marker/province, ...)
+
+
+# === File marker delle cartelle, nell'ordine delle cartelle e poi per nome ===
+# Un file indicato al posto di una cartella è preso così com'è.
+def file_sorgente(cartelle=CARTELLE, escludi=()):
+    escludi = {os.path.abspath(percorso) for percorso in escludi}
+    percorsi = []
+    for cartella in cartelle:
+        if os.path.isfile(cartella):
+            if os.path.abspath(cartella) not in escludi:
+                percorsi.append(cartella)
+            continue
+        if not os.path.isdir(cartella):
+            print(f"  [!] Cartella o file non trovato: {cartella}, salto...")
+            continue
+        for voce in sorted(os.scandir(cartella), key=lambda voce: voce.name.lower()):
+            if (voce.is_file() and os.path.splitext(voce.name)[1].lower() in ESTENSIONI
+                    and os.path.abspath(voce.path) not in escludi):
+                percorsi.append(voce.path)
+    return percorsi
+
+
+# === Coordinate di tutti i file (cache binaria di marker_loader) e indice della fonte di ogni punto ===
+def carica_sorgenti(percorsi):
+    longitudini, latitudini, fonti, usati = [], [], [], []
+    for percorso in percorsi:
+        try:
+            coordinate = coordinate_marker(percorso)
+        except (ValueError, OSError) as errore:
+            print(f"  [!] File marker non valido {percorso}: {errore}")
+            continue
+        if not len(coordinate):
+            continue
+        longitudini.append(np.asarray(coordinate[:, 0]))
+        latitudini.append(np.asarray(coordinate[:, 1]))
+        fonti.append(np.full(len(coordinate), len(usati), dtype=np.int64))
+        usati.append(percorso)
+    if not usati:
+        return np.empty(0), np.empty(0), np.empty(0, np.int64), []
+    return np.concatenate(longitudini), np.concatenate(latitudini), np.concatenate(fonti), usati
+
+
+# === Punto canonico di ogni marker: il primo, in ordine di input, entro distanza_m ===
+# Distanze in EPSG:3857, dove un metro sul terreno vale 1/cos(latitudine) metri: la soglia di
+# ogni punto è scalata alla sua latitudine (alla scala di poche decine di metri la scala non
+# cambia). Le coppie vicine vengono da una query dwithin su uno STRtree (come in
+# cluster.py); poi ogni punto non ancora assorbito diventa canonico e assorbe i suoi vicini
+# liberi. A differenza di un'unione per componenti connesse, una catena di punti a distanza
+# minore della soglia non fonde postazioni lontane.
+def deduplica(longitudine, latitudine, distanza_m=DISTANZA_M):
+    if not len(longitudine):
+        return np.empty(0, np.int64)
+    x, y = lonlat_a_webmerc(longitudine, latitudine)
+    punti = shapely.points(x, y)
+    soglie = distanza_m / np.cos(np.radians(latitudine))
+    primo, secondo = shapely.STRtree(punti).query(punti, predicate="dwithin", distance=soglie)
+    ordine = np.lexsort((secondo, primo))
+    primo, secondo = primo[ordine], secondo[ordine]
+    inizi = np.searchsorted(primo, np.arange(len(punti)))
+    fini = np.searchsorted(primo, np.arange(len(punti)), side="right")
+
+    canonico = np.full(len(punti), -1, dtype=np.int64)
+    for indice in range(len(punti)):
+        if canonico[indice] >= 0:
+            continue
+        vicini = secondo[inizi[indice]:fini[indice]]  # comprende il punto stesso
+        canonico[vicini[canonico[vicini] < 0]] = indice
+    return canonico
+
+
+# === Archivio canonico: una riga per postazione, con numero di record e file di provenienza ===
+def scrivi_canonico(longitudine, latitudine, fonti, percorsi, canonico, destinazione=CANONICO):
+    ordine = np.argsort(canonico, kind="stable")
+    rappresentanti, inizi, numero = np.unique(canonico[ordine], return_index=True, return_counts=True)
+    provenienza = []
+    for inizio, quanti in zip(inizi, numero):
+        indici_fonte = np.unique(fonti[ordine[inizio:inizio + quanti]])
+        provenienza.append("|".join(percorsi[i] for i in indici_fonte))
+
+    tabella = pd.DataFrame({"latitude": latitudine[rappresentanti], "longitude": longitudine[rappresentanti],
+                            "fonti": numero, "provenienza": provenienza})
+    cartella = os.path.dirname(destinazione)
+    if cartella:
+        os.makedirs(cartella, exist_ok=True)
+    contenuto = tabella.to_csv(index=False, float_format="%.6f").encode("utf-8")
+    scrivi_atomico(destinazione, lambda fh: fh.write(contenuto))
+    return len(tabella)
+
+
+# === Unione delle fonti: indice spaziale, fusione dei duplicati, archivio canonico ===
+def unisci(cartelle=CARTELLE, distanza_m=DISTANZA_M, destinazione=CANONICO, partiziona=PARTIZIONA):
+    inizio = time.perf_counter()
+    percorsi = file_sorgente(cartelle, escludi=(destinazione,))
+    longitudine, latitudine, fonti, usati = carica_sorgenti(percorsi)
+    print(f"[i] {len(longitudine)} marker da {len(usati)} file in {len(cartelle)} cartelle")
+    if not len(longitudine):
+        return None
+
+    canonico = deduplica(longitudine, latitudine, distanza_m)
+    scritti = scrivi_canonico(longitudine, latitudine, fonti, usati, canonico, destinazione)
+    print(f"[+] {destinazione}: {scritti} marker canonici, {len(longitudine) - scritti} duplicati entro "
+          f"{distanza_m} m fusi ({time.perf_counter() - inizio:.1f}s)")
+
+    # Per fonte: marker già presenti in una fonte precedente (o ripetuti nello stesso file)
+    duplicati = canonico != np.arange(len(canonico))
+    for indice, percorso in enumerate(usati):
+        del_file = fonti == indice
+        if duplicati[del_file].any():
+            print(f"  [=] {percorso}: {int(duplicati[del_file].sum())} di {int(del_file.sum())} già presenti")
+
+    if partiziona:
+        ingerisci(destinazione)
+    return destinazione
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Unisce le cartelle di marker in un archivio senza duplicati")
+    parser.add_argument("cartelle", nargs="*", default=CARTELLE, help="in ordine di priorità")
+    parser.add_argument("--distanza", type=float, default=DISTANZA_M, help="metri entro cui due marker coincidono")
+    parser.add_argument("--output", default=CANONICO)
+    parser.add_argument("--senza-partizioni", action="store_true", help="non eseguire ingestione.py sull'archivio")
+    args = parser.parse_args()
+    unisci(args.cartelle, args.distanza, args.output, not args.senza_partizioni)
@@ -0,0 +1,199 @@
+import argparse
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+from matplotlib import patheffects
+from matplotlib.colors import LogNorm
+
+from basemap import aggiungi_basemap
+from codifica import attendi_codifiche, estensione_formato, salva, stampa_codifica, statistiche_codifica
+from confini import carica_confini
+from contesto_render import ContestoRender
+from deduplica import CANONICO, file_sorgente
+from ingestione import RIGHE_BLOCCO, assegna_unita, blocchi_coordinate
+from marker_loader import coordinate_valide
+from webmercator import lonlat_a_webmerc
+
+# === Costanti ===
+GEOJSON_PATH = "regioni.geojson"  # unità dei conteggi e della coropleta (anche "province.geojson", campo prov_name)
+CAMPO_NOME = "reg_name"
+# Archivio senza duplicati di deduplica.py: le cartelle grezze ripetono gli stessi autovelox (copie
+# delle province, file regionali) e gonfierebbero i conteggi. Altre sorgenti solo se indicate.
+SORGENTI = [CANONICO]
+OUTPUT_FOLDER = "output_maps"
+FIGSIZE = (10, 10)
+DPI = 150
+PIXEL_PER_CELLA = 4  # lato di una cella della griglia in pixel dell'immagine: la risoluzione segue l'uscita
+MARGINE = 0.03  # frazione dell'estensione delle unità
+MODO = "griglia"  # "griglia" (raster di densità) o "coropleta" (unità colorate per numero di marker)
+MAPPA_COLORI = "inferno_r"
+ALPHA = 0.75
+MAX_TILE = 400
+FORMATO = "png"
+COMPRESSIONE = None
+
+# === Griglia regolare in EPSG:3857: origine (basso a sinistra), lato della cella in metri, colonne e righe ===
+Griglia = namedtuple("Griglia", ["xmin", "ymin", "lato", "colonne", "righe"])
+
+
+# === Griglia sull'estensione con celle di pixel_per_cella pixel in un'immagine di pixel_uscita di lato ===
+def griglia_per_uscita(xmin, ymin, xmax, ymax, pixel_uscita, pixel_per_cella=PIXEL_PER_CELLA):
+    lato = max(xmax - xmin, ymax - ymin) * pixel_per_cella / pixel_uscita
+    colonne = max(int(np.ceil((xmax - xmin) / lato)), 1)
+    righe = max(int(np.ceil((ymax - ymin) / lato)), 1)
+    return Griglia(xmin, ymin, lato, colonne, righe)
+
+
+def estensione_griglia(griglia):
+    return (griglia.xmin, griglia.xmin + griglia.colonne * griglia.lato,
+            griglia.ymin, griglia.ymin + griglia.righe * griglia.lato)
+
+
+# === Marker per cella: indice lineare e np.bincount, accumulati in conteggi (righe * colonne) ===
+# I punti fuori dalla griglia sono ignorati. Costo lineare nei punti, senza ordinamenti.
+def conta_in_griglia(x, y, griglia, conteggi=None):
+    if conteggi is None:
+        conteggi = np.zeros(griglia.righe * griglia.colonne, dtype=np.int64)
+    colonna = np.floor((np.asarray(x) - griglia.xmin) / griglia.lato)
+    riga = np.floor((np.asarray(y) - griglia.ymin) / griglia.lato)
+    dentro = (colonna >= 0) & (colonna < griglia.colonne) & (riga >= 0) & (riga < griglia.righe)
+    indici = riga[dentro].astype(np.int64) * griglia.colonne + colonna[dentro].astype(np.int64)
+    conteggi += np.bincount(indici, minlength=len(conteggi))
+    return conteggi
+
+
+# === Unità (indice in confini, -1 fuori) che contiene il centro di ogni cella ===
+# Dipende solo da griglia e confini, non dai marker: i conteggi per unità diventano una
+# somma pesata sulle celle. Precisione pari alla cella per i marker vicini a un confine.
+def unita_celle(griglia, confini):
+    colonne, righe = np.meshgrid(np.arange(griglia.colonne), np.arange(griglia.righe))
+    x = griglia.xmin + (colonne.ravel() + 0.5) * griglia.lato
+    y = griglia.ymin + (righe.ravel() + 0.5) * griglia.lato
+    return assegna_unita(x, y, confini)
+
+
+def conteggi_unita(conteggi, celle, numero_unita):
+    dentro = celle >= 0
+    return np.bincount(celle[dentro], weights=conteggi[dentro], minlength=numero_unita).astype(np.int64)
+
+
+# === Aggregazione delle sorgenti: blocchi validati, proiettati e contati nella griglia ===
+# Restituisce conteggi per cella, marker letti e secondi spesi a proiettare e contare (la
+# lettura dei file esclusa).
+def aggrega(percorsi, griglia, righe=RIGHE_BLOCCO):
+    conteggi = np.zeros(griglia.righe * griglia.colonne, dtype=np.int64)
+    letti, durata = 0, 0.0
+    for percorso in percorsi:
+        try:
+            for longitudine, latitudine in blocchi_coordinate(percorso, righe):
+                inizio = time.perf_counter()
+                validi = coordinate_valide(longitudine, latitudine)
+                x, y = lonlat_a_webmerc(longitudine[validi], latitudine[validi])
+                conta_in_griglia(x, y, griglia, conteggi)
+                letti += int(validi.sum())
+                durata += time.perf_counter() - inizio
+        except (ValueError, OSError) as errore:
+            print(f"  [!] File marker non valido {percorso}: {errore}")
+    return conteggi, letti, durata
+
+
+# === Raster di densità sopra la basemap: celle vuote trasparenti, scala logaritmica ===
+def disegna_griglia(ax, conteggi, griglia, mappa_colori=MAPPA_COLORI, alpha=ALPHA):
+    densita = np.ma.masked_equal(conteggi.reshape(griglia.righe, griglia.colonne), 0)
+    if densita.count() == 0:
+        return None
+    norma = LogNorm(vmin=1, vmax=max(int(densita.max()), 2))
+    return ax.imshow(densita, extent=estensione_griglia(griglia), origin="lower", cmap=mappa_colori, norm=norma,
+                     alpha=alpha, interpolation="nearest", zorder=2)
+
+
+# === Coropleta: unità colorate per numero di marker, con il numero sul punto interno ===
+def disegna_coropleta(ax, confini, numeri, mappa_colori=MAPPA_COLORI, alpha=ALPHA):
+    con_marker = confini.assign(marker=numeri)[numeri > 0]
+    if con_marker.empty:
+        return None
+    minimo, massimo = con_marker["marker"].min(), con_marker["marker"].max()
+    norma = LogNorm(vmin=minimo, vmax=max(massimo, minimo + 1))
+    con_marker.plot(ax=ax, column="marker", cmap=mappa_colori, norm=norma, alpha=alpha, zorder=2)
+    contorno = [patheffects.withStroke(linewidth=1.5, foreground="black")]
+    for punto, numero in zip(con_marker.geometry.representative_point(), con_marker["marker"]):
+        ax.annotate(str(numero), (punto.x, punto.y), ha="center", va="center", fontsize=6, fontweight="bold",
+                    color="white", path_effects=contorno, zorder=5)
+    return ax.collections[-1]
+
+
+# === Panoramica nazionale (o di un'area): griglia, conteggi per unità, immagine ===
+# area: nome di un'unità di geojson_path su cui restringere la mappa e i conteggi (None = tutte).
+def panoramica(sorgenti=SORGENTI, geojson_path=GEOJSON_PATH, campo_nome=CAMPO_NOME, area=None, modo=MODO,
+               output=None):
+    pixel_uscita = max(FIGSIZE) * DPI
+    confini = carica_confini(geojson_path, pixel_uscita)
+    if area is not None:
+        scelte = confini[confini[campo_nome].str.lower() == area.lower()]
+        if scelte.empty:
+            raise ValueError(f"unità non trovata in {geojson_path}: {area}")
+    else:
+        scelte = confini
+    scelte = scelte.reset_index(drop=True)
+    xmin, ymin, xmax, ymax = scelte["xmin"].min(), scelte["ymin"].min(), scelte["xmax"].max(), scelte["ymax"].max()
+    dx, dy = (xmax - xmin) * MARGINE, (ymax - ymin) * MARGINE
+    griglia = griglia_per_uscita(xmin - dx, ymin - dy, xmax + dx, ymax + dy, pixel_uscita)
+
+    percorsi = file_sorgente(sorgenti)
+    if not percorsi:
+        raise FileNotFoundError(f"nessun file marker in {', '.join(sorgenti)}"
+                                + (" (creare l'archivio con: python deduplica.py)" if CANONICO in sorgenti else ""))
+    inizio = time.perf_counter()
+    conteggi, letti, durata = aggrega(percorsi, griglia)
+    inizio_unita = time.perf_counter()
+    numeri = conteggi_unita(conteggi, unita_celle(griglia, scelte), len(scelte))
+    print(f"[i] {letti} marker da {len(percorsi)} file in {time.perf_counter() - inizio:.1f}s: aggregazione "
+          f"{durata * 1000:.0f} ms su griglia {griglia.colonne}x{griglia.righe} "
+          f"(celle di {griglia.lato / 1000:.1f} km), unità {(time.perf_counter() - inizio_unita) * 1000:.0f} ms")
+    for nome, numero in sorted(zip(scelte[campo_nome], numeri), key=lambda voce: -voce[1]):
+        if numero:
+            print(f"  [=] {nome}: {numero}")
+    fuori = letti - int(numeri.sum())
+    if fuori:
+        print(f"  [i] {fuori} marker fuori dalle unità di {geojson_path} (o dalla griglia)")
+
+    fig, ax = ContestoRender(FIGSIZE).azzera()  # figura propria: la barra dei colori aggiunge assi
+    ax.set_aspect("equal")
+    estensione = estensione_griglia(griglia)
+    ax.axis(estensione)
+    if modo == "coropleta":
+        livello = disegna_coropleta(ax, scelte, numeri)
+    else:
+        livello = disegna_griglia(ax, conteggi, griglia)
+    confini.boundary.plot(ax=ax, color="black", linewidth=0.4, zorder=3)
+    ax.axis(estensione)
+    aggiungi_basemap(ax, dpi=DPI, max_tile=MAX_TILE)
+    if livello is not None:
+        fig.colorbar(livello, ax=ax, shrink=0.6, pad=0.01, label="marker" + (" per cella" if modo != "coropleta" else ""))
+    ax.set_title(f"Autovelox: {int(conteggi.sum())} marker" + (f", {area.title()}" if area else ""))
+    ax.set_axis_off()
+
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    nome = f"densita_{(area or 'italia').lower().replace(' ', '_')}_{modo}"
+    output = output or os.path.join(OUTPUT_FOLDER, f"{nome}{estensione_formato(FORMATO)}")
+    salva(fig, output, DPI, formato=FORMATO, compressione=COMPRESSIONE)
+    for percorso, errore in attendi_codifiche([output]).items():
+        print(f"  [!] Codifica fallita: {percorso}\n{errore}")
+    print(f"[+] Salvata: {output}")
+    stampa_codifica(statistiche_codifica())
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Panoramica della densità dei marker su griglia o per unità")
+    parser.add_argument("sorgenti", nargs="*", default=SORGENTI,
+                        help="file o cartelle di marker (predefinito: l'archivio di deduplica.py)")
+    parser.add_argument("--confini", default=GEOJSON_PATH, help="GeoJSON delle unità (conteggi e coropleta)")
+    parser.add_argument("--campo", default=CAMPO_NOME, help="campo con il nome dell'unità")
+    parser.add_argument("--area", help="restringe la mappa a un'unità (es. Lombardia)")
+    parser.add_argument("--modo", choices=["griglia", "coropleta"], default=MODO)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    panoramica(args.sorgenti, args.confini, args.campo, args.area, args.modo, args.output)
@@ -0,0 +1,26 @@
+import hashlib
+import os
+import tempfile
+
+
+# === SHA-1 del contenuto di un file, letto a blocchi ===
+def impronta_file(percorso):
+    sha1 = hashlib.sha1()
+    with open(percorso, "rb") as fh:
+        for blocco in iter(lambda: fh.read(1 << 20), b""):
+            sha1.update(blocco)
+    return sha1.hexdigest()
+
+
+# === Scrittura atomica: file temporaneo nella stessa cartella + os.replace ===
+# scrivi(fh) riceve il file temporaneo aperto in binario.
+def scrivi_atomico(percorso, scrivi):
+    fd, temporaneo = tempfile.mkstemp(dir=os.path.dirname(percorso) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            scrivi(fh)
+        os.replace(temporaneo, percorso)
+    except BaseException:
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+        raise
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import shapely
+
+from deduplica import CANONICO, file_sorgente
+from file_util import scrivi_atomico
+from marker_loader import coordinate_marker
+from webmercator import RAGGIO, lonlat_a_webmerc
+
+# === Costanti ===
+# Archivio senza duplicati di deduplica.py: con le cartelle grezze lo stesso autovelox comparirebbe una
+# volta per file che lo ripete (e riempirebbe i k più vicini). Cartelle grezze solo se indicate.
+SORGENTI = [CANONICO]
+INDICE_DIR = os.environ.get("VELOX_INDICE", "indice_cache")  # coordinate di tutte le sorgenti + elenco dei file con mtime e dimensione
+VERSIONE_INDICE = 1
+RAGGIO_TERRA = 6371008.8  # raggio medio, per le distanze sul terreno (haversine)
+RAGGIO_INIZIALE_M = 50  # primo raggio della ricerca dei k più vicini, se il più vicino coincide con la query
+
+
+# === Distanza sul terreno in metri tra coppie di punti lon/lat (gradi), vettoriale ===
+def distanza_m(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=float)) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAGGIO_TERRA * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# === Soglia in metri EPSG:3857 che contiene tutti i punti entro raggio_m sul terreno ===
+# Un metro sul terreno vale RAGGIO/RAGGIO_TERRA/cos(latitudine) metri in EPSG:3857 (la sfera
+# della proiezione è più grande di quella delle distanze): si usa la latitudine più vicina al
+# polo raggiungibile entro il raggio, poi le distanze vere filtrano i candidati.
+def _soglia_webmerc(latitudine, raggio_m):
+    estrema = np.minimum(np.abs(np.radians(latitudine)) + np.asarray(raggio_m) / RAGGIO_TERRA, np.radians(89))
+    return np.asarray(raggio_m) * (RAGGIO / RAGGIO_TERRA) / np.cos(estrema)
+
+
+# === Rango di ogni elemento nel suo gruppo (gruppi contigui, ordine già stabilito) ===
+def _rango(gruppi):
+    if not len(gruppi):
+        return np.empty(0, np.int64)
+    inizio = np.r_[True, gruppi[1:] != gruppi[:-1]]
+    primo = np.maximum.accumulate(np.where(inizio, np.arange(len(gruppi)), 0))
+    return np.arange(len(gruppi)) - primo
+
+
+# === Indice spaziale dei marker: STRtree sui punti EPSG:3857 di tutte le sorgenti ===
+# Le coordinate lon/lat di tutti i file stanno in INDICE_DIR con mtime e dimensione di ogni
+# file: aggiorna() rilegge (tramite la cache di marker_loader) solo i file cambiati o nuovi,
+# copia gli altri dall'indice precedente e ricostruisce l'albero, che in memoria costa meno
+# della rilettura. Tutte le query sono vettoriali su migliaia di punti per chiamata e
+# restituiscono distanze vere sul terreno (haversine): l'albero fornisce i candidati.
+class IndiceMarker:
+    def __init__(self, sorgenti=SORGENTI, cartella=INDICE_DIR):
+        self.sorgenti = list(sorgenti)
+        self.cartella = cartella
+        self.file = []  # [{"percorso", "mtime_ns", "size", "inizio", "numero"}]
+        self.longitudine = self.latitudine = np.empty(0)
+        self._punti = np.empty(0, dtype=object)
+        self._albero = shapely.STRtree(self._punti)
+        self.aggiorna()
+
+    def __len__(self):
+        return len(self.longitudine)
+
+    def _percorsi(self):
+        return os.path.join(self.cartella, "coordinate.npy"), os.path.join(self.cartella, "indice.json")
+
+    def _leggi_salvato(self):
+        percorso_coordinate, percorso_meta = self._percorsi()
+        try:
+            with open(percorso_meta, encoding="utf-8") as fh:
+                meta = json.load(fh)
+            coordinate = np.load(percorso_coordinate, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return [], np.empty((0, 2))
+        if meta.get("versione") != VERSIONE_INDICE or meta.get("marker") != len(coordinate):
+            return [], np.empty((0, 2))
+        return meta["file"], coordinate
+
+    # === Allinea l'indice ai file delle sorgenti; True se qualcosa è cambiato ===
+    def aggiorna(self):
+        inizio = time.perf_counter()
+        salvati, coordinate_salvate = self._leggi_salvato() if not self.file else (self.file, None)
+        precedenti = {voce["percorso"]: voce for voce in salvati}
+        if coordinate_salvate is None:
+            coordinate_salvate = np.column_stack([self.longitudine, self.latitudine])
+
+        percorsi = file_sorgente(self.sorgenti)
+        if not percorsi:
+            suggerimento = " (creare l'archivio con: python deduplica.py)" if CANONICO in self.sorgenti else ""
+            raise FileNotFoundError(f"nessun file marker in {', '.join(self.sorgenti)}{suggerimento}")
+        file, blocchi, riletti, offset = [], [], 0, 0
+        for percorso in percorsi:
+            info = os.stat(percorso)
+            voce = precedenti.get(percorso)
+            if voce is not None and voce["mtime_ns"] == info.st_mtime_ns and voce["size"] == info.st_size:
+                coordinate = coordinate_salvate[voce["inizio"]:voce["inizio"] + voce["numero"]]
+            else:
+                try:
+                    coordinate = coordinate_marker(percorso)
+                except (ValueError, OSError) as errore:
+                    print(f"  [!] File marker non valido {percorso}: {errore}")
+                    continue
+                riletti += 1
+            file.append({"percorso": percorso, "mtime_ns": info.st_mtime_ns, "size": info.st_size,
+                         "inizio": offset, "numero": len(coordinate)})
+            blocchi.append(np.asarray(coordinate, dtype=float).reshape(-1, 2))
+            offset += len(coordinate)
+
+        cambiato = riletti > 0 or [v["percorso"] for v in file] != [v["percorso"] for v in salvati]
+        coordinate = np.concatenate(blocchi) if blocchi else np.empty((0, 2))
+        if cambiato:
+            os.makedirs(self.cartella, exist_ok=True)
+            percorso_coordinate, percorso_meta = self._percorsi()
+            scrivi_atomico(percorso_coordinate, lambda fh: np.save(fh, coordinate))
+            contenuto = json.dumps({"versione": VERSIONE_INDICE, "marker": len(coordinate), "file": file}).encode("utf-8")
+            scrivi_atomico(percorso_meta, lambda fh: fh.write(contenuto))
+
+        if cambiato or not len(self._punti) and len(coordinate):
+            self.file = file
+            self.longitudine = np.ascontiguousarray(coordinate[:, 0])
+            self.latitudine = np.ascontiguousarray(coordinate[:, 1])
+            self._punti = shapely.points(*lonlat_a_webmerc(self.longitudine, self.latitudine))
+            self._albero = shapely.STRtree(self._punti)
+            print(f"[i] Indice marker: {len(coordinate)} marker da {len(file)} file ({riletti} riletti) "
+                  f"in {time.perf_counter() - inizio:.2f}s")
+        return cambiato
+
+    # === File di origine di ogni marker (indici dell'indice) ===
+    def fonte(self, indici):
+        inizi = np.array([voce["inizio"] for voce in self.file], dtype=np.int64)
+        percorsi = np.array([voce["percorso"] for voce in self.file], dtype=object)
+        return percorsi[np.searchsorted(inizi, np.asarray(indici), side="right") - 1]
+
+    # === Marker entro raggio_m (scalare o uno per punto) da ogni punto lon/lat ===
+    # Restituisce (indice del punto, indice del marker, distanza in metri), ordinati per
+    # punto e distanza.
+    def entro(self, longitudine, latitudine, raggio_m):
+        longitudine = np.atleast_1d(np.asarray(longitudine, dtype=float))
+        latitudine = np.atleast_1d(np.asarray(latitudine, dtype=float))
+        raggio_m = np.broadcast_to(np.asarray(raggio_m, dtype=float), longitudine.shape)
+        x, y = lonlat_a_webmerc(longitudine, latitudine)
+        punti, marker = self._albero.query(shapely.points(x, y), predicate="dwithin",
+                                           distance=_soglia_webmerc(latitudine, raggio_m))
+        distanze = distanza_m(longitudine[punti], latitudine[punti], self.longitudine[marker], self.latitudine[marker])
+        dentro = distanze <= raggio_m[punti]
+        punti, marker, distanze = punti[dentro], marker[dentro], distanze[dentro]
+        ordine = np.lexsort((marker, distanze, punti))
+        return punti[ordine], marker[ordine], distanze[ordine]
+
+    # === I k marker più vicini a ogni punto: (indici, distanze) di forma (punti, k) ===
+    # Ricerca per raggio che raddoppia, partendo dalla distanza del più vicino: il risultato
+    # è esatto perché i k scelti sono i più vicini tra tutti i marker entro il raggio.
+    # Posizioni vuote (meno di k marker entro max_distanza_m, punto NaN): indice -1, distanza inf.
+    def piu_vicini(self, longitudine, latitudine, k=1, max_distanza_m=None):
+        longitudine = np.atleast_1d(np.asarray(longitudine, dtype=float))
+        latitudine = np.atleast_1d(np.asarray(latitudine, dtype=float))
+        indici = np.full((len(longitudine), k), -1, dtype=np.int64)
+        distanze = np.full((len(longitudine), k), np.inf)
+        if not len(self) or not len(longitudine):
+            return indici, distanze
+
+        x, y = lonlat_a_webmerc(longitudine, latitudine)
+        punti, marker = self._albero.query_nearest(shapely.points(x, y), all_matches=False)
+        finiti = np.isfinite(longitudine[punti]) & np.isfinite(latitudine[punti])
+        punti, marker = punti[finiti], marker[finiti]
+        raggio = np.full(len(longitudine), np.nan)  # resta NaN per i punti non finiti: nessuna ricerca
+        raggio[punti] = distanza_m(longitudine[punti], latitudine[punti], self.longitudine[marker],
+                                   self.latitudine[marker])
+        raggio = np.maximum(raggio * 1.01, RAGGIO_INIZIALE_M) * np.sqrt(k)
+        if max_distanza_m is not None:
+            raggio = np.minimum(raggio, max_distanza_m)
+        necessari = min(k, len(self))
+
+        attivi = np.flatnonzero(np.isfinite(raggio))
+        while len(attivi):
+            punti, marker, distanza = self.entro(longitudine[attivi], latitudine[attivi], raggio[attivi])
+            trovati = np.bincount(punti, minlength=len(attivi))
+            completi = (trovati >= necessari) | (raggio[attivi] == max_distanza_m)
+            tenuti = completi[punti] & (_rango(punti) < k)
+            righe = attivi[punti[tenuti]]
+            colonne = _rango(punti[tenuti])
+            indici[righe, colonne] = marker[tenuti]
+            distanze[righe, colonne] = distanza[tenuti]
+
+            attivi = attivi[~completi]
+            raggio[attivi] *= 2
+            if max_distanza_m is not None:
+                raggio[attivi] = np.minimum(raggio[attivi], max_distanza_m)
+            attivi = attivi[np.isfinite(raggio[attivi])]
+        return indici, distanze
+
+    # === Marker entro raggio_m da ogni traccia (array (n, 2) di lon/lat, es. un percorso GPS) ===
+    # Le tracce diventano linee EPSG:3857 interrogate tutte insieme; la distanza di un marker
+    # dalla linea è riportata in metri alla scala della sua latitudine. Restituisce (indice
+    # della traccia, indice del marker, distanza in metri), ordinati per traccia e distanza.
+    def vicino_a_percorso(self, tracce, raggio_m):
+        geometrie, soglie = [], []
+        for traccia in tracce:
+            traccia = np.asarray(traccia, dtype=float).reshape(-1, 2)
+            x, y = lonlat_a_webmerc(traccia[:, 0], traccia[:, 1])
+            geometrie.append(shapely.linestrings(x, y) if len(traccia) > 1 else shapely.points(x[0], y[0]))
+            soglie.append(_soglia_webmerc(np.abs(traccia[:, 1]).max(), raggio_m))
+        geometrie = np.array(geometrie, dtype=object)
+
+        percorsi, marker = self._albero.query(geometrie, predicate="dwithin", distance=np.array(soglie))
+        scala = np.cos(np.radians(self.latitudine[marker])) * (RAGGIO_TERRA / RAGGIO)
+        distanze = shapely.distance(self._punti[marker], geometrie[percorsi]) * scala
+        dentro = distanze <= raggio_m
+        percorsi, marker, distanze = percorsi[dentro], marker[dentro], distanze[dentro]
+        ordine = np.lexsort((marker, distanze, percorsi))
+        return percorsi[ordine], marker[ordine], distanze[ordine]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Marker vicini a punti o a un percorso GPS")
+    parser.add_argument("sorgenti", nargs="*", default=SORGENTI,
+                        help="file o cartelle di marker (predefinito: l'archivio di deduplica.py)")
+    parser.add_argument("--punto", type=float, nargs=2, action="append", metavar=("LON", "LAT"), default=[])
+    parser.add_argument("--percorso", help="CSV/JSON di punti lon/lat (stesse colonne dei file marker)")
+    parser.add_argument("--raggio", type=float, default=200, help="metri")
+    parser.add_argument("-k", type=int, default=1, help="marker più vicini per --punto")
+    parser.add_argument("--cartella", default=INDICE_DIR, help="cartella dell'indice")
+    args = parser.parse_args()
+
+    indice = IndiceMarker(args.sorgenti, args.cartella)
+    if args.punto:
+        longitudine, latitudine = np.array(args.punto).T
+        indici, distanze = indice.piu_vicini(longitudine, latitudine, args.k)
+        for lon, lat, riga_indici, riga_distanze in zip(longitudine, latitudine, indici, distanze):
+            print(f"[=] {lon:.6f}, {lat:.6f}:")
+            for marker, distanza in zip(riga_indici[riga_indici >= 0], riga_distanze[riga_indici >= 0]):
+                print(f"  [i] {indice.latitudine[marker]:.6f}, {indice.longitudine[marker]:.6f} a {distanza:.0f} m "
+                      f"({indice.fonte([marker])[0]})")
+    if args.percorso:
+        traccia = coordinate_marker(args.percorso)
+        _, marker, distanze = indice.vicino_a_percorso([traccia], args.raggio)
+        print(f"[=] {len(marker)} marker entro {args.raggio:.0f} m dal percorso ({len(traccia)} punti)")
+        for indice_marker, distanza in zip(marker, distanze):
+            print(f"  [i] {indice.latitudine[indice_marker]:.6f}, {indice.longitudine[indice_marker]:.6f} "
+                  f"a {distanza:.0f} m ({indice.fonte([indice_marker])[0]})")
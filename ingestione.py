@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from confini import carica_confini
+from file_util import scrivi_atomico
+from marker_loader import (ALIAS_LATITUDINE, ALIAS_LONGITUDINE, colonna_alias, coordinate_valide, nome_file_unita,
+                           valori_numerici)
+from webmercator import lonlat_a_webmerc
+
+# === Costanti ===
+SORGENTE = "dati_marker/nazionale.csv"  # dataset nazionale unico (CSV, JSON o GeoJSON)
+LIVELLI = [
+    # (GeoJSON confini, campo nome, cartella partizioni)
+    ("province.geojson", "prov_name", "dati_marker/province"),
+    ("regioni.geojson", "reg_name", "dati_marker/regioni"),
+]
+RIGHE_BLOCCO = 200_000  # marker letti, validati e assegnati per volta: la memoria non dipende dalla sorgente
+CARATTERI_JSON = 1 << 20  # lettura incrementale dei JSON/GeoJSON
+ELENCO_PARTIZIONI = "partizioni.txt"  # file scritti dall'ultima ingestione, nella cartella del livello
+
+
+# === Indice dell'unità che contiene ogni punto (-1 se fuori da tutte) ===
+# STRtree sui poligoni: una query vettoriale sui bounding box dà le coppie candidate
+# (punto, unità), poi contains_xy sulla geometria preparata le conferma unità per unità.
+# (Una query con predicate="within" sarebbe ~40 volte più lenta sui confini dettagliati.)
+def assegna_unita(x, y, confini):
+    geometrie = np.asarray(confini.geometry.values)
+    shapely.prepare(geometrie)
+    albero = shapely.STRtree(geometrie)
+    indici_punto, indici_unita = albero.query(shapely.points(x, y))
+
+    ordine = np.argsort(indici_unita, kind="stable")
+    indici_punto, indici_unita = indici_punto[ordine], indici_unita[ordine]
+    unita, inizi = np.unique(indici_unita, return_index=True)
+    fini = np.r_[inizi[1:], len(indici_unita)]
+
+    # In ordine inverso: un punto esattamente su un confine condiviso va alla prima unità
+    assegnazione = np.full(len(x), -1, dtype=np.int64)
+    for indice_unita, inizio, fine in reversed(list(zip(unita, inizi, fini))):
+        candidati = indici_punto[inizio:fine]
+        dentro = shapely.contains_xy(geometrie[indice_unita], x[candidati], y[candidati])
+        assegnazione[candidati[dentro]] = indice_unita
+    return assegnazione
+
+
+# === Lettore JSON incrementale: un valore alla volta da un file di testo ===
+# json.JSONDecoder.raw_decode sul buffer, che si allunga solo quando il valore è incompleto:
+# in memoria restano un blocco di CARATTERI_JSON e il valore corrente, non l'intero file.
+class _LettoreJson:
+    def __init__(self, fh, caratteri=CARATTERI_JSON):
+        self.fh = fh
+        self.caratteri = caratteri
+        self.buffer = ""
+        self.pos = 0
+        self.fine_file = False
+        self.decoder = json.JSONDecoder()
+
+    def _riempi(self):
+        dati = self.fh.read(self.caratteri)
+        if not dati:
+            self.fine_file = True
+        self.buffer = self.buffer[self.pos:] + dati
+        self.pos = 0
+
+    # Prossimo carattere significativo, senza consumarlo ("" a fine file)
+    def carattere(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.fine_file:
+                return self.buffer[self.pos:self.pos + 1]
+            self._riempi()
+
+    def consuma(self, attesi):
+        carattere = self.carattere()
+        if not carattere or carattere not in attesi:
+            raise ValueError(f"JSON non valido: atteso {attesi!r}, trovato {carattere or 'fine file'!r}")
+        self.pos += 1
+        return carattere
+
+    def valore(self):
+        self.carattere()
+        while True:
+            try:
+                valore, fine = self.decoder.raw_decode(self.buffer, self.pos)
+                # Un numero a fine buffer potrebbe continuare nel blocco successivo
+                if fine < len(self.buffer) or self.fine_file:
+                    self.pos = fine
+                    return valore
+            except json.JSONDecodeError as errore:
+                if self.fine_file:
+                    raise ValueError(f"JSON non valido: {errore}") from None
+            self._riempi()
+
+    def elementi_array(self):
+        self.consuma("[")
+        if self.carattere() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.valore()
+            if self.consuma(",]") == "]":
+                return
+
+
+# === Elementi di un JSON (array di record) o GeoJSON (features di una FeatureCollection) ===
+def elementi_json(fh):
+    lettore = _LettoreJson(fh)
+    if lettore.carattere() == "[":
+        yield from lettore.elementi_array()
+        return
+
+    lettore.consuma("{")
+    if lettore.carattere() == "}":
+        return
+    while True:
+        chiave = lettore.valore()
+        lettore.consuma(":")
+        if chiave == "features" and lettore.carattere() == "[":
+            yield from lettore.elementi_array()
+        else:
+            lettore.valore()  # type, name, crs, ...
+        if lettore.consuma(",}") == "}":
+            return
+
+
+# === Coordinate (longitude, latitude) di un blocco di elementi JSON ===
+# Feature GeoJSON: geometria Point (null = coordinate mancanti); altrimenti record con
+# colonne latitude/longitude (o alias), come in marker_loader.
+def _coordinate_elementi(elementi):
+    if elementi and isinstance(elementi[0], dict) and "geometry" in elementi[0]:
+        coordinate = np.full((len(elementi), 2), np.nan)
+        for i, elemento in enumerate(elementi):
+            geometria = elemento.get("geometry")
+            if geometria is None:
+                continue
+            if geometria.get("type") != "Point":
+                raise ValueError("geometrie non puntuali nel file")
+            coordinate[i] = geometria["coordinates"][:2]
+        return coordinate[:, 0], coordinate[:, 1]
+
+    df = pd.DataFrame.from_records(elementi)
+    latitudine = colonna_alias(df, ALIAS_LATITUDINE)
+    longitudine = colonna_alias(df, ALIAS_LONGITUDINE)
+    if latitudine is None or longitudine is None:
+        raise ValueError("colonne 'latitude' o 'longitude' mancanti")
+    return valori_numerici(longitudine), valori_numerici(latitudine)
+
+
+# === Sorgente letta a blocchi di (longitude, latitude), senza caricarla tutta in memoria ===
+def blocchi_coordinate(percorso, righe=RIGHE_BLOCCO):
+    if os.path.splitext(percorso)[1].lower() == ".csv":
+        intestazione = pd.read_csv(percorso, nrows=0, skipinitialspace=True, encoding="utf-8-sig")
+        latitudine = colonna_alias(intestazione, ALIAS_LATITUDINE)
+        longitudine = colonna_alias(intestazione, ALIAS_LONGITUDINE)
+        if latitudine is None or longitudine is None:
+            raise ValueError("colonne 'latitude' o 'longitude' mancanti")
+        colonne = [latitudine.name, longitudine.name]
+        with pd.read_csv(percorso, usecols=colonne, chunksize=righe, skipinitialspace=True,
+                         encoding="utf-8-sig") as lettore:
+            for blocco in lettore:
+                yield valori_numerici(blocco[colonne[1]]), valori_numerici(blocco[colonne[0]])
+        return
+
+    with open(percorso, encoding="utf-8-sig") as fh:
+        elementi = []
+        for elemento in elementi_json(fh):
+            elementi.append(elemento)
+            if len(elementi) == righe:
+                yield _coordinate_elementi(elementi)
+                elementi = []
+        if elementi:
+            yield _coordinate_elementi(elementi)
+
+
+# === Partizioni di un livello: un CSV latitude,longitude per unità, leggibile da marker_loader.carica_marker ===
+# I blocchi sono accodati a file temporanei (un file aperto per unità); conferma() li
+# sostituisce alle partizioni di un'ingestione precedente solo a lettura completata.
+# Si eliminano solo i file elencati in ELENCO_PARTIZIONI dall'ingestione precedente: una
+# cartella con altri file (es. dati_marker, mantenuta a mano) viene rifiutata subito.
+class _Partizioni:
+    def __init__(self, cartella, nomi):
+        os.makedirs(cartella, exist_ok=True)
+        self.cartella = cartella
+        self.nomi = nomi
+        self.file = {}
+        self.precedenti = self._leggi_elenco()
+
+    def _leggi_elenco(self):
+        try:
+            with open(os.path.join(self.cartella, ELENCO_PARTIZIONI), encoding="utf-8") as fh:
+                return {riga.strip() for riga in fh if riga.strip()}
+        except FileNotFoundError:
+            pass
+        estranei = sorted(voce.name for voce in os.scandir(self.cartella) if not voce.name.endswith(".tmp"))
+        if estranei:
+            raise ValueError(f"{self.cartella} non è una cartella di partizioni di ingestione.py (contiene "
+                             f"{', '.join(estranei[:3])}{', ...' if len(estranei) > 3 else ''}): "
+                             f"indicare una cartella vuota o dedicata")
+        return set()
+
+    def _percorso(self, indice_unita):
+        return os.path.join(self.cartella, f"{nome_file_unita(self.nomi[indice_unita])}.csv")
+
+    def aggiungi(self, longitudine, latitudine, assegnazione):
+        ordine = np.argsort(assegnazione, kind="stable")
+        ordinati = assegnazione[ordine]
+        unita, inizi = np.unique(ordinati, return_index=True)
+        fini = np.r_[inizi[1:], len(ordinati)]
+
+        for indice_unita, inizio, fine in zip(unita, inizi, fini):
+            if indice_unita < 0:
+                continue
+            fh = self.file.get(indice_unita)
+            if fh is None:
+                fh = open(self._percorso(indice_unita) + ".tmp", "w", encoding="utf-8", newline="")
+                fh.write("latitude,longitude\n")
+                self.file[indice_unita] = fh
+            righe = ordine[inizio:fine]
+            np.savetxt(fh, np.column_stack([latitudine[righe], longitudine[righe]]), fmt="%.6f", delimiter=",")
+
+    def _chiudi(self):
+        for fh in self.file.values():
+            fh.close()
+
+    def conferma(self):
+        self._chiudi()
+        nuovi = sorted(os.path.basename(self._percorso(indice)) for indice in self.file)
+        for nome in self.precedenti.difference(nuovi):
+            try:
+                os.remove(os.path.join(self.cartella, nome))  # partizione di un'ingestione precedente
+            except FileNotFoundError:
+                pass
+        for indice in self.file:
+            os.replace(self._percorso(indice) + ".tmp", self._percorso(indice))
+        contenuto = "".join(f"{nome}\n" for nome in nuovi).encode("utf-8")
+        scrivi_atomico(os.path.join(self.cartella, ELENCO_PARTIZIONI), lambda fh: fh.write(contenuto))
+        self.precedenti = set(nuovi)
+        return len(self.file)
+
+    def annulla(self):
+        self._chiudi()
+        for indice in self.file:
+            os.remove(self._percorso(indice) + ".tmp")
+
+
+# === Ingestione: dataset nazionale -> partizioni per provincia e per regione ===
+# La sorgente è letta una volta, a blocchi di righe: ogni blocco è validato, proiettato
+# in EPSG:3857 e accodato alle partizioni di tutti i livelli.
+def ingerisci(sorgente=SORGENTE, livelli=LIVELLI, righe=RIGHE_BLOCCO):
+    inizio = time.perf_counter()
+    attivi = []
+    for geojson_path, campo_nome, cartella in livelli:
+        if not os.path.exists(geojson_path):
+            print(f"  [!] Confini non trovati: {geojson_path}, salto...")
+            continue
+        confini = carica_confini(geojson_path)
+        attivi.append({"confini": confini, "cartella": cartella, "assegnati": 0, "tempo": 0.0,
+                       "partizioni": _Partizioni(cartella, confini[campo_nome].tolist())})
+
+    letti = scartati = blocchi = 0
+    try:
+        for longitudine, latitudine in blocchi_coordinate(sorgente, righe):
+            validi = coordinate_valide(longitudine, latitudine)
+            letti += len(validi)
+            scartati += int((~validi).sum())
+            blocchi += 1
+            longitudine, latitudine = longitudine[validi], latitudine[validi]
+            x, y = lonlat_a_webmerc(longitudine, latitudine)
+
+            for livello in attivi:
+                inizio_livello = time.perf_counter()
+                assegnazione = assegna_unita(x, y, livello["confini"])
+                livello["partizioni"].aggiungi(longitudine, latitudine, assegnazione)
+                livello["assegnati"] += int((assegnazione >= 0).sum())
+                livello["tempo"] += time.perf_counter() - inizio_livello
+    except BaseException:
+        for livello in attivi:
+            livello["partizioni"].annulla()  # le partizioni precedenti restano intatte
+        raise
+
+    print(f"[i] {letti} marker letti da {sorgente} in {blocchi} blocchi ({time.perf_counter() - inizio:.1f}s)")
+    if scartati:
+        print(f"  [!] {os.path.basename(sorgente)}: scartati {scartati} marker con coordinate non valide")
+    for livello in attivi:
+        scritte = livello["partizioni"].conferma()
+        fuori = letti - scartati - livello["assegnati"]
+        print(f"  [+] {livello['cartella']}: {scritte} partizioni, {livello['assegnati']} marker assegnati, "
+              f"{fuori} fuori dai confini ({livello['tempo']:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assegna i marker di un dataset nazionale a province e regioni")
+    parser.add_argument("sorgente", nargs="?", default=SORGENTE)
+    parser.add_argument("--righe", type=int, default=RIGHE_BLOCCO, help="marker per blocco")
+    args = parser.parse_args()
+    ingerisci(args.sorgente, righe=args.righe)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import time
+
+import shapely
+
+from file_util import impronta_file, scrivi_atomico
+from strumentazione import fase
+
+# === Costanti ===
+MANIFEST_NAME = "manifest.json"  # uno per cartella di output, accanto ai PNG
+VERSIONE_RENDER = 1  # da incrementare quando cambia il disegno nei moduli condivisi: invalida tutto
+# Con VELOX_SHARD=i/N (shard.py) ogni shard registra i suoi esiti in un manifest proprio, letto insieme
+# a quello comune: shard che scrivono nella stessa cartella non si sovrascrivono, shard.unisci() li riunisce
+MANIFEST_SHARD = ("manifest.shard-" + os.environ["VELOX_SHARD"].replace("/", "-di-") + ".json"
+                  if os.environ.get("VELOX_SHARD") else None)
+
+# Impronte già calcolate in questo processo: (percorso, mtime_ns, size) -> sha1
+_impronte_file = {}
+# Manifest letti in questo processo (i worker li leggono soltanto)
+_manifest_letti = {}
+
+
+def impronta_file_cached(percorso):
+    info = os.stat(percorso)
+    chiave = (os.path.abspath(percorso), info.st_mtime_ns, info.st_size)
+    if chiave not in _impronte_file:
+        _impronte_file[chiave] = impronta_file(percorso)
+    return _impronte_file[chiave]
+
+
+def _sorgente_tile(sorgente):
+    if isinstance(sorgente, str):
+        return sorgente
+    return f"{sorgente.get('name')}|{sorgente.get('url')}"
+
+
+# === Impronta degli input di un render ===
+# file_marker: file dei marker; confine: geometria shapely; impostazioni: dict di
+# parametri (ZOOM_MODE, dpi, zoom marker, TRIM_IMAGE, margini, ...); file_extra: file il
+# cui contenuto conta (icona marker, sorgente dello script che disegna).
+# Restituisce None se manca il file dei marker: l'unità non è mai considerata invariata.
+@fase("impronta")
+def impronta_render(file_marker, confine, impostazioni, sorgente_tile, file_extra=()):
+    if file_marker is None:
+        return None
+    sha1 = hashlib.sha1(f"v{VERSIONE_RENDER}".encode("ascii"))
+    sha1.update(impronta_file_cached(file_marker).encode("ascii"))
+    sha1.update(shapely.to_wkb(confine))
+    sha1.update(json.dumps(impostazioni, sort_keys=True, default=str).encode("utf-8"))
+    sha1.update(_sorgente_tile(sorgente_tile).encode("utf-8"))
+    for percorso in file_extra:
+        sha1.update(impronta_file_cached(percorso).encode("ascii"))
+    return sha1.hexdigest()
+
+
+def percorso_manifest(output_path, nome=MANIFEST_NAME):
+    return os.path.join(os.path.dirname(output_path) or ".", nome)
+
+
+def _leggi(percorso):
+    try:
+        with open(percorso, encoding="utf-8") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _come_lista(output):
+    return list(output) if isinstance(output, (list, tuple)) else [output]
+
+
+# === True se l'output (o tutti gli output di un job) esiste ed è stato prodotto dagli stessi input ===
+def invariato(output_path, impronta):
+    if impronta is None:
+        return False
+    if isinstance(output_path, (list, tuple)):
+        return all(invariato(percorso, impronta) for percorso in output_path)
+    for nome in filter(None, (MANIFEST_SHARD, MANIFEST_NAME)):
+        percorso = percorso_manifest(output_path, nome)
+        if percorso not in _manifest_letti:
+            _manifest_letti[percorso] = _leggi(percorso)
+        voce = _manifest_letti[percorso].get(os.path.basename(output_path))
+        if voce is not None and voce.get("impronta") == impronta:
+            return os.path.exists(output_path)
+    return False
+
+
+# === Aggiorna i manifest con gli esiti del batch (solo nel processo principale) ===
+def registra_esiti(esiti):
+    per_manifest = {}
+    nome = MANIFEST_SHARD or MANIFEST_NAME
+    for esito in esiti:
+        if esito.impronta and esito.stato in ("ok", "invariata"):
+            for output in _come_lista(esito.output):
+                per_manifest.setdefault(percorso_manifest(output, nome), []).append((output, esito))
+
+    adesso = time.strftime("%Y-%m-%dT%H:%M:%S")
+    for percorso, gruppo in per_manifest.items():
+        manifest = _leggi(percorso)
+        for output, esito in gruppo:
+            voce = manifest.get(os.path.basename(output), {})
+            if esito.stato == "ok" or voce.get("impronta") != esito.impronta:
+                voce = {"impronta": esito.impronta, "aggiornato": adesso}
+            manifest[os.path.basename(output)] = voce
+
+        contenuto = json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        scrivi_atomico(percorso, lambda fh: fh.write(contenuto))
+        _manifest_letti[percorso] = manifest
@@ -0,0 +1,206 @@
+import os
+
+import numpy as np
+from matplotlib.artist import Artist
+from matplotlib.text import Text
+from matplotlib.transforms import Bbox, IdentityTransform
+from PIL import Image
+
+from cluster import DIMENSIONE_CONTEGGIO, raggruppa
+from strumentazione import conta, fase
+
+# Pixel dell'icona elaborati per blocco: limita la memoria con centinaia di migliaia di marker
+PIXEL_PER_BLOCCO = 4_000_000
+
+
+# === Artist unico per tutti i marker: l'icona viene composta in un solo livello RGBA ===
+# Stesso aspetto di un AnnotationBbox(OffsetImage(icona, zoom=zoom), box_alignment=...) per
+# punto: dimensione icona = pixel originali * zoom * dpi/72, ancoraggio su box_alignment,
+# disegnati solo i marker il cui punto cade dentro gli assi.
+# raggio_cluster (punti tipografici): se indicato, i marker visibili più vicini di così nei
+# pixel dell'immagine salvata (zoom della mappa e dpi effettivi) diventano un'icona sola nel
+# loro baricentro, con il numero dei marker (cluster.raggruppa).
+class MarkerBatch(Artist):
+    def __init__(self, x, y, icona, zoom=0.015, box_alignment=(0.5, 0), zorder=10, raggio_cluster=None):
+        super().__init__()
+        self._xy = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        self._icona = icona
+        self.zoom = zoom
+        self.box_alignment = box_alignment
+        self.raggio_cluster = raggio_cluster
+        self.set_zorder(zorder)
+        self._icone_scalate = {}
+
+    # Icona ridimensionata per il dpi corrente, premoltiplicata e con le righe dal basso verso l'alto
+    def _icona_pixel(self, renderer):
+        scala = self.zoom * renderer.points_to_pixels(1.0)
+        altezza, larghezza = self._icona.shape[:2]
+        dimensione = (max(1, round(larghezza * scala)), max(1, round(altezza * scala)))
+        if dimensione not in self._icone_scalate:
+            scalata = Image.fromarray(self._icona).convert("RGBa").resize(dimensione, Image.LANCZOS)
+            self._icone_scalate[dimensione] = np.ascontiguousarray(np.asarray(scalata)[::-1])
+        return self._icone_scalate[dimensione]
+
+    # Angolo in basso a sinistra (pixel display, interi) delle icone dei marker visibili (o
+    # dei cluster) e numero di marker di ogni icona (None senza cluster). Trasformazione e
+    # riquadro di ritaglio sono quelli che ax.add_artist imposta (transData, bbox degli assi):
+    # sfondi.py li imposta direttamente per disegnare i marker senza assi.
+    def _angoli(self, renderer, altezza, larghezza):
+        punti = self.get_transform().transform(self._xy)
+        riquadro = self.get_clip_box() or self.axes.bbox
+        visibili = (np.isfinite(punti).all(axis=1)
+                    & (punti[:, 0] >= riquadro.x0) & (punti[:, 0] <= riquadro.x1)
+                    & (punti[:, 1] >= riquadro.y0) & (punti[:, 1] <= riquadro.y1))
+        punti = punti[visibili]
+        conteggi = None
+        if self.raggio_cluster:
+            gx, gy, conteggi, _ = raggruppa(punti[:, 0], punti[:, 1],
+                                            renderer.points_to_pixels(self.raggio_cluster))
+            punti = np.column_stack([gx, gy])
+        sinistra = np.round(punti[:, 0] - self.box_alignment[0] * larghezza).astype(np.int64)
+        basso = np.round(punti[:, 1] - self.box_alignment[1] * altezza).astype(np.int64)
+        return sinistra, basso, conteggi
+
+    def get_window_extent(self, renderer=None):
+        if renderer is None:
+            renderer = self.get_figure(root=True)._get_renderer()
+        altezza, larghezza = self._icona_pixel(renderer).shape[:2]
+        sinistra, basso, _ = self._angoli(renderer, altezza, larghezza)
+        if not len(sinistra):
+            return Bbox.null()
+        return Bbox([[sinistra.min(), basso.min()], [sinistra.max() + larghezza, basso.max() + altezza]])
+
+    @fase("disegno_marker")
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+        icona = self._icona_pixel(renderer)
+        altezza, larghezza = icona.shape[:2]
+        sinistra, basso, conteggi = self._angoli(renderer, altezza, larghezza)
+        if not len(sinistra):
+            return
+
+        x0, y0 = sinistra.min(), basso.min()
+        livello = componi_icone(icona, sinistra - x0, basso - y0, basso.max() + altezza - y0,
+                                sinistra.max() + larghezza - x0)
+
+        # draw_image vuole RGBA "straight" con la prima riga in basso
+        immagine = da_premoltiplicato(livello)
+
+        gc = renderer.new_gc()
+        self._set_gc_clip(gc)
+        gc.set_alpha(self.get_alpha())
+        renderer.draw_image(gc, x0, y0, immagine)
+        gc.restore()
+        if conteggi is not None:
+            self._disegna_conteggi(renderer, sinistra, basso, altezza, larghezza, conteggi)
+        self.stale = False
+
+    # Numero di marker sull'angolo in alto a destra delle icone dei cluster
+    def _disegna_conteggi(self, renderer, sinistra, basso, altezza, larghezza, conteggi):
+        multipli = np.flatnonzero(conteggi > 1)
+        conta("cluster", len(multipli))
+        dimensione = altezza * DIMENSIONE_CONTEGGIO / renderer.points_to_pixels(1.0)
+        # Un solo Text riposizionato: crearne uno per cluster costerebbe più del disegno
+        testo = Text(transform=IdentityTransform(), ha="center", va="center", fontsize=dimensione,
+                     fontweight="bold", color="white",
+                     bbox=dict(boxstyle="round,pad=0.25", fc="#c62828", ec="white", lw=dimensione / 10))
+        testo.set_figure(self.get_figure(root=True))
+        testo.set_clip_box(self.get_clip_box())
+        testo.set_clip_path(self.get_clip_path())
+        for i in multipli:
+            testo.set_position((sinistra[i] + 0.85 * larghezza, basso[i] + 0.85 * altezza))
+            testo.set_text(str(conteggi[i]))
+            testo.draw(renderer)
+
+
+# === Livello RGBA premoltiplicato (uint8) con l'icona composta in ogni posizione ===
+# icona: RGBA premoltiplicato; colonne/righe: angolo dell'icona nel livello, dentro i suoi
+# limiti. Le righe possono crescere verso il basso o verso l'alto: l'icona va orientata allo
+# stesso modo. Le icone si sovrappongono con l'operatore "over" nell'ordine di input.
+def componi_icone(icona, colonne, righe, altezza_livello, larghezza_livello):
+    altezza, larghezza = icona.shape[:2]
+    livello = np.zeros(altezza_livello * larghezza_livello, dtype=np.uint32)  # un uint32 per pixel
+    if not len(colonne):
+        return livello.view(np.uint8).reshape(altezza_livello, larghezza_livello, 4)
+    origini = righe * larghezza_livello + colonne
+
+    # Pixel dell'icona: opachi (basta assegnarli) e semitrasparenti (serve l'operatore "over")
+    righe_icona, colonne_icona = np.nonzero(icona[:, :, 3] > 0)
+    colori = icona[righe_icona, colonne_icona]
+    opachi = colori[:, 3] >= 255
+    offset_opachi = righe_icona[opachi] * larghezza_livello + colonne_icona[opachi]
+    offset_bordo = righe_icona[~opachi] * larghezza_livello + colonne_icona[~opachi]
+    colori_opachi = colori[opachi].view(np.uint32).ravel()
+    colori_bordo = colori[~opachi].astype(np.float32)
+    trasparenza_bordo = 1.0 - colori_bordo[:, 3:4] / 255.0
+
+    passo = max(1, PIXEL_PER_BLOCCO // len(colori))
+    for gruppo in _gruppi_senza_sovrapposizioni(colonne, righe, altezza, larghezza):
+        for inizio in range(0, len(gruppo), passo):
+            blocco = origini[gruppo[inizio:inizio + passo], None]
+            # Nel gruppo le icone non si sovrappongono: nessun pixel è scritto due volte
+            indici = blocco + offset_bordo[None, :]
+            sotto = livello[indici].view(np.uint8).reshape(*indici.shape, 4)
+            sopra = colori_bordo + sotto * trasparenza_bordo
+            livello[indici] = (sopra + 0.5).astype(np.uint8).view(np.uint32)[..., 0]
+            livello[blocco + offset_opachi[None, :]] = colori_opachi
+    return livello.view(np.uint8).reshape(altezza_livello, larghezza_livello, 4)
+
+
+# === Da RGBA premoltiplicato a RGBA "straight" ===
+# Cambiano solo i pixel semitrasparenti: quelli opachi o vuoti restano uguali.
+def da_premoltiplicato(livello):
+    immagine = livello.copy()
+    righe, colonne = np.nonzero((immagine[:, :, 3] > 0) & (immagine[:, :, 3] < 255))
+    pixel = immagine[righe, colonne].astype(np.float32)
+    colore = pixel[:, :3] * 255.0 / pixel[:, 3:4]
+    immagine[righe, colonne, :3] = np.clip(colore + 0.5, 0, 255).astype(np.uint8)
+    return immagine
+
+
+# === Suddivide i marker (in ordine di input) in gruppi di icone che non si sovrappongono ===
+# Griglia con celle grandi quanto l'icona: due icone in celle della stessa parità (x%2, y%2)
+# e distinte non possono toccarsi; marker nella stessa cella vanno in gruppi successivi
+# secondo l'ordine di input. Tra celle vicine l'ordine di sovrapposizione può quindi
+# differire da quello di input, l'aspetto del singolo marker no.
+def _gruppi_senza_sovrapposizioni(colonne, righe, altezza, larghezza):
+    cella_x = colonne // larghezza
+    cella_y = righe // altezza
+    chiave_cella = cella_y * (cella_x.max() + 1) + cella_x
+
+    ordine = np.argsort(chiave_cella, kind="stable")
+    chiavi_ordinate = chiave_cella[ordine]
+    inizio_cella = np.r_[True, chiavi_ordinate[1:] != chiavi_ordinate[:-1]]
+    primo_indice = np.maximum.accumulate(np.where(inizio_cella, np.arange(len(ordine)), 0))
+    rango = np.empty_like(ordine)
+    rango[ordine] = np.arange(len(ordine)) - primo_indice
+
+    gruppo = rango * 4 + (cella_x % 2) * 2 + (cella_y % 2)
+    ordine_gruppi = np.argsort(gruppo, kind="stable")
+    confini = np.flatnonzero(np.diff(gruppo[ordine_gruppi])) + 1
+    return np.split(ordine_gruppi, confini)
+
+
+_icone = {}
+
+
+def carica_icona(image_path):
+    if image_path not in _icone:
+        with Image.open(image_path) as immagine:
+            _icone[image_path] = np.asarray(immagine.convert("RGBA"))
+    return _icone[image_path]
+
+
+# === Funzione per visualizzare marker personalizzati (un solo artist per tutti i punti) ===
+# raggio_cluster: vedi MarkerBatch (None = un'icona per marker)
+@fase("marker_artist")
+def imscatter(x, y, ax, zoom=0.015, image_path="autovelox-icon.png", zorder=10, raggio_cluster=None):
+    if not os.path.exists(image_path):
+        print(f"[!] Icona marker non trovata: {image_path}")
+        return None
+
+    artist = MarkerBatch(x, y, carica_icona(image_path), zoom=zoom, box_alignment=(0.5, 0), zorder=zorder,
+                         raggio_cluster=raggio_cluster)
+    ax.add_artist(artist)
+    return artist
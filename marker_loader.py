@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import unicodedata
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from file_util import impronta_file, scrivi_atomico
+from strumentazione import conta, fase
+
+# === Costanti ===
+DATA_FOLDER = "dati_marker"
+MARKER_CACHE = "marker_cache"
+ESTENSIONI = (".csv", ".json", ".geojson")  # in ordine di priorità, come negli script originali
+ALIAS_LATITUDINE = ("latitude", "lat")
+ALIAS_LONGITUDINE = ("longitude", "lon", "lng", "long")
+
+
+# === Nome normalizzato per confronti: minuscolo, NFC, apostrofo tipografico -> ' ===
+def normalizza_nome(nome):
+    nome = unicodedata.normalize("NFC", nome).replace("’", "'")
+    return " ".join(nome.lower().split())
+
+
+# === Nome del file di un'unità (es. "Bolzano/Bozen" -> "Bolzano-Bozen") ===
+def nome_file_unita(nome):
+    return nome.replace("/", "-").replace("\\", "-").strip()
+
+
+# === File marker di un'unità, cercato senza distinzione di maiuscole ===
+# ("barletta-andria-trani" trova "Barletta-Andria-Trani.csv" anche su Linux)
+def trova_file_marker(nome, cartella=DATA_FOLDER):
+    if not os.path.isdir(cartella):
+        return None
+
+    candidati = {}
+    for voce in os.scandir(cartella):
+        radice, estensione = os.path.splitext(voce.name)
+        if voce.is_file() and estensione.lower() in ESTENSIONI:
+            candidati[(normalizza_nome(radice), estensione.lower())] = voce.path
+
+    for estensione in ESTENSIONI:
+        percorso = candidati.get((normalizza_nome(nome_file_unita(nome)), estensione))
+        if percorso:
+            return percorso
+    return None
+
+
+# === Colonna di df con uno dei nomi in alias (senza distinzione di maiuscole), None se assente ===
+def colonna_alias(df, alias):
+    colonne = {str(c).strip().lower(): c for c in df.columns}
+    for nome in alias:
+        if nome in colonne:
+            return df[colonne[nome]]
+    return None
+
+
+# === Valori con spazi, virgola decimale o testo spurio -> numerici (NaN se non validi) ===
+def valori_numerici(colonna):
+    if not pd.api.types.is_numeric_dtype(colonna):  # object o, con pandas 3, str
+        colonna = colonna.astype(str).str.strip().str.replace(",", ".", regex=False)
+    return pd.to_numeric(colonna, errors="coerce").to_numpy(dtype=float)
+
+
+# === True per le coordinate presenti e dentro il dominio lon/lat ===
+def coordinate_valide(longitudine, latitudine):
+    return (np.isfinite(longitudine) & np.isfinite(latitudine)
+            & (np.abs(longitudine) <= 180) & (np.abs(latitudine) <= 90))
+
+
+# === Lettura della sorgente in due array (longitude, latitude) ===
+def _leggi_coordinate(percorso):
+    estensione = os.path.splitext(percorso)[1].lower()
+
+    if estensione == ".csv":
+        df = pd.read_csv(percorso, skipinitialspace=True, encoding="utf-8-sig")
+    else:
+        try:
+            gdf = gpd.read_file(percorso)
+        except Exception:
+            gdf = None
+
+        if gdf is not None and len(gdf) and gdf.geometry.notna().any():
+            if not gdf.geometry.type.eq("Point").all():
+                raise ValueError("geometrie non puntuali nel file")
+            return gdf.geometry.x.to_numpy(dtype=float), gdf.geometry.y.to_numpy(dtype=float)
+        df = pd.read_json(percorso)
+
+    latitudine = colonna_alias(df, ALIAS_LATITUDINE)
+    longitudine = colonna_alias(df, ALIAS_LONGITUDINE)
+    if latitudine is None or longitudine is None:
+        raise ValueError("colonne 'latitude' o 'longitude' mancanti")
+    return valori_numerici(longitudine), valori_numerici(latitudine)
+
+
+# === Scarta coordinate mancanti o fuori dal dominio lon/lat ===
+def _valida(longitudine, latitudine, percorso):
+    validi = coordinate_valide(longitudine, latitudine)
+    scartati = int((~validi).sum())
+    if scartati:
+        print(f"  [!] {os.path.basename(percorso)}: scartati {scartati} marker con coordinate non valide")
+    return np.column_stack([longitudine[validi], latitudine[validi]])
+
+
+# === Coordinate (n, 2) lon/lat float64 di un file marker, con cache binaria ===
+# La cache (<cache_dir>/<chiave>.npy + .json) è valida se mtime e dimensione coincidono;
+# se la mtime è cambiata ma lo SHA-1 del contenuto no, la cache viene solo riconfermata.
+def coordinate_marker(percorso, cache_dir=MARKER_CACHE):
+    os.makedirs(cache_dir, exist_ok=True)
+    chiave = hashlib.sha1(os.path.abspath(percorso).encode("utf-8")).hexdigest()[:16]
+    npy_path = os.path.join(cache_dir, f"{chiave}.npy")
+    meta_path = os.path.join(cache_dir, f"{chiave}.json")
+
+    info = os.stat(percorso)
+    meta = None
+    if os.path.exists(npy_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, encoding="utf-8") as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            meta = None
+
+    if meta and meta["mtime_ns"] == info.st_mtime_ns and meta["size"] == info.st_size:
+        return np.load(npy_path, mmap_mode="r")
+
+    sha1 = impronta_file(percorso)
+    if not (meta and meta["sha1"] == sha1):
+        coordinate = _valida(*_leggi_coordinate(percorso), percorso)
+        scrivi_atomico(npy_path, lambda fh: np.save(fh, coordinate))
+
+    meta = {"sorgente": percorso, "mtime_ns": info.st_mtime_ns, "size": info.st_size, "sha1": sha1}
+    scrivi_atomico(meta_path, lambda fh: fh.write(json.dumps(meta).encode("utf-8")))
+    return np.load(npy_path, mmap_mode="r")
+
+
+# === GeoDataFrame dei marker (EPSG:4326) di un'unità, None se assente o non valido ===
+@fase("caricamento_marker")
+def carica_marker(nome, cartella=DATA_FOLDER, cache_dir=MARKER_CACHE):
+    percorso = trova_file_marker(nome, cartella)
+    if percorso is None:
+        print(f"  [!] Nessun file marker trovato per {nome}")
+        return None
+
+    try:
+        coordinate = coordinate_marker(percorso, cache_dir)
+    except (ValueError, OSError) as errore:
+        print(f"  [!] File marker non valido {percorso}: {errore}")
+        return None
+
+    if not len(coordinate):
+        print(f"  [!] Nessun marker valido in {percorso}")
+        return None
+
+    conta("marker", len(coordinate))
+    longitudine = np.ascontiguousarray(coordinate[:, 0])
+    latitudine = np.ascontiguousarray(coordinate[:, 1])
+    return gpd.GeoDataFrame(
+        {"longitude": longitudine, "latitude": latitudine},
+        geometry=gpd.points_from_xy(longitudine, latitudine),
+        crs="EPSG:4326",
+    )
@@ -1,114 +1,98 @@
 import os
-import contextily as ctx
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import Point
-import pandas as pd
-import numpy as np
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+
+from basemap import SORGENTE_PREDEFINITA, aggiungi_basemap
+from codifica import estensione_formato, salva_rgba
+from confini import PIXEL_USCITA, confine_per_estensione
+from contesto_render import figura
+from manifest import impronta_render, invariato
+from marker_loader import carica_marker, trova_file_marker
+from render_parallelo import RisultatoRender, renderizza_tutte
+from sfondi import SFONDI_DIR, carica_sfondo, chiave_sfondo, salva_sfondo
+from strumentazione import fase
 
 # === Costanti ===
 GEOJSON_PATH = "province.geojson"
-DATA_FOLDER = "dati_marker"
+REGIONI_PATH = "regioni.geojson"  # province raggruppate per regione: un mosaico di tile per regione (None = per provincia)
+DATA_FOLDER = "dati_marker"  # oppure "dati_marker/province", partizioni di ingestione.py o deduplica.py
 OUTPUT_FOLDER = "output_maps"
 MARKER_IMAGE_PATH = "autovelox-icon.png"  # scaricato da: https://unpkg.com/leaflet@1.9.4/dist/images/marker-icon.png
+DPI = 300
+FORMATO = "png"  # "png", "png8" (palette, file più piccoli) o "webp"
+COMPRESSIONE = None  # png: livello zlib 0-9 (None = 6); webp: qualità 0-100 (None = 90)
+ZOOM_MAPPA = None  # zoom delle tile: None = automatico dalla risoluzione dell'immagine (prima fisso a 11)
+MAX_TILE = 400  # tile per render con lo zoom automatico: oltre si scende di zoom
+RAGGIO_CLUSTER = 15  # punti: marker più vicini nell'immagine diventano un'icona con il numero (None = uno per marker)
+INCREMENTALE = True  # salta le province con input invariati (manifest in OUTPUT_FOLDER); False = ricostruisce tutto
+SFONDI_FOLDER = os.path.join(SFONDI_DIR, "prov")  # basemap e confine rasterizzati per provincia (None = nessuna cache)
+WORKERS = 1  # processi per il rendering in parallelo (1 = sequenziale, 0 = tutti i core)
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# === Funzione per visualizzare marker personalizzati ===
-def imscatter(x, y, ax, zoom=0.015, image_path="autovelox-icon.png"):
-    if not os.path.exists(image_path):
-        print(f"[!] Icona marker non trovata: {image_path}")
-        return
-
-    img = plt.imread(image_path)
-    im = OffsetImage(img, zoom=zoom)
-    for xi, yi in zip(x, y):
-        ab = AnnotationBbox(
-            im,
-            (xi, yi),
-            frameon=False,
-            xycoords='data',
-            box_alignment=(0.5, 0),  # punta sul punto
-            zorder=10
-        )
-        ax.add_artist(ab)
-
-# === Carica confini provinciali ===
-province_gdf = gpd.read_file(GEOJSON_PATH)
-
-# === Cicla su ogni provincia ===
-for _, provincia in province_gdf.iterrows():
+# === Rendering di una singola provincia ===
+def renderizza_provincia(provincia):
     nome_provincia = provincia['prov_name'].lower()
     print(f"\nElaborazione: {nome_provincia.title()}")
 
-    # === Verifica esistenza file marker ===
-    csv_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.csv")
-    json_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.json")
-    geojson_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.geojson")
-
-    marker_gdf = None
-
-    if os.path.exists(csv_path):
-        df = pd.read_csv(csv_path)
-        if {'latitude', 'longitude'}.issubset(df.columns):
-            geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-            marker_gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
-
-    elif os.path.exists(json_path):
-        try:
-            gdf = gpd.read_file(json_path)
-            if gdf.geometry.type.eq("Point").all():
-                gdf['longitude'] = gdf.geometry.x
-                gdf['latitude'] = gdf.geometry.y
-                marker_gdf = gdf
-        except Exception:
-            df = pd.read_json(json_path)
-            if {'latitude', 'longitude'}.issubset(df.columns):
-                geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-                marker_gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
-
-    elif os.path.exists(geojson_path):
-        gdf = gpd.read_file(geojson_path)
-        if gdf.geometry.type.eq("Point").all():
-            gdf['longitude'] = gdf.geometry.x
-            gdf['latitude'] = gdf.geometry.y
-            marker_gdf = gdf
-
-    if marker_gdf is None or not {'latitude', 'longitude'}.issubset(marker_gdf.columns):
-        print(f"  [!] File marker invalido o mancante colonne, salto...")
-        continue
+    output_path = os.path.join(OUTPUT_FOLDER, f"{nome_provincia}{estensione_formato(FORMATO)}")
+
+    # === Build incrementale: impronta di marker, confine, impostazioni, icona, tile e script ===
+    impronta = impronta_render(trova_file_marker(nome_provincia, DATA_FOLDER), provincia.geometry,
+                               {"dpi": DPI, "marker_icon": MARKER_IMAGE_PATH, "raggio_cluster": RAGGIO_CLUSTER,
+                                "zoom_mappa": ZOOM_MAPPA, "max_tile": MAX_TILE,
+                                "formato": FORMATO, "compressione": COMPRESSIONE},
+                               SORGENTE_PREDEFINITA, file_extra=(MARKER_IMAGE_PATH, __file__))
+    if INCREMENTALE and invariato(output_path, impronta):
+        print(f"  [=] Input invariati, salto: {output_path}")
+        return RisultatoRender(output_path, impronta, True)
+
+    # === Carica marker (file cercato senza distinzione di maiuscole, cache binaria) ===
+    marker_gdf = carica_marker(nome_provincia, DATA_FOLDER)
+    if marker_gdf is None:
+        print(f"  [!] Nessun marker utilizzabile, salto...")
+        return None
 
     gdf = marker_gdf
 
-    # === Estrai e proietta confine provincia ===
-    provincia_gdf = gpd.GeoDataFrame([provincia], crs=province_gdf.crs)
-    provincia_webmerc = provincia_gdf.to_crs(epsg=3857)
-    gdf_webmerc = gdf.to_crs(epsg=3857)
+    # === Proietta marker (il confine è già in EPSG:3857 nel catalogo confini) ===
+    with fase("proiezione"):
+        gdf_webmerc = gdf.to_crs(epsg=3857)
 
     # === Bounding box ===
-    combined = gpd.GeoSeries(pd.concat([gdf_webmerc.geometry, provincia_webmerc.geometry], ignore_index=True))
-    xmin, ymin, xmax, ymax = combined.total_bounds
-
-    # === Plotta ===
-    fig, ax = plt.subplots(figsize=(8.75, 8.75))
-    imscatter(
-        gdf_webmerc.geometry.x.values,
-        gdf_webmerc.geometry.y.values,
-        ax=ax,
-        zoom=0.015,
-        image_path=MARKER_IMAGE_PATH
-    )
-    provincia_webmerc.boundary.plot(ax=ax, color='black', linewidth=0.25, zorder=1)
-
-    ax.set_xlim(xmin - 1000, xmax + 1000)
-    ax.set_ylim(ymin - 1000, ymax + 1000)
-
-    ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, crs=gdf_webmerc.crs.to_string(), attribution_size=2, zoom=11)
-    ax.set_axis_off()
-
-    output_path = os.path.join(OUTPUT_FOLDER, f"{nome_provincia}.png")
-    plt.savefig(output_path, dpi=300, bbox_inches='tight', pad_inches=0)
-    plt.close()
+    mxmin, mymin, mxmax, mymax = gdf_webmerc.total_bounds
+    xmin, ymin = min(mxmin, provincia['xmin']), min(mymin, provincia['ymin'])
+    xmax, ymax = max(mxmax, provincia['xmax']), max(mymax, provincia['ymax'])
+    limiti = (xmin - 1000, xmax + 1000, ymin - 1000, ymax + 1000)
+
+    # === Sfondo (basemap e confine): dalla cache se solo i marker sono cambiati ===
+    chiave = chiave_sfondo(provincia.geometry, limiti,
+                           {"figsize": (8.75, 8.75), "dpi": DPI, "zoom_mappa": ZOOM_MAPPA, "max_tile": MAX_TILE},
+                           SORGENTE_PREDEFINITA, file_extra=(__file__,))
+    sfondo = carica_sfondo(SFONDI_FOLDER, nome_provincia, chiave) if SFONDI_FOLDER else None
+    if sfondo is None:
+        provincia_webmerc = confine_per_estensione(provincia, max(xmax - xmin, ymax - ymin) + 2000, PIXEL_USCITA)
+        fig, ax = figura((8.75, 8.75))  # figura riusata tra le unità, svuotata (contesto_render)
+        provincia_webmerc.boundary.plot(ax=ax, color='black', linewidth=0.25, zorder=1)
+
+        ax.set_xlim(limiti[0], limiti[1])
+        ax.set_ylim(limiti[2], limiti[3])
+
+        aggiungi_basemap(ax, zoom=ZOOM_MAPPA, attribution_size=2, dpi=DPI, max_tile=MAX_TILE)
+        ax.set_axis_off()
+        sfondo = salva_sfondo(fig, ax, SFONDI_FOLDER, nome_provincia, chiave, DPI, pad_inches=0)
+    else:
+        print(f"  [i] Sfondo dalla cache: ricompongo solo i marker")
+
+    # === Marker sopra lo sfondo, come imscatter negli assi ===
+    with fase("salvataggio"):
+        rgba = sfondo.componi(gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values, MARKER_IMAGE_PATH,
+                              zoom=0.015, raggio_cluster=RAGGIO_CLUSTER)
+        salva_rgba(rgba, output_path, DPI, formato=FORMATO, compressione=COMPRESSIONE)  # codifica in background
 
     print(f"  [+] Salvata: {output_path}")
+    return RisultatoRender(output_path, impronta, False)
+
+
+if __name__ == "__main__":
+    renderizza_tutte(renderizza_provincia, GEOJSON_PATH, campo_nome="prov_name", workers=WORKERS,
+                     regioni_path=REGIONI_PATH,
+                     impostazioni={"data_folder": DATA_FOLDER, "zoom_mappa": ZOOM_MAPPA, "max_tile": MAX_TILE})
@@ -1,137 +1,73 @@
 # === path: generate_mappe_province.py ===
 
-import os
-import contextily as ctx
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import Point
-import pandas as pd
-import numpy as np
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
-from PIL import Image
+from basemap import SORGENTE_PREDEFINITA
+from manifest import impronta_render, invariato
+from marker_loader import carica_marker, trova_file_marker
+from render_parallelo import RisultatoRender, renderizza_tutte
+from strumentazione import fase
+from varianti import Variante, percorso_variante, renderizza_varianti
 
 # === Costanti ===
 GEOJSON_PATH = "province.geojson"
-DATA_FOLDER = "dati_marker"
+REGIONI_PATH = "regioni.geojson"  # province raggruppate per regione: un mosaico di tile per regione (None = per provincia)
+DATA_FOLDER = "dati_marker"  # oppure "dati_marker/province", partizioni di ingestione.py o deduplica.py
 OUTPUT_FOLDER = "output_maps"
 MARKER_IMAGE_PATH = "autovelox-icon.png"
 ZOOM_MODE = "provincia"
 TRIM_IMAGE = True
 TRIM_MARGIN_PX = 50
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-# === Funzione per visualizzare marker personalizzati ===
-def imscatter(x, y, ax, zoom=0.015, image_path="autovelox-icon.png"):
-    if not os.path.exists(image_path):
-        print(f"[!] Icona marker non trovata: {image_path}")
-        return
-    img = plt.imread(image_path)
-    im = OffsetImage(img, zoom=zoom)
-    for xi, yi in zip(x, y):
-        ab = AnnotationBbox(im, (xi, yi), frameon=False, xycoords='data', box_alignment=(0.5, 0), zorder=10)
-        ax.add_artist(ab)
-
-# === Carica confini provinciali ===
-province_gdf = gpd.read_file(GEOJSON_PATH)
-
-# === Cicla su ogni provincia ===
-for _, provincia in province_gdf.iterrows():
+SALVA_COMPLETA = False  # True = salva anche l'immagine non ritagliata <nome>.full.png
+DPI = 300
+ZOOM_MAPPA = None  # zoom delle tile: None = automatico dalla risoluzione dell'immagine (prima fisso a 11)
+MAX_TILE = 400  # tile per render con lo zoom automatico: oltre si scende di zoom
+FORMATO = "png"  # "png", "png8" (palette, file più piccoli) o "webp"
+COMPRESSIONE = None  # png: livello zlib 0-9 (None = 6); webp: qualità 0-100 (None = 90)
+RAGGIO_CLUSTER = 15  # punti: marker più vicini nell'immagine diventano un'icona con il numero (None = uno per marker)
+INCREMENTALE = True  # salta le province con input invariati (manifest in OUTPUT_FOLDER); False = ricostruisce tutto
+WORKERS = 1  # processi per il rendering in parallelo (1 = sequenziale, 0 = tutti i core)
+
+# Ritaglio in memoria: il riquadro dei marker è calcolato prima di disegnare e si codifica
+# una sola immagine, senza salvare e riaprire il PNG completo
+VARIANTI = [Variante("ritagliata", OUTPUT_FOLDER, estensione=ZOOM_MODE, dpi=DPI, icona=MARKER_IMAGE_PATH,
+                     zoom_mappa=ZOOM_MAPPA, zoom_marker=0.015, ritaglio_px=TRIM_MARGIN_PX if TRIM_IMAGE else None,
+                     raggio_cluster=RAGGIO_CLUSTER, formato=FORMATO, compressione=COMPRESSIONE)]
+if SALVA_COMPLETA and TRIM_IMAGE:
+    VARIANTI.append(Variante("completa", OUTPUT_FOLDER, estensione=ZOOM_MODE, dpi=DPI, icona=MARKER_IMAGE_PATH,
+                             zoom_mappa=ZOOM_MAPPA, zoom_marker=0.015, suffisso=".full",
+                             raggio_cluster=RAGGIO_CLUSTER, formato=FORMATO, compressione=COMPRESSIONE))
+
+
+# === Rendering di una singola provincia ===
+def renderizza_provincia(provincia):
     nome_provincia = provincia['prov_name'].lower()
     print(f"\nElaborazione: {nome_provincia.title()}")
 
-    csv_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.csv")
-    json_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.json")
-    geojson_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.geojson")
-
-    marker_gdf = None
+    output_paths = [percorso_variante(variante, nome_provincia) for variante in VARIANTI]
 
-    if os.path.exists(csv_path):
-        df = pd.read_csv(csv_path)
-        if {'latitude', 'longitude'}.issubset(df.columns):
-            geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-            marker_gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
+    # === Build incrementale: impronta di marker, confine, impostazioni, icona, tile e script ===
+    impronta = impronta_render(trova_file_marker(nome_provincia, DATA_FOLDER), provincia.geometry,
+                               {"varianti": [variante._asdict() for variante in VARIANTI], "max_tile": MAX_TILE},
+                               SORGENTE_PREDEFINITA, file_extra=(MARKER_IMAGE_PATH, __file__))
+    if INCREMENTALE and invariato(output_paths, impronta):
+        print(f"  [=] Input invariati, salto: {', '.join(output_paths)}")
+        return RisultatoRender(output_paths, impronta, True)
 
-    elif os.path.exists(json_path):
-        try:
-            gdf = gpd.read_file(json_path)
-            if gdf.geometry.type.eq("Point").all():
-                gdf['longitude'] = gdf.geometry.x
-                gdf['latitude'] = gdf.geometry.y
-                marker_gdf = gdf
-        except Exception:
-            df = pd.read_json(json_path)
-            if {'latitude', 'longitude'}.issubset(df.columns):
-                geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-                marker_gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
-
-    elif os.path.exists(geojson_path):
-        gdf = gpd.read_file(geojson_path)
-        if gdf.geometry.type.eq("Point").all():
-            gdf['longitude'] = gdf.geometry.x
-            gdf['latitude'] = gdf.geometry.y
-            marker_gdf = gdf
-
-    if marker_gdf is None or not {'latitude', 'longitude'}.issubset(marker_gdf.columns):
-        print(f"  [!] File marker invalido o mancante colonne, salto...")
-        continue
+    # === Carica marker (file cercato senza distinzione di maiuscole, cache binaria) ===
+    marker_gdf = carica_marker(nome_provincia, DATA_FOLDER)
+    if marker_gdf is None:
+        print(f"  [!] Nessun marker utilizzabile, salto...")
+        return None
 
     gdf = marker_gdf
-    provincia_gdf = gpd.GeoDataFrame([provincia], crs=province_gdf.crs)
-    provincia_webmerc = provincia_gdf.to_crs(epsg=3857)
-    gdf_webmerc = gdf.to_crs(epsg=3857)
-
-    bounds = provincia_webmerc.total_bounds
-    margin_factor = 0.05
-
-    xmin, ymin, xmax, ymax = bounds
-    x_margin = (xmax - xmin) * margin_factor
-    y_margin = (ymax - ymin) * margin_factor
-
-    basemap_zoom = 11
-    marker_zoom = 0.015
-    print(f"  [i] Zoom livello OSM usato: {basemap_zoom}")
-
-    fig, ax = plt.subplots(figsize=(8.75, 8.75))
-    imscatter(gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values, ax=ax, zoom=marker_zoom, image_path=MARKER_IMAGE_PATH)
-    provincia_webmerc.boundary.plot(ax=ax, color='black', linewidth=0.25, zorder=1)
-
-    ax.set_xlim(xmin - x_margin, xmax + x_margin)
-    ax.set_ylim(ymin - y_margin, ymax + y_margin)
-
-    ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, crs=gdf_webmerc.crs.to_string(), attribution_size=2, zoom=basemap_zoom)
-    ax.set_axis_off()
-
-    output_base = os.path.join(OUTPUT_FOLDER, f"{nome_provincia}")
-    output_full = f"{output_base}.full.png"
-    output_crop = f"{output_base}.png"
-
-    # === Disegna rettangolo rosso per debug ===
-    from matplotlib.patches import Rectangle
-    rect = Rectangle(
-         (x0, y0), x1 - x0, y1 - y0,
-         linewidth=2, edgecolor='red', facecolor='none',
-         transform=None  # pixel coordinates
-    )
-    ax.add_patch(rect)
-
-    plt.savefig(output_full, dpi=300, bbox_inches='tight', pad_inches=0)
-
-    if TRIM_IMAGE:
-        img = Image.open(output_full)
-        points = np.vstack(ax.transData.transform(list(zip(gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values))))
-        x0, y0 = points.min(axis=0)
-        x1, y1 = points.max(axis=0)
+    with fase("proiezione"):
+        gdf_webmerc = gdf.to_crs(epsg=3857)  # il confine è già in EPSG:3857 nel catalogo confini
 
-        x0 = max(int(x0) - TRIM_MARGIN_PX, 0)
-        y0 = max(int(y0) - TRIM_MARGIN_PX, 0)
-        x1 = min(int(x1) + TRIM_MARGIN_PX, img.width)
-        y1 = min(int(y1) + TRIM_MARGIN_PX, img.height)
+    output_paths = renderizza_varianti(provincia, gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values,
+                                       VARIANTI, f"{nome_provincia}.png", max_tile=MAX_TILE)
+    return RisultatoRender(output_paths, impronta, False)
 
-        img_cropped = img.crop((x0, y0, x1, y1))
-        img_cropped.save(output_crop)
-        print(f"  [i] Immagine ritagliata salvata: {output_crop}")
-    else:
-        os.rename(output_full, output_crop)
 
-    plt.close()
-    print(f"  [+] Salvata: {output_crop}")
+if __name__ == "__main__":
+    renderizza_tutte(renderizza_provincia, GEOJSON_PATH, campo_nome="prov_name", workers=WORKERS,
+                     regioni_path=REGIONI_PATH,
+                     impostazioni={"data_folder": DATA_FOLDER, "zoom_mappa": ZOOM_MAPPA, "max_tile": MAX_TILE})
@@ -1,71 +1,98 @@
 import os
-import contextily as ctx
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import Point
-import pandas as pd
 import numpy as np
 
+from basemap import SORGENTE_PREDEFINITA, aggiungi_basemap
+from codifica import estensione_formato, salva
+from cluster import raggruppa_in_assi
+from confini import confine_per_estensione
+from contesto_render import figura
+from manifest import impronta_render, invariato
+from marker_loader import carica_marker, trova_file_marker
+from render_parallelo import RisultatoRender, renderizza_tutte
+from strumentazione import fase
+
 # === Costanti ===
 GEOJSON_PATH = "province.geojson"
-DATA_FOLDER = "dati_marker"
+REGIONI_PATH = "regioni.geojson"  # province raggruppate per regione: un mosaico di tile per regione (None = per provincia)
+DATA_FOLDER = "dati_marker"  # oppure "dati_marker/province", partizioni di ingestione.py o deduplica.py
 OUTPUT_FOLDER = "output_maps"
+PIXEL_USCITA = 8 * 300  # lato immagine: figsize 8 in a 300 dpi
+DPI = 300
+FORMATO = "png"  # "png", "png8" (palette, file più piccoli) o "webp"
+COMPRESSIONE = None  # png: livello zlib 0-9 (None = 6); webp: qualità 0-100 (None = 90)
+ZOOM_MAPPA = None  # zoom delle tile: None = automatico dalla risoluzione dell'immagine (prima fisso a 11)
+MAX_TILE = 400  # tile per render con lo zoom automatico: oltre si scende di zoom
+RAGGIO_CLUSTER = 8  # punti: marker più vicini nell'immagine diventano un punto con il numero (None = uno per marker)
+INCREMENTALE = True  # salta le province con input invariati (manifest in OUTPUT_FOLDER); False = ricostruisce tutto
+WORKERS = 1  # processi per il rendering in parallelo (1 = sequenziale, 0 = tutti i core)
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# === Carica confini provinciali ===
-province_gdf = gpd.read_file(GEOJSON_PATH)
-
-# === Cicla su ogni provincia ===
-for _, provincia in province_gdf.iterrows():
+# === Rendering di una singola provincia ===
+def renderizza_provincia(provincia):
     nome_provincia = provincia['prov_name'].lower()
     print(f"\nElaborazione: {nome_provincia.title()}")
 
-    # === Verifica esistenza file marker ===
-    csv_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.csv")
-    json_path = os.path.join(DATA_FOLDER, f"{nome_provincia}.geojson")
-
-    if os.path.exists(csv_path):
-        df = pd.read_csv(csv_path)
-    elif os.path.exists(json_path):
-        df = pd.read_json(json_path)
-    else:
-        print(f"  [!] Nessun file marker trovato per {nome_provincia}, salto...")
-        continue
+    output_path = os.path.join(OUTPUT_FOLDER, f"{nome_provincia}{estensione_formato(FORMATO)}")
 
-    if not {'latitude', 'longitude'}.issubset(df.columns):
-        print(f"  [!] File marker mancante colonne 'latitude' o 'longitude', salto...")
-        continue
+    # === Build incrementale: impronta di marker, confine, impostazioni, icona, tile e script ===
+    impronta = impronta_render(trova_file_marker(nome_provincia, DATA_FOLDER), provincia.geometry,
+                               {"dpi": DPI, "pixel_uscita": PIXEL_USCITA, "raggio_cluster": RAGGIO_CLUSTER,
+                                "zoom_mappa": ZOOM_MAPPA, "max_tile": MAX_TILE,
+                                "formato": FORMATO, "compressione": COMPRESSIONE},
+                               SORGENTE_PREDEFINITA, file_extra=(__file__,))
+    if INCREMENTALE and invariato(output_path, impronta):
+        print(f"  [=] Input invariati, salto: {output_path}")
+        return RisultatoRender(output_path, impronta, True)
 
-    # === Crea GeoDataFrame marker ===
-    geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-    gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
+    # === Carica marker (file cercato senza distinzione di maiuscole, cache binaria) ===
+    gdf = carica_marker(nome_provincia, DATA_FOLDER)
+    if gdf is None:
+        print(f"  [!] Nessun marker utilizzabile, salto...")
+        return None
 
-    # === Estrai e proietta confine provincia ===
-    provincia_gdf = gpd.GeoDataFrame([provincia], crs=province_gdf.crs)
-    provincia_webmerc = provincia_gdf.to_crs(epsg=3857)
-    gdf_webmerc = gdf.to_crs(epsg=3857)
+    # === Proietta marker (il confine è già in EPSG:3857 nel catalogo confini) ===
+    with fase("proiezione"):
+        gdf_webmerc = gdf.to_crs(epsg=3857)
 
     # === Bounding box ===
-    combined = gpd.GeoSeries(pd.concat([gdf_webmerc.geometry, provincia_webmerc.geometry], ignore_index=True))
-    xmin, ymin, xmax, ymax = combined.total_bounds
+    mxmin, mymin, mxmax, mymax = gdf_webmerc.total_bounds
+    xmin, ymin = min(mxmin, provincia['xmin']), min(mymin, provincia['ymin'])
+    xmax, ymax = max(mxmax, provincia['xmax']), max(mymax, provincia['ymax'])
+    provincia_webmerc = confine_per_estensione(provincia, max(xmax - xmin, ymax - ymin) + 2000, PIXEL_USCITA)
 
     # === Plotta ===
-    fig, ax = plt.subplots(figsize=(8, 8))
-    gdf_webmerc.plot(ax=ax, color='red', markersize=15, zorder=1)
+    fig, ax = figura((8, 8))  # figura riusata tra le unità, svuotata (contesto_render)
     provincia_webmerc.boundary.plot(ax=ax, color='black', linewidth=0.5, zorder=1)
 
     ax.set_xlim(xmin - 1000, xmax + 1000)
     ax.set_ylim(ymin - 1000, ymax + 1000)
 
-    ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, crs=gdf_webmerc.crs.to_string(), attribution_size=4, zoom=11)
-    # ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.HOT, crs=gdf_webmerc.crs.to_string(), zoom=11)
+    # === Marker raggruppati alla scala dell'immagine (limiti già fissati): un punto per cluster ===
+    x, y = gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values
+    conteggi = np.ones(len(x), dtype=int)
+    if RAGGIO_CLUSTER:
+        x, y, conteggi = raggruppa_in_assi(ax, x, y, RAGGIO_CLUSTER)
+    ax.scatter(x, y, color='red', s=15, zorder=1)
+    for xi, yi, numero in zip(x, y, conteggi):
+        if numero > 1:
+            ax.annotate(str(numero), (xi, yi), xytext=(2, 2), textcoords="offset points", fontsize=4,
+                        fontweight="bold", color="darkred", zorder=2)
+
+    aggiungi_basemap(ax, zoom=ZOOM_MAPPA, attribution_size=4, dpi=DPI, max_tile=MAX_TILE)
+    # aggiungi_basemap(ax, zoom=11, source=ctx.providers.OpenStreetMap.HOT)
 
     # ax.set_title(f"Provincia di {nome_provincia.title()}")
     ax.set_axis_off()
 
-    output_path = os.path.join(OUTPUT_FOLDER, f"{nome_provincia}.png")
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    with fase("salvataggio"):
+        salva(fig, output_path, DPI, formato=FORMATO, compressione=COMPRESSIONE)  # codifica in background
+
+    print(f"  [+] Salvata: {output_path}")
+    return RisultatoRender(output_path, impronta, False)
+
 
-    print(f"  [+] Salvata: {output_path}")
\ No newline at end of file
+if __name__ == "__main__":
+    renderizza_tutte(renderizza_provincia, GEOJSON_PATH, campo_nome="prov_name", workers=WORKERS, pixel_uscita=PIXEL_USCITA,
+                     regioni_path=REGIONI_PATH,
+                     impostazioni={"data_folder": DATA_FOLDER, "zoom_mappa": ZOOM_MAPPA, "max_tile": MAX_TILE})
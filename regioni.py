@@ -1,70 +1,83 @@
 import os
-import contextily as ctx
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import Point
-import pandas as pd
-import numpy as np
+
+from basemap import aggiungi_basemap
+from codifica import attendi_codifiche, estensione_formato, salva, stampa_codifica, statistiche_codifica
+from confini import carica_confini, confine_per_estensione
+from contesto_render import figura
+from densita import conta_in_griglia, disegna_griglia, griglia_per_uscita
+from marker_loader import carica_marker, trova_file_marker
 
 # === Costanti ===
 GEOJSON_PATH = "regioni.geojson"
-DATA_FOLDER = "dati_marker"
+DATA_FOLDER = "dati_marker/regioni"  # partizioni per regione di ingestione.py o deduplica.py
+DATA_FOLDER_ORIGINALE = "dati_marker"  # file per regione mantenuti a mano, se le partizioni non ci sono ancora
 OUTPUT_FOLDER = "output_maps"
+PIXEL_USCITA = 10 * 150  # lato immagine: figsize 10 in a 150 dpi
+DPI = 150
+ZOOM_MAPPA = None  # zoom delle tile: None = automatico dalla risoluzione dell'immagine (prima fisso a 11)
+MAX_TILE = 400  # tile per render con lo zoom automatico: oltre si scende di zoom
+FORMATO = "png"  # "png", "png8" (palette, file più piccoli) o "webp"
+COMPRESSIONE = None  # png: livello zlib 0-9 (None = 6); webp: qualità 0-100 (None = 90)
+MODO = "marker"  # "marker" (un punto per autovelox) o "densita" (griglia di densità di densita.py, per migliaia di marker)
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# === Carica confini provinciali ===
-regioni_gdf = gpd.read_file(GEOJSON_PATH)
+# === Sorgente dei marker: partizioni se presenti, altrimenti la cartella originale ===
+if not os.path.isdir(DATA_FOLDER):
+    print(f"[!] {DATA_FOLDER} non trovata (partizioni create da: python ingestione.py o python deduplica.py): "
+          f"uso {DATA_FOLDER_ORIGINALE}")
+    DATA_FOLDER = DATA_FOLDER_ORIGINALE
+
+# === Carica confini regionali (proiettati e semplificati una volta, poi dalla cache) ===
+regioni_gdf = carica_confini(GEOJSON_PATH, PIXEL_USCITA)
+if not any(trova_file_marker(nome.lower(), DATA_FOLDER) for nome in regioni_gdf["reg_name"]):
+    raise SystemExit(f"[!] Nessun file marker per regione in {DATA_FOLDER}: eseguire prima python ingestione.py "
+                     f"(o python deduplica.py) per creare le partizioni in dati_marker/regioni")
 
 # === Cicla su ogni provincia ===
 for _, regione in regioni_gdf.iterrows():
     nome_regione = regione['reg_name'].lower()
     print(f"\nElaborazione: {nome_regione.title()}")
 
-    # === Verifica esistenza file marker ===
-    csv_path = os.path.join(DATA_FOLDER, f"{nome_regione}.csv")
-    json_path = os.path.join(DATA_FOLDER, f"{nome_regione}.json")
-
-    if os.path.exists(csv_path):
-        df = pd.read_csv(csv_path)
-    elif os.path.exists(json_path):
-        df = pd.read_json(json_path)
-    else:
-        print(f"  [!] Nessun file marker trovato per {nome_regione}, salto...")
+    # === Carica marker (file cercato senza distinzione di maiuscole, cache binaria) ===
+    gdf = carica_marker(nome_regione, DATA_FOLDER)
+    if gdf is None:
+        print(f"  [!] Nessun marker utilizzabile, salto...")
         continue
 
-    if not {'latitude', 'longitude'}.issubset(df.columns):
-        print(f"  [!] File marker mancante colonne 'latitude' o 'longitude', salto...")
-        continue
-
-    # === Crea GeoDataFrame marker ===
-    geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
-    gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
-
-    # === Estrai e proietta confine regione ===
-    regione_gdf = gpd.GeoDataFrame([regione], crs=regioni_gdf.crs)
-    regione_webmerc = regione_gdf.to_crs(epsg=3857)
+    # === Proietta marker (il confine è già in EPSG:3857 nel catalogo confini) ===
     gdf_webmerc = gdf.to_crs(epsg=3857)
 
     # === Bounding box ===
-    combined = gpd.GeoSeries(pd.concat([gdf_webmerc.geometry, regione_webmerc.geometry], ignore_index=True))
-    xmin, ymin, xmax, ymax = combined.total_bounds
+    mxmin, mymin, mxmax, mymax = gdf_webmerc.total_bounds
+    xmin, ymin = min(mxmin, regione['xmin']), min(mymin, regione['ymin'])
+    xmax, ymax = max(mxmax, regione['xmax']), max(mymax, regione['ymax'])
+    regione_webmerc = confine_per_estensione(regione, max(xmax - xmin, ymax - ymin) + 10000, PIXEL_USCITA)
 
     # === Plotta ===
-    fig, ax = plt.subplots(figsize=(10, 10))
-    gdf_webmerc.plot(ax=ax, color='red', markersize=50, edgecolor='black', zorder=3)
+    fig, ax = figura((10, 10))  # figura riusata tra le unità, svuotata (contesto_render)
+    if MODO == "densita":
+        griglia = griglia_per_uscita(xmin - 5000, ymin - 5000, xmax + 5000, ymax + 5000, PIXEL_USCITA)
+        conteggi = conta_in_griglia(gdf_webmerc.geometry.x.values, gdf_webmerc.geometry.y.values, griglia)
+        disegna_griglia(ax, conteggi, griglia)
+    else:
+        gdf_webmerc.plot(ax=ax, color='red', markersize=50, edgecolor='black', zorder=3)
     regione_webmerc.boundary.plot(ax=ax, color='black', linewidth=2, zorder=4)
 
     ax.set_xlim(xmin - 5000, xmax + 5000)
     ax.set_ylim(ymin - 5000, ymax + 5000)
 
-    ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, crs=gdf_webmerc.crs.to_string(), zoom=11)
+    aggiungi_basemap(ax, zoom=ZOOM_MAPPA, dpi=DPI, max_tile=MAX_TILE)
 
     ax.set_title(f"regione {nome_regione.title()}")
     ax.set_axis_off()
 
-    output_path = os.path.join(OUTPUT_FOLDER, f"{nome_regione}.png")
-    plt.savefig(output_path, dpi=150, bbox_inches='tight')
-    plt.close()
+    output_path = os.path.join(OUTPUT_FOLDER, f"{nome_regione}{estensione_formato(FORMATO)}")
+    salva(fig, output_path, DPI, formato=FORMATO, compressione=COMPRESSIONE)  # codifica in background
+
+    print(f"  [+] Salvata: {output_path}")
 
-    print(f"  [+] Salvata: {output_path}")
\ No newline at end of file
+# === Attende le ultime immagini in codifica ===
+for percorso, errore in attendi_codifiche().items():
+    print(f"  [!] Codifica fallita: {percorso}\n{errore}")
+stampa_codifica(statistiche_codifica())
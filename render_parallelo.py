@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing as mp
+
+import matplotlib
+import numpy as np
+import shapely
+
+from basemap import mosaico_regionale
+from codifica import attendi_codifiche
+from confini import PIXEL_USCITA, carica_confini
+from ingestione import assegna_unita
+from manifest import registra_esiti
+from shard import SHARD, SOLO_PIANO, carichi_shard, indici_shard, piano_shard, scrivi_rapporto, stampa_piano
+from strumentazione import RegistroMetriche, byte_output, inizia_unita, riepiloga, termina_unita
+
+MARGINE_REGIONE = 0.1  # margine del mosaico regionale, per le estensioni che escono dal confine
+
+# === Esito del rendering di una singola unità (provincia o regione) ===
+# stato: "ok" (immagine salvata), "invariata" (input invariati, immagine esistente
+# riutilizzata), "saltata" (nessun marker) oppure "errore"
+# metriche: fasi, marker, tile, byte scritti e memoria (strumentazione.termina_unita)
+EsitoRender = namedtuple("EsitoRender", ["nome", "stato", "output", "durata", "errore", "impronta", "metriche"],
+                         defaults=[None, None])
+
+# === Valore che una funzione di rendering può restituire al posto del solo percorso ===
+# impronta: hash degli input (manifest.impronta_render), registrata nel manifest dal
+# processo principale; invariato: True se l'immagine non è stata ridisegnata.
+RisultatoRender = namedtuple("RisultatoRender", ["output", "impronta", "invariato"])
+
+# Confini (EPSG:3857) caricati una sola volta per processo (worker o processo principale)
+_confini = None
+
+
+# === Inizializzazione del processo: backend headless e catalogo confini in memoria ===
+def _inizializza_worker(geojson_path, pixel_uscita):
+    global _confini
+    matplotlib.use("Agg")
+    _confini = carica_confini(geojson_path, pixel_uscita)
+
+
+# === Rendering di una unità isolato: un errore non ferma il batch ===
+def _renderizza_unita(funzione, campo_nome, indice):
+    unita = _confini.iloc[indice]
+    nome = unita[campo_nome]
+    inizio = time.perf_counter()
+    inizia_unita(nome)
+    try:
+        output = funzione(unita)
+    except Exception:
+        # Chiude le figure pyplot rimaste aperte (quelle di contesto_render si svuotano al prossimo uso)
+        import matplotlib.pyplot as plt
+        plt.close("all")
+        metriche = termina_unita()
+        return EsitoRender(nome, "errore", None, time.perf_counter() - inizio, traceback.format_exc(),
+                           metriche=metriche)
+    metriche = termina_unita(output)
+
+    impronta = None
+    if isinstance(output, RisultatoRender):
+        stato = "invariata" if output.invariato else "ok"
+        output, impronta = output.output, output.impronta
+    else:
+        stato = "ok" if output else "saltata"
+    return EsitoRender(nome, stato, output, time.perf_counter() - inizio, None, impronta, metriche)
+
+
+# === Attende le immagini ancora in codifica (codifica.salva) degli esiti ===
+# Una codifica fallita rende l'unità un errore; i byte scritti sono misurati a file completo.
+def _completa_codifiche(esiti):
+    completati = []
+    for esito in esiti:
+        if esito.stato == "ok":
+            errori = attendi_codifiche(esito.output if isinstance(esito.output, (list, tuple)) else [esito.output])
+            if errori:
+                esito = esito._replace(stato="errore", errore="\n".join(errori.values()))
+            elif esito.metriche is not None:
+                esito.metriche["output_bytes"] = byte_output(esito.output)
+        completati.append(esito)
+    return completati
+
+
+# === Rendering di un gruppo di unità che condividono il mosaico della stessa regione ===
+# Restituisce gli esiti e i contatori del mosaico regionale accumulati dal gruppo.
+# completa=False lascia le ultime immagini in codifica (_completa_codifiche le attende).
+def _renderizza_gruppo(funzione, campo_nome, nome_regione, estensione, indici, completa=True):
+    regionale = mosaico_regionale()
+    prima = regionale.statistiche()
+    regionale.imposta(nome_regione, estensione)
+    try:
+        esiti = [_renderizza_unita(funzione, campo_nome, indice) for indice in indici]
+    finally:
+        regionale.imposta(None)  # libera il mosaico prima del gruppo successivo
+    dopo = regionale.statistiche()
+    if completa:
+        esiti = _completa_codifiche(esiti)
+        attendi_codifiche()  # anche quelle di unità fallite dopo il salvataggio
+    return esiti, {chiave: dopo[chiave] - prima[chiave] for chiave in dopo}
+
+
+# === Piano di rendering: unità raggruppate per regione ===
+# Ogni unità va alla regione che contiene un suo punto interno; restituisce una lista di
+# (nome regione, estensione del mosaico, indici delle unità). Le unità fuori da tutte le
+# regioni formano gruppi singoli senza mosaico condiviso.
+def pianifica_regioni(confini, regioni_path, campo_regione="reg_name"):
+    regioni = carica_confini(regioni_path)
+    punti = shapely.point_on_surface(np.asarray(confini.geometry.values))
+    regione_di = assegna_unita(shapely.get_x(punti), shapely.get_y(punti), regioni)
+
+    gruppi = []
+    for indice_regione in np.unique(regione_di):
+        indici = np.flatnonzero(regione_di == indice_regione).tolist()
+        if indice_regione < 0:
+            gruppi.extend((None, None, [indice]) for indice in indici)
+            continue
+        regione = regioni.iloc[indice_regione]
+        dx = (regione["xmax"] - regione["xmin"]) * MARGINE_REGIONE
+        dy = (regione["ymax"] - regione["ymin"]) * MARGINE_REGIONE
+        estensione = (regione["xmin"] - dx, regione["ymin"] - dy, regione["xmax"] + dx, regione["ymax"] + dy)
+        gruppi.append((regione[campo_regione], estensione, indici))
+    return gruppi
+
+
+def _stampa_risparmio(contatori):
+    if not contatori["ritagli"] and not contatori["fuori_mosaico"]:
+        return
+    mb = 1024 * 1024
+    print(f"[i] Mosaici regionali: {contatori['ritagli']} basemap ritagliate, "
+          f"{contatori['fuori_mosaico']} fuori mosaico (tile per unità)")
+    print(f"  [i] Tile lette e decodificate: {contatori['tile_lette']} ({contatori['bytes_letti'] / mb:.1f} MB) "
+          f"invece di {contatori['tile_richieste']} ({contatori['bytes_richiesti'] / mb:.1f} MB) per unità: "
+          f"risparmiate {contatori['tile_richieste'] - contatori['tile_lette']} letture e decodifiche, "
+          f"{(contatori['bytes_richiesti'] - contatori['bytes_letti']) / mb:.1f} MB")
+
+
+def _stampa_esito(esito):
+    if esito.stato == "ok":
+        output = ", ".join(esito.output) if isinstance(esito.output, (list, tuple)) else esito.output
+        print(f"  [+] {esito.nome}: {output} ({esito.durata:.1f}s)")
+    elif esito.stato == "errore":
+        print(f"  [!] {esito.nome}: errore dopo {esito.durata:.1f}s\n{esito.errore}")
+
+
+def _stampa_riepilogo(esiti, durata):
+    conteggi = {stato: sum(1 for e in esiti if e.stato == stato) for stato in ("ok", "invariata", "saltata", "errore")}
+    print(f"\n[i] Ricostruite: {conteggi['ok']}, invariate: {conteggi['invariata']}, "
+          f"saltate: {conteggi['saltata']}, errori: {conteggi['errore']} in {durata:.1f}s")
+    for esito in esiti:
+        if esito.stato == "errore":
+            print(f"  [!] Fallita: {esito.nome}")
+
+
+# === Rendering di tutte le unità del GeoJSON, in sequenza o con un pool di processi ===
+# funzione(unita) riceve la riga del catalogo confini (geometria già in EPSG:3857), deve
+# essere definita a livello di modulo (picklable) e restituire il percorso dell'immagine
+# salvata o la lista dei percorsi delle varianti (oppure un RisultatoRender, per le build
+# incrementali), o None se l'unità è saltata. Le impronte restituite sono registrate nei
+# manifest a fine batch.
+# workers: 1 = sequenziale nel processo corrente, None/0 = un processo per core.
+# regioni_path: GeoJSON delle regioni; se indicato le unità sono raggruppate per regione e
+# condividono un solo mosaico di tile per regione e zoom (un gruppo per processo).
+# Per ogni unità si aggiunge una riga JSON a strumentazione.METRICHE_PATH (VELOX_METRICHE);
+# con VELOX_PROFILI=N si conservano i profili cProfile delle N unità più lente.
+# shard: (i, N) per renderizzare solo lo shard i del piano di shard.py (VELOX_SHARD=i/N, anche
+# da "python shard.py esegui <script> --shard i/N"); impostazioni: parametri dello script per
+# la stima dei costi (data_folder, zoom_mappa, max_tile, uscite). A fine batch lo shard scrive
+# il suo rapporto in shard.RAPPORTI_DIR, che shard.unisci() raccoglie.
+def renderizza_tutte(funzione, geojson_path, campo_nome="prov_name", workers=1, pixel_uscita=PIXEL_USCITA,
+                     regioni_path=None, impostazioni=None, shard=SHARD):
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    inizio = time.perf_counter()
+    inizio_batch = time.time()
+    esiti = []
+    contatori = dict.fromkeys(mosaico_regionale().statistiche(), 0)
+    script = os.path.basename(sys.argv[0]) or None
+
+    # Il catalogo viene (ri)costruito qui, una volta: i worker lo trovano già in cache
+    _inizializza_worker(geojson_path, pixel_uscita)
+
+    indici = range(len(_confini))
+    piano = None
+    if shard is not None:
+        piano = piano_shard(_confini, campo_nome, pixel_uscita, impostazioni, shard[1], script)
+        if SOLO_PIANO:
+            stampa_piano(piano)
+            return []
+        indici = indici_shard(piano, shard[0])
+        print(f"[i] Shard {shard[0]}/{shard[1]}: {len(indici)} unità su {len(_confini)}, "
+              f"{carichi_shard(piano)[shard[0] - 1]:.1f}s stimati (piano {piano.impronta[:12]})")
+
+    if regioni_path and os.path.exists(regioni_path):
+        scelte = set(indici)
+        gruppi = [(nome_regione, estensione, [indice for indice in gruppo if indice in scelte])
+                  for nome_regione, estensione, gruppo in pianifica_regioni(_confini, regioni_path)]
+        gruppi = [gruppo for gruppo in gruppi if gruppo[2]]
+        print(f"[i] {len(scelte)} unità in {sum(1 for g in gruppi if g[0] is not None)} regioni")
+    else:
+        gruppi = [(None, None, [indice]) for indice in indici]
+
+    registro = RegistroMetriche(script=script)
+
+    def chiudi():
+        registra_esiti(esiti)  # anche se interrotto: le unità completate non si rifanno
+        registro.chiudi()
+        if piano is not None:
+            scrivi_rapporto(piano, shard[0], esiti, inizio_batch, time.perf_counter() - inizio)
+
+    def raccogli(esiti_gruppo, contatori_gruppo):
+        for esito in esiti_gruppo:
+            registro.scrivi(esito)
+        esiti.extend(esiti_gruppo)
+        for chiave, valore in contatori_gruppo.items():
+            contatori[chiave] += valore
+
+    if workers == 1:
+        # Le immagini di un gruppo si codificano mentre si disegna il gruppo successivo
+        def completa(esiti_gruppo, contatori_gruppo):
+            esiti_gruppo = _completa_codifiche(esiti_gruppo)
+            for esito in esiti_gruppo:
+                if esito.stato == "errore":
+                    _stampa_esito(esito)
+            raccogli(esiti_gruppo, contatori_gruppo)
+
+        try:
+            in_codifica = None
+            for nome_regione, estensione, indici in gruppi:
+                gruppo = _renderizza_gruppo(funzione, campo_nome, nome_regione, estensione, indici, completa=False)
+                if in_codifica is not None:
+                    completa(*in_codifica)
+                in_codifica = gruppo
+            if in_codifica is not None:
+                completa(*in_codifica)
+            attendi_codifiche()
+        finally:
+            chiudi()
+        _stampa_riepilogo(esiti, time.perf_counter() - inizio)
+        _stampa_risparmio(contatori)
+        riepiloga(esiti)
+        return esiti
+
+    nomi = _confini[campo_nome].tolist()
+    print(f"[i] Rendering di {len(indici)} unità con {workers} processi")
+
+    # "spawn" ovunque: stesso comportamento su Windows e Linux, nessuno stato pyplot ereditato
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    contesto = mp.get_context("spawn")
+    lavoro = partial(_renderizza_gruppo, funzione, campo_nome)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=contesto,
+                                 initializer=_inizializza_worker, initargs=(geojson_path, pixel_uscita)) as pool:
+            futures = {pool.submit(lavoro, *gruppo): gruppo[2] for gruppo in gruppi}
+            for future in as_completed(futures):
+                try:
+                    esiti_gruppo, contatori_gruppo = future.result()
+                except BrokenProcessPool:
+                    # Un worker è terminato in modo anomalo (es. memoria esaurita)
+                    esiti_gruppo = [EsitoRender(nomi[indice], "errore", None, 0.0, "processo worker terminato")
+                                    for indice in futures[future]]
+                    contatori_gruppo = {}
+                for esito in esiti_gruppo:
+                    _stampa_esito(esito)
+                raccogli(esiti_gruppo, contatori_gruppo)
+    finally:
+        chiudi()  # i worker leggono soltanto i manifest, li scrive il processo principale
+
+    _stampa_riepilogo(esiti, time.perf_counter() - inizio)
+    _stampa_risparmio(contatori)
+    riepiloga(esiti)
+    return esiti
@@ -0,0 +1,280 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import mercantile as mt
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from tile_cache import TileCache, cache_predefinita, url_tile
+
+# === Costanti ===
+USER_AGENT = "velox-mappe/1.0"  # richiesto dalla tile usage policy di OpenStreetMap
+TIMEOUT_S = 30
+THREAD_TILE = int(os.environ.get("VELOX_THREAD_TILE", "16"))  # download e decodifica in parallelo (1 = in sequenza)
+CONNESSIONI_PER_HOST = int(os.environ.get("VELOX_CONNESSIONI_PER_HOST", "6"))  # richieste contemporanee verso un host
+RICHIESTE_AL_SECONDO = float(os.environ.get("VELOX_RICHIESTE_AL_SECONDO", "25"))  # per host, 0 = nessun limite
+HOST_LOCALI = {"127.0.0.1", "localhost", "::1"}  # es. server_tile_locale.py: nessun limite di frequenza
+TENTATIVI = 4
+BACKOFF_S = 0.5  # attesa prima del secondo tentativo, poi raddoppia (più una quota casuale)
+BACKOFF_MAX_S = 30
+STATI_RIPETIBILI = {429, 500, 502, 503, 504}
+
+
+class _Host:
+    def __init__(self, connessioni, richieste_al_secondo):
+        self.semaforo = threading.BoundedSemaphore(connessioni)
+        self.intervallo = 1 / richieste_al_secondo if richieste_al_secondo else 0
+        self.prossima = 0.0
+        self.lock = threading.Lock()
+
+    # Limite di frequenza: ogni richiesta prenota l'istante libero successivo
+    def attendi_turno(self):
+        if not self.intervallo:
+            return
+        with self.lock:
+            adesso = time.monotonic()
+            turno = max(adesso, self.prossima)
+            self.prossima = turno + self.intervallo
+        if turno > adesso:
+            time.sleep(turno - adesso)
+
+    # Dopo un 429/503 con Retry-After nessuna richiesta parte prima di quell'istante
+    def rinvia(self, secondi):
+        with self.lock:
+            self.prossima = max(self.prossima, time.monotonic() + secondi)
+
+
+def _retry_after(risposta):
+    valore = risposta.headers.get("Retry-After")
+    if not valore:
+        return None
+    try:
+        return max(float(valore), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(valore).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+# === Download concorrente delle tile di un render (o di un piano di render) ===
+# Un pool di thread limitato su una sessione requests con connessioni persistenti: le tile
+# già in cache si leggono da disco, le altre si scaricano al massimo CONNESSIONI_PER_HOST
+# alla volta per host e RICHIESTE_AL_SECONDO (tranne HOST_LOCALI), con nuovi tentativi a backoff esponenziale su
+# errori di rete, 429 e 5xx (rispettando Retry-After). Anche la decodifica PNG avviene nei
+# thread del pool (Pillow rilascia il GIL), quindi si sovrappone ai download ancora in corso.
+class ScaricatoreTile:
+    def __init__(self, thread=THREAD_TILE, connessioni_per_host=CONNESSIONI_PER_HOST,
+                 richieste_al_secondo=RICHIESTE_AL_SECONDO, tentativi=TENTATIVI):
+        self.thread = max(thread, 1)
+        self.connessioni_per_host = connessioni_per_host
+        self.richieste_al_secondo = richieste_al_secondo
+        self.tentativi = tentativi
+        self.ripetute = 0
+        self._host = {}
+        self._pool = None
+        self._sessione = None
+        self._lock = threading.Lock()
+
+    def _avvia(self):
+        with self._lock:
+            if self._pool is None:
+                sessione = requests.Session()
+                sessione.headers["User-Agent"] = USER_AGENT
+                adattatore = HTTPAdapter(pool_connections=4, pool_maxsize=self.thread, max_retries=0)
+                sessione.mount("http://", adattatore)
+                sessione.mount("https://", adattatore)
+                self._sessione = sessione
+                self._pool = ThreadPoolExecutor(max_workers=self.thread, thread_name_prefix="tile")
+        return self._pool
+
+    def _per_host(self, url):
+        indirizzo = urlsplit(url)
+        with self._lock:
+            if indirizzo.netloc not in self._host:
+                frequenza = 0 if indirizzo.hostname in HOST_LOCALI else self.richieste_al_secondo
+                self._host[indirizzo.netloc] = _Host(self.connessioni_per_host, frequenza)
+            return self._host[indirizzo.netloc]
+
+    def _scarica(self, url):
+        host = self._per_host(url)
+        for tentativo in range(self.tentativi):
+            attesa = None
+            with host.semaforo:
+                host.attendi_turno()
+                try:
+                    risposta = self._sessione.get(url, timeout=TIMEOUT_S)
+                    if risposta.status_code == 404:
+                        raise requests.HTTPError(f"Tile inesistente (404): {url}", response=risposta)
+                    if risposta.status_code in STATI_RIPETIBILI:
+                        attesa = _retry_after(risposta)
+                    risposta.raise_for_status()
+                    return risposta.content
+                except requests.RequestException as errore:
+                    stato = getattr(errore.response, "status_code", None)
+                    ripetibile = stato is None or stato in STATI_RIPETIBILI
+                    if tentativo == self.tentativi - 1 or not ripetibile:
+                        raise
+            # Fuori dal semaforo: durante l'attesa l'host resta libero per le altre tile
+            if attesa is None:
+                attesa = BACKOFF_S * 2 ** tentativo * (1 + random.random())
+            attesa = min(attesa, BACKOFF_MAX_S)
+            host.rinvia(attesa)
+            with self._lock:
+                self.ripetute += 1
+            time.sleep(attesa)
+
+    def _leggi(self, source, tile, cache):
+        dati = cache.leggi_cache(source, tile.z, tile.x, tile.y)
+        if dati is None:
+            dati = self._scarica(url_tile(source, tile.z, tile.x, tile.y))
+            cache.memorizza(source, tile.z, tile.x, tile.y, dati)
+        return dati
+
+    def _leggi_e_decodifica(self, source, tile, cache):
+        from basemap import decodifica_tile  # basemap importa questo modulo
+
+        dati = self._leggi(source, tile, cache)
+        return dati, decodifica_tile(dati)
+
+    # === Genera (tile, byte, array RGBA) man mano che le tile sono pronte, in ordine qualsiasi ===
+    def tile_decodificate(self, source, tiles, cache=None):
+        cache = cache or cache_predefinita()
+        pool = self._avvia()
+        if self.thread == 1 or len(tiles) <= 1:
+            for tile in tiles:
+                yield (tile, *self._leggi_e_decodifica(source, tile, cache))
+            return
+
+        future = {pool.submit(self._leggi_e_decodifica, source, tile, cache): tile for tile in tiles}
+        try:
+            for completata in as_completed(future):
+                yield (future[completata], *completata.result())
+        finally:
+            for attesa in future:
+                attesa.cancel()  # errore su una tile: le altre non ancora partite non servono più
+
+    # === Porta in cache le tile (es. di un intero piano di render) senza decodificarle ===
+    # Restituisce {tile: errore} delle tile non scaricate.
+    def precarica(self, source, tiles, cache=None):
+        cache = cache or cache_predefinita()
+        pool = self._avvia()
+        future = {pool.submit(self._leggi, source, tile, cache): tile for tile in tiles}
+        errori = {}
+        for completata in as_completed(future):
+            errore = completata.exception()
+            if errore is not None:
+                errori[future[completata]] = f"{type(errore).__name__}: {errore}"
+        return errori
+
+    # === Mosaico delle tile con la sua estensione (left, right, bottom, top) in EPSG:3857 ===
+    # Ogni tile decodificata è copiata nella sua posizione appena arriva.
+    def mosaico(self, tiles, zoom, source, cache=None):
+        x0, y0 = min(t.x for t in tiles), min(t.y for t in tiles)
+        x1, y1 = max(t.x for t in tiles), max(t.y for t in tiles)
+        img = None
+        for tile, _, array in self.tile_decodificate(source, tiles, cache):
+            h, w, d = array.shape
+            if img is None:
+                img = np.zeros(((y1 - y0 + 1) * h, (x1 - x0 + 1) * w, d), dtype=np.uint8)
+            riga, colonna = tile.y - y0, tile.x - x0
+            img[riga * h:(riga + 1) * h, colonna * w:(colonna + 1) * w] = array
+
+        alto_sinistra = mt.xy_bounds(mt.Tile(x0, y0, zoom))
+        basso_destra = mt.xy_bounds(mt.Tile(x1, y1, zoom))
+        return img, (alto_sinistra.left, basso_destra.right, basso_destra.bottom, alto_sinistra.top)
+
+    def statistiche(self):
+        with self._lock:
+            return {"thread": self.thread, "host": len(self._host), "ripetute": self.ripetute}
+
+
+# === Istanza condivisa per processo, usata da basemap.py ===
+_scaricatore = None
+_lock_predefinito = threading.Lock()
+
+
+def scaricatore_predefinito():
+    global _scaricatore
+    with _lock_predefinito:
+        if _scaricatore is None:
+            _scaricatore = ScaricatoreTile()
+        return _scaricatore
+
+
+# === Tile di un piano di render: unione delle tile delle estensioni delle unità, per zoom ===
+def tile_piano(geojson_path, zoom, margine):
+    from basemap import tile_estensione
+    from confini import carica_confini
+
+    tiles = set()
+    for unita in carica_confini(geojson_path).itertuples():
+        dx, dy = (unita.xmax - unita.xmin) * margine, (unita.ymax - unita.ymin) * margine
+        for livello in zoom:
+            tiles.update(tile_estensione(unita.xmin - dx, unita.ymin - dy, unita.xmax + dx, unita.ymax + dy, livello))
+    return sorted(tiles, key=lambda t: (t.z, t.x, t.y))
+
+
+# === Confronto con il download in sequenza su server_tile_locale.py con latenza simulata ===
+def prova(latenza, zoom, thread):
+    from basemap import mosaico
+    from server_tile_locale import avvia_server, provider_locale
+
+    server = avvia_server(latenza=latenza)
+    source = provider_locale(server)
+    xmin, ymin, xmax, ymax = 1005000, 5685000, 1045000, 5725000  # Milano, EPSG:3857
+    cartella = tempfile.mkdtemp(prefix="velox-tile-")
+    try:
+        risultati = {}
+        for nome, scaricatore in [("sequenza", ScaricatoreTile(thread=1)), ("concorrente", ScaricatoreTile(thread))]:
+            cache = TileCache(os.path.join(cartella, nome))
+            inizio = time.perf_counter()
+            img, _ = mosaico(xmin, ymin, xmax, ymax, zoom, source=source, cache=cache, scaricatore=scaricatore)
+            durata = time.perf_counter() - inizio
+            risultati[nome] = img
+            print(f"[i] {nome:11}: {cache.miss} tile in {durata:.2f}s ({cache.miss / durata:.0f} tile/s), "
+                  f"mosaico {img.shape[1]}x{img.shape[0]}")
+        print(f"[=] Mosaici identici: {np.array_equal(risultati['sequenza'], risultati['concorrente'])}, "
+              f"richieste al server: {server.richieste}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scarica in parallelo le tile di un piano di render nella cache")
+    parser.add_argument("geojson", nargs="?", help="confini delle unità (es. province.geojson)")
+    parser.add_argument("--zoom", type=int, nargs="+", default=[11])
+    parser.add_argument("--margine", type=float, default=0.15, help="frazione dell'estensione di ogni unità")
+    parser.add_argument("--thread", type=int, default=THREAD_TILE)
+    parser.add_argument("--prova", action="store_true", help="confronto sequenza/concorrente su un server locale")
+    parser.add_argument("--latenza", type=float, default=0.05, help="secondi per tile del server di --prova")
+    args = parser.parse_args()
+
+    if args.prova:
+        prova(args.latenza, args.zoom[0], args.thread)
+    elif args.geojson:
+        from basemap import SORGENTE_PREDEFINITA
+
+        tiles = tile_piano(args.geojson, args.zoom, args.margine)
+        scaricatore = ScaricatoreTile(args.thread)
+        cache = cache_predefinita()
+        inizio = time.perf_counter()
+        errori = scaricatore.precarica(SORGENTE_PREDEFINITA, tiles, cache)
+        print(f"[+] {len(tiles)} tile in {time.perf_counter() - inizio:.1f}s: {cache.hit} già in cache, "
+              f"{cache.miss - len(errori)} scaricate, {len(errori)} errori ({scaricatore.statistiche()['ripetute']} "
+              f"tentativi ripetuti)")
+        for tile, errore in list(errori.items())[:10]:
+            print(f"  [!] {tile.z}/{tile.x}/{tile.y}: {errore}")
+    else:
+        parser.error("indicare un geojson oppure --prova")
@@ -0,0 +1,87 @@
+import argparse
+import hashlib
+import io
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw
+from xyzservices import TileProvider
+
+# === Server di tile locale: sostituto deterministico di OpenStreetMap per prove e benchmark ===
+# Ogni tile /{z}/{x}/{y}.png è un PNG 256x256 con un colore ricavato da z/x/y e il bordo
+# disegnato, quindi le immagini generate sono identiche tra un'esecuzione e l'altra.
+TILE_SIZE = 256
+_PERCORSO_TILE = re.compile(r"^/(\d+)/(\d+)/(\d+)\.png$")
+
+
+def genera_tile(z, x, y):
+    colore = hashlib.md5(f"{z}/{x}/{y}".encode("ascii")).digest()[:3]
+    immagine = Image.new("RGB", (TILE_SIZE, TILE_SIZE), tuple(128 + c // 2 for c in colore))
+    ImageDraw.Draw(immagine).rectangle((0, 0, TILE_SIZE - 1, TILE_SIZE - 1), outline=(90, 90, 90))
+    buffer = io.BytesIO()
+    immagine.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class _GestoreTile(BaseHTTPRequestHandler):
+    def do_GET(self):
+        corrispondenza = _PERCORSO_TILE.match(self.path)
+        if not corrispondenza:
+            self.send_error(404)
+            return
+
+        if self.server.latenza:
+            time.sleep(self.server.latenza)
+        with self.server.lock:
+            self.server.richieste += 1
+            errore = self.server.richieste <= self.server.errori
+        if errore:
+            self.send_error(503)
+            return
+
+        dati = genera_tile(*(int(v) for v in corrispondenza.groups()))
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(dati)))
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def log_message(self, *args):
+        pass
+
+
+# === Avvia il server in un thread daemon; porta=0 sceglie una porta libera ===
+# latenza: secondi di attesa aggiunti a ogni risposta, per simulare la rete.
+# errori: numero di richieste iniziali che ricevono 503, per provare i nuovi tentativi.
+def avvia_server(porta=0, latenza=0.0, errori=0):
+    server = ThreadingHTTPServer(("127.0.0.1", porta), _GestoreTile)
+    server.daemon_threads = True
+    server.latenza = latenza
+    server.richieste = 0
+    server.errori = errori
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def provider_locale(server):
+    host, porta = server.server_address[:2]
+    return TileProvider(name="Locale", url=f"http://{host}:{porta}/{{z}}/{{x}}/{{y}}.png",
+                        attribution="Tile di prova", max_zoom=19)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server di tile locale per prove senza rete")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--latenza", type=float, default=0.0, help="secondi di ritardo per tile")
+    args = parser.parse_args()
+
+    server = avvia_server(args.porta, args.latenza)
+    print(f"[i] Tile su {provider_locale(server).url} (Ctrl+C per terminare)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
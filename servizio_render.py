@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import multiprocessing as mp
+
+import matplotlib
+
+from basemap import SORGENTE_PREDEFINITA
+from codifica import ESTENSIONI as FORMATI
+from confini import PIXEL_USCITA, carica_confini
+from manifest import impronta_render
+from marker_loader import DATA_FOLDER, normalizza_nome, trova_file_marker
+from varianti import Variante
+
+# === Servizio di rendering locale: import, confini e cache delle tile restano caldi ===
+# Uso:  python servizio_render.py --porta 8770
+#       curl -o bari.png 'http://127.0.0.1:8770/render?unita=Bari&estensione=marker&dpi=150'
+#       curl 'http://127.0.0.1:8770/stato'
+# Con --socket <percorso> ascolta su un socket Unix (curl --unix-socket <percorso> http://x/render?...).
+# I render girano in un pool di processi avviati una volta sola; le immagini già prodotte
+# sono servite da una cache LRU in memoria con chiave l'impronta degli input (marker,
+# confine, parametri, sorgente tile, icona), la stessa dei manifest delle build incrementali.
+GEOJSON_PATH = "province.geojson"
+CAMPO_NOME = "prov_name"
+PORTA = 8770
+WORKERS = 2  # processi di rendering (0 = tutti i core)
+CACHE_MB = 256  # immagini in memoria; oltre si eliminano quelle richieste meno di recente
+ICONA = "autovelox-icon.png"
+FIGSIZE = (8.75, 8.75)
+
+# Parametri accettati da /render, con il tipo: gli altri campi di Variante restano ai default
+PARAMETRI = {"estensione": str, "dpi": int, "zoom_mappa": int, "zoom_marker": float, "margine": float,
+             "ritaglio_px": int, "raggio_cluster": float, "formato": str, "compressione": int}
+ALIAS = {"zoom_mode": "estensione"}  # nome della costante negli script (ZOOM_MODE=marker)
+ESTENSIONI = ("marker", "provincia")
+DPI_MAX = 600
+TIPI = {".png": "image/png", ".webp": "image/webp"}
+
+# Catalogo confini del processo worker
+_confini = None
+
+
+class RichiestaNonValida(Exception):
+    pass
+
+
+# Unità non presente nel catalogo confini (404); ogni altra eccezione del render è un 500
+class UnitaSconosciuta(Exception):
+    pass
+
+
+# === Inizializzazione del worker: backend headless, librerie importate e catalogo in memoria ===
+def _inizializza_worker(geojson_path, pixel_uscita):
+    global _confini
+    matplotlib.use("Agg")
+    import varianti  # noqa: F401  (matplotlib, contextily, marker_batch, cluster)
+    from contesto_render import figura
+    _confini = carica_confini(geojson_path, pixel_uscita)
+    figura(FIGSIZE)[0].canvas.draw()  # carica font e renderer prima della prima richiesta
+
+
+# === Render di una variante nel worker: restituisce i byte dell'immagine, None senza marker ===
+def _renderizza(indice, variante, data_folder):
+    from codifica import attendi_codifiche
+    from marker_loader import carica_marker
+    from varianti import renderizza_varianti
+
+    unita = _confini.iloc[indice]
+    nome = unita[CAMPO_NOME].lower()
+    marker_gdf = carica_marker(nome, data_folder)
+    if marker_gdf is None:
+        return None
+    marker = marker_gdf.to_crs(epsg=3857)
+
+    with tempfile.TemporaryDirectory(prefix="velox-") as cartella:
+        percorso, = renderizza_varianti(unita, marker.geometry.x.values, marker.geometry.y.values,
+                                        [variante._replace(cartella=cartella)], "render", figsize=FIGSIZE)
+        errori = attendi_codifiche([percorso])
+        if errori:
+            raise RuntimeError(next(iter(errori.values())))
+        with open(percorso, "rb") as fh:
+            return fh.read()
+
+
+# === Cache LRU delle immagini, limitata in byte ===
+class CacheImmagini:
+    def __init__(self, max_mb=CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.bytes = 0
+        self.hit = 0
+        self.miss = 0
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+
+    def leggi(self, chiave):
+        with self._lock:
+            dati = self._voci.get(chiave)
+            if dati is None:
+                self.miss += 1
+                return None
+            self._voci.move_to_end(chiave)
+            self.hit += 1
+            return dati
+
+    def scrivi(self, chiave, dati):
+        if len(dati) > self.max_bytes:
+            return
+        with self._lock:
+            if chiave in self._voci:
+                return
+            self._voci[chiave] = dati
+            self.bytes += len(dati)
+            while self.bytes > self.max_bytes:
+                _, vecchia = self._voci.popitem(last=False)
+                self.bytes -= len(vecchia)
+
+    def statistiche(self):
+        with self._lock:
+            return {"immagini": len(self._voci), "mb": round(self.bytes / 1024 / 1024, 1),
+                    "hit": self.hit, "miss": self.miss}
+
+
+# === Stato del servizio: catalogo, pool di worker, cache e render in corso ===
+# Richieste uguali arrivate insieme attendono lo stesso render invece di ripeterlo.
+class ServizioRender:
+    def __init__(self, geojson_path=GEOJSON_PATH, data_folder=DATA_FOLDER, workers=WORKERS, cache_mb=CACHE_MB,
+                 pixel_uscita=PIXEL_USCITA):
+        self.geojson_path = geojson_path
+        self.data_folder = data_folder
+        self.workers = workers or os.cpu_count() or 1
+        self.pixel_uscita = pixel_uscita
+        self.cache = CacheImmagini(cache_mb)
+
+        # Il catalogo viene (ri)costruito qui, una volta: i worker lo trovano già in cache
+        self.confini = carica_confini(geojson_path, pixel_uscita)
+        self.indici = {normalizza_nome(nome): i for i, nome in enumerate(self.confini[CAMPO_NOME])}
+        self._in_corso = {}
+        self._lock = threading.RLock()  # il callback di fine render può girare nel thread che ha appena inviato
+        self._pool = None
+        self._avvia_pool()
+
+    def _avvia_pool(self):
+        # "spawn" come in render_parallelo: nessuno stato pyplot ereditato, stesso comportamento su Windows
+        os.environ.setdefault("MPLBACKEND", "Agg")
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp.get_context("spawn"),
+                                         initializer=_inizializza_worker,
+                                         initargs=(self.geojson_path, self.pixel_uscita))
+        # Avvia subito i processi (e i loro import), non alla prima richiesta
+        for future in [self._pool.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def chiudi(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    # === Variante dai parametri della richiesta (valori come liste, da parse_qs) ===
+    def variante(self, parametri):
+        valori = {}
+        for nome, valore in parametri.items():
+            if nome == "unita":
+                continue
+            nome = ALIAS.get(nome.lower(), nome)
+            if nome not in PARAMETRI:
+                raise RichiestaNonValida(f"parametro sconosciuto: {nome}")
+            try:
+                valori[nome] = PARAMETRI[nome](valore[-1])
+            except ValueError:
+                raise RichiestaNonValida(f"valore non valido per {nome}: {valore[-1]}") from None
+        if valori.get("estensione", "provincia") not in ESTENSIONI:
+            raise RichiestaNonValida(f"estensione deve essere una tra {', '.join(ESTENSIONI)}")
+        if valori.get("formato", "png") not in FORMATI:
+            raise RichiestaNonValida(f"formato deve essere uno tra {', '.join(FORMATI)}")
+        if not 0 < valori.get("dpi", 300) <= DPI_MAX:
+            raise RichiestaNonValida(f"dpi deve essere tra 1 e {DPI_MAX}")
+        return Variante("servizio", None, icona=ICONA, **valori)
+
+    # === Immagine di un'unità: (byte, da_cache); None se l'unità non ha marker ===
+    def render(self, nome_unita, variante):
+        indice = self.indici.get(normalizza_nome(nome_unita))
+        if indice is None:
+            raise UnitaSconosciuta(nome_unita)
+        unita = self.confini.iloc[indice]
+
+        chiave = impronta_render(trova_file_marker(unita[CAMPO_NOME].lower(), self.data_folder), unita.geometry,
+                                 {"variante": variante._asdict(), "figsize": FIGSIZE}, SORGENTE_PREDEFINITA,
+                                 file_extra=(variante.icona,))
+        if chiave is None:
+            return None  # nessun file marker
+        dati = self.cache.leggi(chiave)
+        if dati is not None:
+            return dati, True
+
+        with self._lock:
+            future = self._in_corso.get(chiave)
+            pool = self._pool
+            if future is None:
+                future = pool.submit(_renderizza, indice, variante, self.data_folder)
+                self._in_corso[chiave] = future
+                future.add_done_callback(lambda _: self._termina(chiave))
+        try:
+            dati = future.result()
+        except BrokenProcessPool:
+            # Un worker è terminato in modo anomalo (es. memoria esaurita): nuovo pool per le richieste successive
+            with self._lock:
+                if self._pool is pool:
+                    print("[!] Pool di rendering interrotto, riavvio dei worker")
+                    self._pool.shutdown(wait=False)
+                    self._avvia_pool()
+            raise
+        if dati is None:
+            return None
+        self.cache.scrivi(chiave, dati)
+        return dati, False
+
+    def _termina(self, chiave):
+        with self._lock:
+            self._in_corso.pop(chiave, None)
+
+    def stato(self):
+        return {"unita": len(self.indici), "workers": self.workers, "render_in_corso": len(self._in_corso),
+                "cache": self.cache.statistiche()}
+
+
+class _GestoreRender(BaseHTTPRequestHandler):
+    def do_GET(self):
+        indirizzo = urlsplit(self.path)
+        if indirizzo.path == "/stato":
+            self._rispondi(200, json.dumps(self.server.servizio.stato()).encode("utf-8"), "application/json")
+            return
+        if indirizzo.path != "/render":
+            self._rispondi(404, b"percorsi: /render?unita=<nome>&..., /stato\n")
+            return
+
+        parametri = parse_qs(indirizzo.query)
+        nome = (parametri.get("unita") or [""])[-1]
+        inizio = time.perf_counter()
+        try:
+            if not nome:
+                raise RichiestaNonValida("parametro unita mancante")
+            variante = self.server.servizio.variante(parametri)
+            risultato = self.server.servizio.render(nome, variante)
+        except RichiestaNonValida as errore:
+            self._rispondi(400, f"{errore}\n".encode("utf-8"))
+            return
+        except UnitaSconosciuta:
+            self._rispondi(404, f"unità sconosciuta: {nome}\n".encode("utf-8"))
+            return
+        except Exception as errore:
+            print(f"  [!] {nome}: {type(errore).__name__}: {errore}")
+            self._rispondi(500, f"errore di rendering: {type(errore).__name__}\n".encode("utf-8"))
+            return
+        if risultato is None:
+            self._rispondi(404, f"nessun marker per {nome}\n".encode("utf-8"))
+            return
+
+        dati, da_cache = risultato
+        durata = time.perf_counter() - inizio
+        print(f"  [{'=' if da_cache else '+'}] {nome} {indirizzo.query} ({durata:.2f}s{', cache' if da_cache else ''})")
+        self._rispondi(200, dati, TIPI[FORMATI[variante.formato]], {"X-Velox-Cache": "hit" if da_cache else "miss"})
+
+    def _rispondi(self, codice, dati, tipo="text/plain; charset=utf-8", intestazioni=None):
+        self.send_response(codice)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dati)))
+        for nome, valore in (intestazioni or {}).items():
+            self.send_header(nome, valore)
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ServerUnix(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        richiesta, _ = super().get_request()
+        return richiesta, ("unix", 0)  # BaseHTTPRequestHandler si aspetta (host, porta)
+
+
+# === Server HTTP (TCP su 127.0.0.1 o socket Unix) davanti al servizio ===
+def avvia_server(servizio, porta=PORTA, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # socket rimasto da un'esecuzione precedente
+        server = _ServerUnix(socket_path, _GestoreRender)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", porta), _GestoreRender)
+        server.daemon_threads = True
+    server.servizio = servizio
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servizio di rendering delle mappe con cache dei risultati")
+    parser.add_argument("--porta", type=int, default=PORTA)
+    parser.add_argument("--socket", help="percorso di un socket Unix al posto della porta TCP")
+    parser.add_argument("--geojson", default=GEOJSON_PATH)
+    parser.add_argument("--marker", default=DATA_FOLDER, help="cartella dei file marker")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processi di rendering (0 = tutti i core)")
+    parser.add_argument("--cache-mb", type=float, default=CACHE_MB)
+    args = parser.parse_args()
+
+    inizio = time.perf_counter()
+    servizio = ServizioRender(args.geojson, args.marker, args.workers, args.cache_mb)
+    server = avvia_server(servizio, args.porta, args.socket)
+    dove = args.socket or f"http://127.0.0.1:{args.porta}"
+    print(f"[i] {len(servizio.indici)} unità, {servizio.workers} worker pronti in {time.perf_counter() - inizio:.1f}s")
+    print(f"[i] In ascolto su {dove} (/render?unita=<nome>&estensione=marker&dpi=150, /stato; Ctrl+C per terminare)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        servizio.chiudi()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
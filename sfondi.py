@@ -0,0 +1,132 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import shapely
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.figure import Figure
+from matplotlib.transforms import Affine2D, Bbox
+
+from codifica import PAD_INCHES, rasterizza
+from file_util import scrivi_atomico
+from manifest import VERSIONE_RENDER, impronta_file_cached
+from marker_batch import MarkerBatch, carica_icona
+from strumentazione import conta, fase
+
+# === Costanti ===
+SFONDI_DIR = os.environ.get("VELOX_SFONDI", "sfondi_cache")
+VERSIONE_SFONDI = 1  # da incrementare quando cambia il formato dei file o la composizione
+
+# Figure vuote per dpi: servono solo ai testi dei cluster (metriche del font), mai disegnate
+_figure_testo = {}
+
+
+# === Chiave dello sfondo di un'unità ===
+# Tutto ciò che cambia i pixel di basemap e confine: geometria, limiti degli assi,
+# impostazioni (figsize, dpi, zoom, stile del confine, ...), sorgente delle tile e file il cui
+# contenuto conta (lo script che disegna). Non i marker: sono l'unica parte ricomposta.
+def chiave_sfondo(confine, limiti, impostazioni, sorgente_tile, file_extra=()):
+    sha1 = hashlib.sha1(f"v{VERSIONE_RENDER}.{VERSIONE_SFONDI}".encode("ascii"))
+    sha1.update(shapely.to_wkb(confine))
+    sha1.update(json.dumps([[float(v) for v in limiti], impostazioni], sort_keys=True, default=str).encode("utf-8"))
+    sha1.update(str(sorgente_tile.get("url") if isinstance(sorgente_tile, dict) else sorgente_tile).encode("utf-8"))
+    for percorso in file_extra:
+        sha1.update(impronta_file_cached(percorso).encode("ascii"))
+    return sha1.hexdigest()
+
+
+def _percorsi(cartella, nome, chiave):
+    base = os.path.join(cartella, f"{nome}.{chiave[:16]}")
+    return base + ".npy", base + ".json"
+
+
+# === Sfondo rasterizzato di un'unità: pixel RGBA (mappati da disco) e trasformazione dati -> pixel ===
+# rgba: immagine già ritagliata come il file di uscita (righe dall'alto); finestra: (riga,
+# colonna) del ritaglio nel buffer della figura intera; figura: (larghezza, altezza) in pixel;
+# trasformazione: matrice affine 3x3 di ax.transData al dpi di uscita; riquadro: bbox degli
+# assi in pixel display (visibilità e ritaglio dei marker).
+class Sfondo:
+    def __init__(self, rgba, finestra, figura, trasformazione, riquadro, dpi):
+        self.rgba = rgba
+        self.finestra = tuple(finestra)
+        self.figura = tuple(figura)
+        self.trasformazione = np.asarray(trasformazione, dtype=float)
+        self.riquadro = np.asarray(riquadro, dtype=float)
+        self.dpi = dpi
+
+    # === Marker sopra lo sfondo: stesso disegno di imscatter negli assi, senza figura né tile ===
+    # Il buffer di un RendererAgg grande quanto la figura riceve lo sfondo nella sua finestra;
+    # MarkerBatch disegna con la trasformazione e il riquadro salvati, poi si ritaglia. Le
+    # icone cadono sugli stessi pixel del render completo, quindi l'immagine è identica.
+    @fase("composizione")
+    def componi(self, x, y, image_path, zoom=0.015, raggio_cluster=None, zorder=10):
+        larghezza, altezza = self.figura
+        riga, colonna = self.finestra
+        lato_y, lato_x = self.rgba.shape[:2]
+        renderer = RendererAgg(larghezza, altezza, self.dpi)
+        buffer = np.asarray(renderer.buffer_rgba())
+        buffer[riga:riga + lato_y, colonna:colonna + lato_x] = self.rgba
+
+        if os.path.exists(image_path):
+            marker = MarkerBatch(x, y, carica_icona(image_path), zoom=zoom, zorder=zorder,
+                                 raggio_cluster=raggio_cluster)
+            if self.dpi not in _figure_testo:
+                _figure_testo[self.dpi] = Figure(dpi=self.dpi)
+            marker.set_figure(_figure_testo[self.dpi])
+            marker.set_transform(Affine2D(self.trasformazione))
+            marker.set_clip_box(Bbox(self.riquadro.reshape(2, 2)))
+            marker.draw(renderer)
+        else:
+            print(f"[!] Icona marker non trovata: {image_path}")
+        return buffer[riga:riga + lato_y, colonna:colonna + lato_x].copy()
+
+
+# === Sfondo salvato per (nome, chiave), oppure None ===
+# Il file .json è scritto per ultimo: se c'è, anche i pixel sono completi.
+def carica_sfondo(cartella, nome, chiave):
+    percorso_pixel, percorso_meta = _percorsi(cartella, nome, chiave)
+    try:
+        with open(percorso_meta, encoding="utf-8") as fh:
+            meta = json.load(fh)
+        rgba = np.load(percorso_pixel, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta.get("chiave") != chiave:
+        return None
+    conta("sfondo_da_cache")
+    return Sfondo(rgba, meta["finestra"], meta["figura"], meta["trasformazione"], meta["riquadro"], meta["dpi"])
+
+
+# === Rasterizza la figura (basemap e confine, senza marker) e la salva come sfondo ===
+# Un solo disegno, come codifica.salva: la trasformazione degli assi è letta subito dopo,
+# quando figura e assi sono ancora al dpi di uscita. Gli sfondi precedenti della stessa
+# unità (chiavi diverse) vengono eliminati; cartella None = sfondo solo in memoria.
+@fase("sfondo")
+def salva_sfondo(fig, ax, cartella, nome, chiave, dpi, bbox_inches="tight", pad_inches=PAD_INCHES):
+    dpi_originale = fig.dpi
+    fig.set_dpi(dpi)
+    try:
+        rgba, finestra = rasterizza(fig, dpi, bbox_inches, pad_inches, finestra=True)
+        altezza, larghezza = np.asarray(fig.canvas.buffer_rgba()).shape[:2]  # buffer della figura intera
+        if not ax.transData.is_affine:
+            raise ValueError("scala degli assi non lineare: lo sfondo non si può ricomporre")
+        trasformazione = ax.transData.get_matrix()
+        riquadro = ax.bbox.extents
+    finally:
+        fig.set_dpi(dpi_originale)
+    meta = {"chiave": chiave, "finestra": [int(v) for v in finestra], "figura": [larghezza, altezza],
+            "trasformazione": trasformazione.tolist(), "riquadro": riquadro.tolist(), "dpi": dpi}
+    if cartella is None:
+        return Sfondo(rgba, meta["finestra"], meta["figura"], meta["trasformazione"], meta["riquadro"], dpi)
+
+    os.makedirs(cartella, exist_ok=True)
+    percorso_pixel, percorso_meta = _percorsi(cartella, nome, chiave)
+    for vecchio in glob.glob(os.path.join(glob.escape(cartella), f"{glob.escape(nome)}.*.*")):
+        if vecchio not in (percorso_pixel, percorso_meta) and vecchio.endswith((".npy", ".json")):
+            os.remove(vecchio)
+    scrivi_atomico(percorso_pixel, lambda fh: np.save(fh, rgba))
+    contenuto = json.dumps(meta).encode("utf-8")
+    scrivi_atomico(percorso_meta, lambda fh: fh.write(contenuto))
+    return Sfondo(rgba, meta["finestra"], meta["figura"], meta["trasformazione"], meta["riquadro"], dpi)
@@ -0,0 +1,338 @@
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+from basemap import MAX_TILE_RENDER, numero_tile, pianifica_zoom
+from file_util import scrivi_atomico
+from marker_loader import DATA_FOLDER, coordinate_marker, trova_file_marker
+
+# === Costanti ===
+SHARD_ENV = os.environ.get("VELOX_SHARD")  # "i/N": esegue solo lo shard i (1..N) del batch; None = tutte le unità
+PIANO_PATH = os.environ.get("VELOX_PIANO")  # piano salvato: letto se esiste, altrimenti scritto dal primo shard
+SOLO_PIANO = os.environ.get("VELOX_SOLO_PIANO") == "1"  # stampa il piano senza renderizzare (shard.py piano)
+RAPPORTI_DIR = os.environ.get("VELOX_RAPPORTI", "rapporti_shard")  # un rapporto JSON per shard, letti da unisci()
+VERSIONE_PIANO = 1
+
+# Stima del costo di un'unità in secondi, dalle metriche di prov.py/province.py a cache di tile calda:
+# disegno e codifica crescono con i pixel di uscita, la basemap con le tile, le icone con i marker
+COSTO_UNITA = 0.1  # figura, confine, impronta; anche le unità senza file marker (saltate)
+COSTO_TILE = 0.005
+COSTO_MARKER = 2e-5
+COSTO_MEGAPIXEL = 0.3
+
+# === Lavoro di render di un'unità: indice nel catalogo confini, nome e costo stimato ===
+LavoroRender = namedtuple("LavoroRender", ["indice", "nome", "marker", "tile", "megapixel", "costo"])
+
+# === Piano del batch: lavori, impostazioni della stima e shard (1..N) assegnato a ogni lavoro ===
+# impronta: hash di unità e assegnazione, uguale su ogni nodo che calcola lo stesso piano;
+# unisci() la usa per rifiutare rapporti di piani diversi.
+Piano = namedtuple("Piano", ["script", "impostazioni", "numero_shard", "lavori", "shard_di", "impronta"])
+
+
+# === "i/N" -> (i, N), con 1 <= i <= N ===
+def leggi_shard(testo):
+    try:
+        numero, numero_shard = (int(parte) for parte in testo.split("/"))
+    except ValueError:
+        raise ValueError(f"shard non valido: {testo!r} (atteso i/N, es. 2/4)") from None
+    if not 1 <= numero <= numero_shard:
+        raise ValueError(f"shard non valido: {testo!r} (i tra 1 e N)")
+    return numero, numero_shard
+
+
+SHARD = leggi_shard(SHARD_ENV) if SHARD_ENV else None
+
+
+# === Lavori del batch con il costo stimato, senza disegnare né scaricare nulla ===
+# impostazioni: data_folder (marker), zoom_mappa e max_tile (tile come pianifica_zoom),
+# uscite (immagini per unità, es. varianti). Marker contati dalla cache di marker_loader.
+def stima_lavori(confini, campo_nome, pixel_uscita, impostazioni=None):
+    impostazioni = {"data_folder": DATA_FOLDER, "zoom_mappa": None, "max_tile": MAX_TILE_RENDER, "uscite": 1,
+                    **(impostazioni or {})}
+    megapixel = pixel_uscita * pixel_uscita * impostazioni["uscite"] / 1e6
+    lavori = []
+    for indice, unita in enumerate(confini.itertuples(index=False)):
+        nome = getattr(unita, campo_nome)
+        percorso = trova_file_marker(nome.lower(), impostazioni["data_folder"])
+        if percorso is None:
+            lavori.append(LavoroRender(indice, nome, 0, 0, 0.0, COSTO_UNITA))
+            continue
+        try:
+            marker = len(coordinate_marker(percorso))
+        except (ValueError, OSError):
+            marker = 0
+        estensione = (unita.xmin, unita.ymin, unita.xmax, unita.ymax)
+        if impostazioni["zoom_mappa"] is None:
+            tile = pianifica_zoom(*estensione, pixel_uscita, pixel_uscita, max_tile=impostazioni["max_tile"]).tile
+        else:
+            tile = numero_tile(*estensione, impostazioni["zoom_mappa"])
+        costo = COSTO_UNITA + tile * COSTO_TILE + marker * COSTO_MARKER + megapixel * COSTO_MEGAPIXEL
+        lavori.append(LavoroRender(indice, nome, marker, tile, round(megapixel, 3), round(costo, 3)))
+    return lavori
+
+
+# === Shard (1..N) di ogni lavoro: il più costoso non ancora assegnato va allo shard più scarico ===
+# Ordine per costo e poi per nome, parità risolte dallo shard con il numero più basso: ogni
+# nodo ottiene la stessa assegnazione dagli stessi input, senza coordinarsi.
+def suddividi(lavori, numero_shard):
+    shard_di = [0] * len(lavori)
+    carichi = [(0.0, numero) for numero in range(1, numero_shard + 1)]
+    for lavoro in sorted(lavori, key=lambda lavoro: (-lavoro.costo, lavoro.nome)):
+        carico, numero = heapq.heappop(carichi)
+        shard_di[lavoro.indice] = numero
+        heapq.heappush(carichi, (carico + lavoro.costo, numero))
+    return shard_di
+
+
+def _impronta(lavori, shard_di, numero_shard):
+    sha1 = hashlib.sha1(f"v{VERSIONE_PIANO}.{numero_shard}".encode("ascii"))
+    sha1.update(json.dumps([[lavoro.nome, shard] for lavoro, shard in zip(lavori, shard_di)]).encode("utf-8"))
+    return sha1.hexdigest()
+
+
+def _salva_piano(piano, percorso):
+    cartella = os.path.dirname(percorso)
+    if cartella:
+        os.makedirs(cartella, exist_ok=True)
+    salvato = {"versione": VERSIONE_PIANO, **piano._asdict(), "lavori": [lavoro._asdict() for lavoro in piano.lavori]}
+    contenuto = json.dumps(salvato, indent=2, ensure_ascii=False).encode("utf-8")
+    scrivi_atomico(percorso, lambda fh: fh.write(contenuto))
+
+
+def _leggi_piano(percorso, confini, campo_nome, numero_shard):
+    with open(percorso, encoding="utf-8") as fh:
+        salvato = json.load(fh)
+    lavori = [LavoroRender(**lavoro) for lavoro in salvato["lavori"]]
+    if salvato.get("versione") != VERSIONE_PIANO or salvato["numero_shard"] != numero_shard:
+        raise ValueError(f"piano {percorso}: {salvato['numero_shard']} shard, richiesti {numero_shard}")
+    if [lavoro.nome for lavoro in lavori] != confini[campo_nome].tolist():
+        raise ValueError(f"piano {percorso}: le unità non corrispondono al GeoJSON")
+    return Piano(salvato["script"], salvato["impostazioni"], numero_shard, lavori, salvato["shard_di"],
+                 salvato["impronta"])
+
+
+# === Piano del batch in numero_shard shard: dal file percorso se esiste, altrimenti stimato ===
+# Con percorso indicato e file assente il piano stimato viene salvato: i nodi che lo
+# ricevono eseguono la stessa assegnazione anche se i loro marker differiscono.
+def piano_shard(confini, campo_nome, pixel_uscita, impostazioni, numero_shard, script=None, percorso=PIANO_PATH):
+    if percorso and os.path.exists(percorso):
+        return _leggi_piano(percorso, confini, campo_nome, numero_shard)
+    lavori = stima_lavori(confini, campo_nome, pixel_uscita, impostazioni)
+    shard_di = suddividi(lavori, numero_shard)
+    piano = Piano(script, {"pixel_uscita": pixel_uscita, **(impostazioni or {})}, numero_shard, lavori, shard_di,
+                  _impronta(lavori, shard_di, numero_shard))
+    if percorso:
+        _salva_piano(piano, percorso)
+    return piano
+
+
+def indici_shard(piano, numero):
+    return [lavoro.indice for lavoro, shard in zip(piano.lavori, piano.shard_di) if shard == numero]
+
+
+def carichi_shard(piano):
+    carichi = [0.0] * piano.numero_shard
+    for lavoro, shard in zip(piano.lavori, piano.shard_di):
+        carichi[shard - 1] += lavoro.costo
+    return carichi
+
+
+def stampa_piano(piano):
+    carichi = carichi_shard(piano)
+    media = sum(carichi) / len(carichi)
+    print(f"[i] Piano {piano.impronta[:12]}: {len(piano.lavori)} unità in {piano.numero_shard} shard, "
+          f"costo stimato {sum(carichi):.1f}s, massimo/medio {max(carichi) / media if media else 1:.2f}")
+    for numero, carico in enumerate(carichi, start=1):
+        lavori = [lavoro for lavoro, shard in zip(piano.lavori, piano.shard_di) if shard == numero]
+        print(f"  [=] Shard {numero}/{piano.numero_shard}: {len(lavori)} unità, {carico:.1f}s stimati, "
+              f"{sum(lavoro.marker for lavoro in lavori)} marker, {sum(lavoro.tile for lavoro in lavori)} tile")
+
+
+def _nome_rapporto(script, numero, numero_shard):
+    return f"{os.path.splitext(os.path.basename(script or 'batch'))[0]}.shard-{numero}-di-{numero_shard}.json"
+
+
+# === Rapporto di uno shard: piano, nodo, durata ed esiti con le metriche di ogni unità ===
+def scrivi_rapporto(piano, numero, esiti, inizio, durata, cartella=RAPPORTI_DIR):
+    os.makedirs(cartella, exist_ok=True)
+    percorso = os.path.join(cartella, _nome_rapporto(piano.script, numero, piano.numero_shard))
+    rapporto = {"script": piano.script, "shard": numero, "numero_shard": piano.numero_shard,
+                "impronta_piano": piano.impronta, "nodo": platform.node(), "pid": os.getpid(),
+                "inizio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(inizio)), "durata": round(durata, 3),
+                "costo_stimato": round(carichi_shard(piano)[numero - 1], 3),
+                "lavori": [piano.lavori[indice].nome for indice in indici_shard(piano, numero)],
+                "esiti": [esito._asdict() for esito in esiti]}
+    contenuto = json.dumps(rapporto, indent=2, ensure_ascii=False).encode("utf-8")
+    scrivi_atomico(percorso, lambda fh: fh.write(contenuto))
+    return percorso
+
+
+# === Unisce gli shard: rapporti, immagini e manifest nella cartella di destinazione ===
+# radici: cartelle di lavoro dei nodi (ognuna con RAPPORTI_DIR e le immagini prodotte, con
+# gli stessi percorsi relativi); "." se gli shard hanno girato nella stessa cartella.
+# Le immagini sono copiate in destinazione se stanno altrove; i manifest di destinazione
+# ricevono le impronte di tutti gli shard (la build incrementale vale anche senza shard).
+def unisci(radici, destinazione=".", script=None):
+    from manifest import registra_esiti
+    from render_parallelo import EsitoRender
+    from strumentazione import riepiloga
+
+    rapporti = []
+    for radice in radici:
+        cartella = os.path.join(radice, RAPPORTI_DIR)
+        if not os.path.isdir(cartella):
+            print(f"[!] Nessun rapporto in {cartella}")
+            continue
+        for nome in sorted(os.listdir(cartella)):
+            if ".shard-" not in nome or not nome.endswith(".json"):
+                continue
+            with open(os.path.join(cartella, nome), encoding="utf-8") as fh:
+                rapporto = json.load(fh)
+            if script is None or rapporto["script"] == os.path.basename(script):
+                rapporti.append((radice, rapporto))
+    if not rapporti:
+        raise ValueError(f"nessun rapporto di shard in {', '.join(radici)}")
+    piani = {(rapporto["script"], rapporto["impronta_piano"]) for _, rapporto in rapporti}
+    if len(piani) > 1:
+        raise ValueError("rapporti di piani diversi (script o assegnazione): "
+                         + ", ".join(f"{script} {impronta[:12]}" for script, impronta in sorted(piani)))
+
+    rapporti.sort(key=lambda voce: voce[1]["shard"])
+    numero_shard = rapporti[0][1]["numero_shard"]
+    presenti = [rapporto["shard"] for _, rapporto in rapporti]
+    doppi = sorted({numero for numero in presenti if presenti.count(numero) > 1})
+    if doppi:
+        raise ValueError(f"shard presenti in più radici: {doppi}")
+    mancanti = sorted(set(range(1, numero_shard + 1)) - set(presenti))
+
+    esiti, copiate = [], 0
+    for radice, rapporto in rapporti:
+        for voce in rapporto["esiti"]:
+            esito = EsitoRender(**voce)
+            if esito.output and esito.stato in ("ok", "invariata"):
+                uscite = []
+                for output in (esito.output if isinstance(esito.output, list) else [esito.output]):
+                    sorgente, arrivo = os.path.join(radice, output), os.path.join(destinazione, output)
+                    if os.path.exists(sorgente) and not (os.path.exists(arrivo) and os.path.samefile(sorgente, arrivo)):
+                        os.makedirs(os.path.dirname(arrivo) or ".", exist_ok=True)
+                        shutil.copy2(sorgente, arrivo)
+                        copiate += 1
+                    uscite.append(arrivo)
+                esito = esito._replace(output=uscite if isinstance(esito.output, list) else uscite[0])
+            esiti.append(esito)
+    registra_esiti(esiti)
+
+    durate = [rapporto["durata"] for _, rapporto in rapporti]
+    print(f"[i] {len(rapporti)}/{numero_shard} shard di {rapporti[0][1]['script']} "
+          f"(piano {rapporti[0][1]['impronta_piano'][:12]}), {copiate} immagini copiate in {destinazione}")
+    for _, rapporto in rapporti:
+        stati = [voce["stato"] for voce in rapporto["esiti"]]
+        interrotte = len(rapporto["lavori"]) - len(stati)
+        print(f"  [=] Shard {rapporto['shard']}/{numero_shard} su {rapporto['nodo']}: {len(rapporto['lavori'])} unità "
+              f"in {rapporto['durata']:.1f}s (stimati {rapporto['costo_stimato']:.1f}s), "
+              f"errori {stati.count('errore')}" + (f", {interrotte} non eseguite" if interrotte else ""))
+    print(f"[i] Durata: shard più lento {max(durate):.1f}s, medio {sum(durate) / len(durate):.1f}s "
+          f"(massimo/medio {max(durate) / max(sum(durate) / len(durate), 1e-9):.2f}), somma {sum(durate):.1f}s")
+    conteggi = {stato: sum(1 for e in esiti if e.stato == stato) for stato in ("ok", "invariata", "saltata", "errore")}
+    print(f"[i] Ricostruite: {conteggi['ok']}, invariate: {conteggi['invariata']}, "
+          f"saltate: {conteggi['saltata']}, errori: {conteggi['errore']}")
+    for numero in mancanti:
+        print(f"  [!] Shard mancante: {numero}/{numero_shard}")
+    for esito in esiti:
+        if esito.stato == "errore":
+            print(f"  [!] Fallita: {esito.nome}")
+    riepiloga(esiti, profili_lenti=len(esiti))  # i profili restano sui nodi, già ridotti dagli shard
+
+    os.makedirs(os.path.join(destinazione, RAPPORTI_DIR), exist_ok=True)
+    unito = {"script": rapporti[0][1]["script"], "impronta_piano": rapporti[0][1]["impronta_piano"],
+             "numero_shard": numero_shard, "mancanti": mancanti,
+             "shard": [{chiave: valore for chiave, valore in rapporto.items() if chiave not in ("lavori", "esiti")}
+                       for _, rapporto in rapporti],
+             "esiti": [esito._asdict() for esito in esiti]}
+    percorso = os.path.join(destinazione, RAPPORTI_DIR,
+                            f"{os.path.splitext(rapporti[0][1]['script'])[0]}.unito.json")
+    contenuto = json.dumps(unito, indent=2, ensure_ascii=False).encode("utf-8")
+    scrivi_atomico(percorso, lambda fh: fh.write(contenuto))
+    print(f"[+] Rapporto unito: {percorso}")
+    return esiti
+
+
+def _ambiente(shard, piano=None, solo_piano=False):
+    ambiente = dict(os.environ, VELOX_SHARD=shard)
+    if piano:
+        ambiente["VELOX_PIANO"] = piano
+    if solo_piano:
+        ambiente["VELOX_SOLO_PIANO"] = "1"
+    return ambiente
+
+
+# === Esegue uno shard dello script (prov.py, province.py, ...) in un processo figlio ===
+def esegui(script, shard, piano=None):
+    leggi_shard(shard)
+    return subprocess.run([sys.executable, script], env=_ambiente(shard, piano)).returncode
+
+
+# === Prova locale: numero_shard processi al posto dei nodi, nella cartella corrente, poi unisci() ===
+def prova(script, numero_shard, piano=None):
+    os.makedirs(RAPPORTI_DIR, exist_ok=True)
+    if piano and not os.path.exists(piano):
+        # Piano scritto una volta prima di avviare gli shard, che poi lo leggono
+        subprocess.run([sys.executable, script], env=_ambiente(f"1/{numero_shard}", piano, solo_piano=True), check=True)
+
+    inizio = time.perf_counter()
+    processi = []
+    for numero in range(1, numero_shard + 1):
+        shard = f"{numero}/{numero_shard}"
+        log = open(os.path.join(RAPPORTI_DIR, _nome_rapporto(script, numero, numero_shard)[:-5] + ".log"), "w",
+                   encoding="utf-8")
+        processi.append((shard, log, subprocess.Popen([sys.executable, script], env=_ambiente(shard, piano),
+                                                      stdout=log, stderr=subprocess.STDOUT)))
+    for shard, log, processo in processi:
+        codice = processo.wait()
+        log.close()
+        if codice:
+            print(f"[!] Shard {shard} terminato con codice {codice} (log: {log.name})")
+    print(f"[i] {numero_shard} shard completati in {time.perf_counter() - inizio:.1f}s")
+    return unisci(["."], script=script)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Suddivisione del batch di render in shard indipendenti")
+    comandi = parser.add_subparsers(dest="comando", required=True)
+    comando = comandi.add_parser("piano", help="stima i costi e stampa l'assegnazione (--piano la salva)")
+    comando.add_argument("script")
+    comando.add_argument("-n", "--shard", type=int, required=True, help="numero di shard")
+    comando.add_argument("--piano", help="file del piano da scrivere, da passare ai nodi")
+    comando = comandi.add_parser("esegui", help="esegue uno shard dello script su questo nodo")
+    comando.add_argument("script")
+    comando.add_argument("--shard", required=True, help="i/N, es. 2/4")
+    comando.add_argument("--piano", help="piano salvato (altrimenti stimato su questo nodo)")
+    comando = comandi.add_parser("unisci", help="unisce rapporti, immagini e manifest degli shard")
+    comando.add_argument("radici", nargs="*", default=["."], help="cartelle di lavoro dei nodi")
+    comando.add_argument("--destinazione", default=".")
+    comando.add_argument("--script", help="solo i rapporti di questo script")
+    comando = comandi.add_parser("prova", help="N processi locali al posto dei nodi, poi unisci")
+    comando.add_argument("script")
+    comando.add_argument("-n", "--shard", type=int, required=True, help="numero di shard")
+    comando.add_argument("--piano", help="file del piano condiviso dagli shard")
+    args = parser.parse_args()
+
+    if args.comando == "piano":
+        if args.piano and os.path.exists(args.piano):
+            os.remove(args.piano)  # si ristima: il piano esistente verrebbe solo riletto
+        sys.exit(subprocess.run([sys.executable, args.script],
+                                env=_ambiente(f"1/{args.shard}", args.piano, solo_piano=True)).returncode)
+    elif args.comando == "esegui":
+        sys.exit(esegui(args.script, args.shard, args.piano))
+    elif args.comando == "unisci":
+        unisci(args.radici, args.destinazione, args.script)
+    else:
+        prova(args.script, args.shard, args.piano)
@@ -0,0 +1,163 @@
+import cProfile
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+# === Costanti ===
+METRICHE_PATH = os.environ.get("VELOX_METRICHE", "metriche_render.jsonl")  # "" = nessun file di metriche
+PROFILI_LENTI = int(os.environ.get("VELOX_PROFILI", "0"))  # profili cProfile delle N unità più lente (0 = disattivato)
+PROFILI_DIR = "profili"
+
+# Metriche dell'unità in corso in questo processo (None fuori dal runner: fase/conta non fanno nulla)
+_metriche = None
+_profilo = None
+# Fasi aperte: [nome, inizio, durata delle fasi annidate]
+_pila = []
+
+
+# === Fase misurata dell'unità corrente (context manager o decoratore) ===
+# Registra il tempo esclusivo: una fase annidata (es. disegno dei marker dentro il
+# salvataggio) non viene contata due volte.
+@contextmanager
+def fase(nome):
+    if _metriche is None:
+        yield
+        return
+    voce = [nome, time.perf_counter(), 0.0]
+    _pila.append(voce)
+    try:
+        yield
+    finally:
+        _pila.pop()
+        durata = time.perf_counter() - voce[1]
+        fasi = _metriche["fasi"]
+        fasi[nome] = fasi.get(nome, 0.0) + durata - voce[2]
+        if _pila:
+            _pila[-1][2] += durata
+
+
+def conta(chiave, valore=1):
+    if _metriche is not None:
+        _metriche[chiave] = _metriche.get(chiave, 0) + valore
+
+
+# Metriche dell'unità in corso, per chi le completa più tardi (es. codifica in background)
+def unita_corrente():
+    return _metriche
+
+
+def byte_output(output):
+    output = getattr(output, "output", output)  # RisultatoRender o percorso/i
+    percorsi = output if isinstance(output, (list, tuple)) else [output] if output else []
+    return sum(os.path.getsize(p) for p in percorsi if os.path.exists(p))
+
+
+def _memoria():
+    memoria = {"rss_mb": None, "picco_rss_mb": None}
+    try:
+        import resource
+        picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memoria["picco_rss_mb"] = round(picco / 1024 / (1024 if os.uname().sysname == "Darwin" else 1), 1)
+    except ImportError:
+        pass  # Windows
+    try:
+        with open("/proc/self/statm") as fh:
+            memoria["rss_mb"] = round(int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    return memoria
+
+
+def inizia_unita(nome):
+    global _metriche, _profilo
+    _pila.clear()
+    _metriche = {"unita": nome, "pid": os.getpid(), "fasi": {}, "_inizio": time.perf_counter()}
+    if PROFILI_LENTI:
+        _profilo = cProfile.Profile()
+        _profilo.enable()
+
+
+# === Chiude le metriche dell'unità: durata, fasi, byte scritti, memoria, profilo ===
+def termina_unita(output=None):
+    global _metriche, _profilo
+    metriche, _metriche = _metriche, None
+    if metriche is None:
+        return None
+
+    # Tempo fuori dalle fasi misurate (figura, limiti, codice dello script)
+    durata = time.perf_counter() - metriche.pop("_inizio")
+    metriche["fasi"]["altro"] = max(0.0, durata - sum(metriche["fasi"].values()))
+    metriche["fasi"] = {nome: round(durata, 4) for nome, durata in metriche["fasi"].items()}
+    metriche["output_bytes"] = byte_output(output)
+    metriche.update(_memoria())
+
+    if _profilo is not None:
+        _profilo.disable()
+        os.makedirs(PROFILI_DIR, exist_ok=True)
+        nome_file = re.sub(r"[^\w.-]", "_", str(metriche["unita"])).lower()
+        metriche["profilo"] = os.path.join(PROFILI_DIR, f"{nome_file}.prof")
+        _profilo.dump_stats(metriche["profilo"])
+        _profilo = None
+    return metriche
+
+
+# === File JSON-lines delle metriche, scritto solo dal processo principale ===
+class RegistroMetriche:
+    def __init__(self, percorso=METRICHE_PATH, script=None):
+        self.percorso = percorso
+        self.esecuzione = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.script = script
+        self._fh = None
+        if percorso:
+            cartella = os.path.dirname(percorso)
+            if cartella:
+                os.makedirs(cartella, exist_ok=True)
+            self._fh = open(percorso, "a", encoding="utf-8")
+
+    def scrivi(self, esito):
+        if self._fh is None or esito.metriche is None:
+            return
+        riga = {"esecuzione": self.esecuzione, "script": self.script, "stato": esito.stato,
+                "durata": round(esito.durata, 4), **esito.metriche}
+        self._fh.write(json.dumps(riga, ensure_ascii=False) + "\n")
+        self._fh.flush()  # una riga per unità anche se il batch viene interrotto
+
+    def chiudi(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+# === Tempo complessivo per fase, codifica per formato e profili: restano solo quelli delle N unità più lente ===
+def riepiloga(esiti, profili_lenti=PROFILI_LENTI):
+    totali = {}
+    codifica = {}
+    for esito in esiti:
+        for nome, durata in ((esito.metriche or {}).get("fasi") or {}).items():
+            totali[nome] = totali.get(nome, 0.0) + durata
+        for formato, voce in ((esito.metriche or {}).get("codifica") or {}).items():
+            somma = codifica.setdefault(formato, dict.fromkeys(voce, 0))
+            for chiave, valore in voce.items():
+                somma[chiave] += valore
+    totale = sum(totali.values())
+    if totale > 0:
+        quote = sorted(totali.items(), key=lambda voce: -voce[1])
+        print("[i] Tempo per fase: " + ", ".join(f"{nome} {durata:.1f}s ({durata / totale:.0%})"
+                                                for nome, durata in quote))
+    if codifica:
+        from codifica import stampa_codifica
+        stampa_codifica(codifica)
+
+    profilati = sorted((e for e in esiti if (e.metriche or {}).get("profilo")), key=lambda e: -e.durata)
+    if not profilati:
+        return
+    for esito in profilati[profili_lenti:]:
+        try:
+            os.remove(esito.metriche["profilo"])
+        except FileNotFoundError:
+            pass
+    print(f"[i] Profili delle {min(profili_lenti, len(profilati))} unità più lente (python -m pstats <file>):")
+    for esito in profilati[:profili_lenti]:
+        print(f"  [i] {esito.nome}: {esito.metriche['profilo']} ({esito.durata:.1f}s)")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Gli script stanno nella radice del repository: importabili come moduli di primo livello
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+from cluster import raggruppa, raggruppa_in_assi
+
+
+def test_gruppi_separati_e_conteggi():
+    rng = np.random.default_rng(0)
+    centri = np.array([[100, 100], [400, 120], [250, 400]])
+    numeri = [30, 5, 1]
+    punti = np.concatenate([centro + rng.normal(0, 2, (numero, 2)) for centro, numero in zip(centri, numeri)])
+    gx, gy, conteggi, gruppo = raggruppa(punti[:, 0], punti[:, 1], 20)
+    assert conteggi.tolist() == numeri  # gruppi nell'ordine del loro primo punto
+    assert gruppo.tolist() == [0] * 30 + [1] * 5 + [2]
+    for numero in range(3):
+        np.testing.assert_allclose([gx[numero], gy[numero]], punti[gruppo == numero].mean(axis=0))
+
+
+def test_proprieta_su_punti_casuali():
+    rng = np.random.default_rng(1)
+    px, py = rng.uniform(0, 1000, 5000), rng.uniform(0, 1000, 5000)
+    raggio = 15
+    gx, gy, conteggi, gruppo = raggruppa(px, py, raggio)
+    assert conteggi.sum() == len(px)
+    assert np.array_equal(np.bincount(gruppo), conteggi)
+    primo = np.array([np.flatnonzero(gruppo == numero)[0] for numero in range(len(conteggi))])
+    assert np.all(np.diff(primo) > 0)
+    # Ogni punto è entro il raggio dal baricentro della sua cella, che è entro il raggio da
+    # quello della cella che guida il gruppo: entro due raggi da questa, quattro dal baricentro
+    distanze = np.hypot(px - gx[gruppo], py - gy[gruppo])
+    assert distanze.max() <= 4 * raggio
+    # Nessun gruppo se i punti sono più lontani di due raggi tra loro
+    sparsi = np.arange(20) * 2.5 * raggio
+    _, _, conteggi, _ = raggruppa(sparsi, np.zeros(20), raggio)
+    assert conteggi.tolist() == [1] * 20
+
+
+def test_vuoto():
+    gx, gy, conteggi, gruppo = raggruppa([], [], 10)
+    assert len(gx) == len(gy) == len(conteggi) == len(gruppo) == 0
+
+
+# Raggio in punti tipografici: gli stessi gruppi a qualunque dpi
+def test_raggruppa_in_assi_indipendente_dal_dpi():
+    rng = np.random.default_rng(2)
+    x, y = rng.uniform(0, 1e5, 2000), rng.uniform(0, 5e4, 2000)
+    risultati = []
+    for dpi in (72, 150, 300):
+        fig, ax = plt.subplots(figsize=(6, 4), dpi=dpi)
+        ax.set_aspect("equal")
+        ax.set_xlim(0, 1e5)
+        ax.set_ylim(0, 5e4)
+        risultati.append(raggruppa_in_assi(ax, x, y, raggio=12))
+        plt.close(fig)
+    for gx, gy, conteggi in risultati[1:]:
+        assert np.array_equal(conteggi, risultati[0][2])
+        np.testing.assert_allclose(gx, risultati[0][0])
+        np.testing.assert_allclose(gy, risultati[0][1])
@@ -0,0 +1,32 @@
+import math
+
+import numpy as np
+import pytest
+
+from deduplica import DISTANZA_M, deduplica
+
+RAGGIO_TERRA = 6_371_008.8
+
+
+# Punto a metri verso est sul terreno, alla stessa latitudine
+def _a_est(longitudine, latitudine, metri):
+    return longitudine + math.degrees(metri / (RAGGIO_TERRA * math.cos(math.radians(latitudine))))
+
+
+@pytest.mark.parametrize("latitudine", [0.0, 60.0])
+def test_distanza_sul_terreno_indipendente_dalla_latitudine(latitudine):
+    longitudine = np.array([10.0, _a_est(10.0, latitudine, DISTANZA_M - 5),
+                            10.5, _a_est(10.5, latitudine, DISTANZA_M + 5)])
+    canonico = deduplica(longitudine, np.full(4, latitudine))
+    assert canonico.tolist() == [0, 0, 2, 3]
+
+
+def test_ogni_marker_va_a_un_solo_canonico():
+    longitudine = np.array([_a_est(10.0, 45.0, metri) for metri in (0, 20, 40, 60)])
+    canonico = deduplica(longitudine, np.full(4, 45.0))
+    # Catena di punti a 20 m: il primo assorbe il secondo, il terzo diventa un nuovo canonico
+    assert canonico.tolist() == [0, 0, 2, 2]
+
+
+def test_vuoto():
+    assert len(deduplica(np.empty(0), np.empty(0))) == 0
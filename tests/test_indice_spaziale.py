@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from indice_spaziale import IndiceMarker, distanza_m
+
+RAGGIO_M = 300
+
+
+@pytest.fixture
+def indice(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # cache di marker_loader nella cartella temporanea
+    rng = np.random.default_rng(0)
+    # Due città con marker fitti, uno alla latitudine di Palermo e uno del Nord
+    lon = np.concatenate([rng.normal(9.19, 0.02, 1500), rng.normal(13.36, 0.02, 1500)])
+    lat = np.concatenate([rng.normal(45.46, 0.015, 1500), rng.normal(38.12, 0.015, 1500)])
+    for numero, blocco in enumerate(np.array_split(np.arange(len(lon)), 3)):
+        np.savetxt(f"marker_{numero}.csv", np.column_stack([lon[blocco], lat[blocco]]), fmt="%.6f", delimiter=",",
+                   header="longitude,latitude", comments="")
+    return IndiceMarker(["marker_0.csv", "marker_1.csv", "marker_2.csv"], "indice")
+
+
+def _query(n=200, seme=1):
+    rng = np.random.default_rng(seme)
+    citta = rng.integers(0, 2, n)
+    return (np.where(citta, rng.normal(13.36, 0.03, n), rng.normal(9.19, 0.03, n)),
+            np.where(citta, rng.normal(38.12, 0.02, n), rng.normal(45.46, 0.02, n)))
+
+
+def test_entro_come_forza_bruta(indice):
+    lon, lat = _query()
+    punti, marker, distanze = indice.entro(lon, lat, RAGGIO_M)
+    for numero in range(len(lon)):
+        tutte = distanza_m(lon[numero], lat[numero], indice.longitudine, indice.latitudine)
+        attesi = np.flatnonzero(tutte <= RAGGIO_M)
+        assert sorted(marker[punti == numero]) == sorted(attesi)
+        assert np.all(np.diff(distanze[punti == numero]) >= 0)
+
+
+@pytest.mark.parametrize("k", [1, 5])
+def test_piu_vicini_come_forza_bruta(indice, k):
+    lon, lat = _query()
+    indici, distanze = indice.piu_vicini(lon, lat, k)
+    for numero in range(len(lon)):
+        tutte = distanza_m(lon[numero], lat[numero], indice.longitudine, indice.latitudine)
+        np.testing.assert_allclose(distanze[numero], np.sort(tutte)[:k])
+        np.testing.assert_allclose(tutte[indici[numero]], distanze[numero])
+
+
+def test_piu_vicini_punti_non_finiti(indice):
+    indici, distanze = indice.piu_vicini([9.19, np.nan, 9.2], [45.46, np.nan, np.inf], k=2)
+    assert (indici[0] >= 0).all() and np.isfinite(distanze[0]).all()
+    assert (indici[1:] == -1).all() and np.isinf(distanze[1:]).all()
+
+
+def test_piu_vicini_con_distanza_massima(indice):
+    indici, distanze = indice.piu_vicini([11.0, 9.19], [42.0, 45.46], k=3, max_distanza_m=1000)
+    assert (indici[0] == -1).all() and np.isinf(distanze[0]).all()
+    assert (distanze[1] <= 1000).all()
+
+
+def test_vicino_a_percorso_come_forza_bruta(indice):
+    rng = np.random.default_rng(2)
+    tracce = []
+    for centro in ((9.19, 45.46), (13.36, 38.12)):
+        passi = np.column_stack([rng.normal(0.0008, 0.0004, 60), rng.normal(0.0003, 0.0004, 60)])
+        tracce.append(np.array(centro) - 0.02 + np.cumsum(passi, axis=0))
+    percorsi, marker, distanze = indice.vicino_a_percorso(tracce, RAGGIO_M)
+
+    for numero, traccia in enumerate(tracce):
+        # Forza bruta: minima distanza dai punti fitti (circa 1 m) lungo ogni segmento
+        frazioni = np.linspace(0, 1, 100)[:, None]
+        campioni = np.concatenate([a + frazioni * (b - a) for a, b in zip(traccia[:-1], traccia[1:])])
+        vere = np.array([distanza_m(campioni[:, 0], campioni[:, 1], lon, lat).min()
+                         for lon, lat in zip(indice.longitudine, indice.latitudine)])
+        trovati = dict(zip(marker[percorsi == numero], distanze[percorsi == numero]))
+        # Le distanze sono calcolate in EPSG:3857 scalato: ammesso l'1% ai bordi del raggio
+        assert set(np.flatnonzero(vere <= RAGGIO_M * 0.99)) <= set(trovati)
+        assert not set(trovati) & set(np.flatnonzero(vere > RAGGIO_M * 1.01))
+        for indice_marker, distanza in trovati.items():
+            assert distanza == pytest.approx(vere[indice_marker], rel=0.01, abs=2)
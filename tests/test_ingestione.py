@@ -0,0 +1,36 @@
+import io
+import json
+
+import pytest
+
+from ingestione import _LettoreJson, elementi_json
+
+RECORD = [{"latitude": 45.4642, "longitude": 9.19, "nome": "Milano, viale \"Monza\""},
+          {"latitude": -12345.678e-2, "longitude": [1, 2, {"a": None}], "nome": ""},
+          1234567890]
+
+
+# Blocchi di pochi caratteri: stringhe, numeri e oggetti spezzati tra una lettura e l'altra
+@pytest.mark.parametrize("caratteri", [1, 3, 7, 1 << 20])
+def test_valori_spezzati_tra_blocchi(caratteri):
+    lettore = _LettoreJson(io.StringIO(json.dumps(RECORD, indent=1)), caratteri=caratteri)
+    assert list(lettore.elementi_array()) == RECORD
+
+
+def test_numero_a_fine_blocco():
+    # "12" letto per primo non basta: il numero continua nel blocco successivo
+    lettore = _LettoreJson(io.StringIO("[12345, 6]"), caratteri=3)
+    assert list(lettore.elementi_array()) == [12345, 6]
+
+
+def test_features_di_una_feature_collection():
+    collezione = {"type": "FeatureCollection", "name": "marker", "features": RECORD, "crs": {"type": "name"}}
+    assert list(elementi_json(io.StringIO(json.dumps(collezione)))) == RECORD
+    assert list(elementi_json(io.StringIO("{}"))) == []
+    assert list(elementi_json(io.StringIO("[]"))) == []
+
+
+def test_json_troncato():
+    lettore = _LettoreJson(io.StringIO('[{"latitude": 45.1}, {"lat'), caratteri=4)
+    with pytest.raises(ValueError):
+        list(lettore.elementi_array())
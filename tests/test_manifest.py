@@ -0,0 +1,62 @@
+import pytest
+
+import manifest
+from render_parallelo import EsitoRender
+
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest, "MANIFEST_SHARD", None)
+    monkeypatch.setattr(manifest, "_manifest_letti", {})
+    percorso = tmp_path / "milano.png"
+    percorso.write_bytes(b"png")
+    return str(percorso)
+
+
+def _registra(output, impronta, stato="ok"):
+    manifest.registra_esiti([EsitoRender("Milano", stato, output, 1.0, None, impronta)])
+    manifest._manifest_letti.clear()  # come un nuovo processo: il manifest viene riletto dal disco
+
+
+def test_stessa_impronta_salta(output):
+    _registra(output, "abc")
+    assert manifest.invariato(output, "abc")
+
+
+def test_impronta_diversa_ricostruisce(output):
+    _registra(output, "abc")
+    assert not manifest.invariato(output, "def")
+    assert not manifest.invariato(output, None)
+
+
+def test_output_mancante_ricostruisce(output, tmp_path):
+    _registra(output, "abc")
+    (tmp_path / "milano.png").unlink()
+    assert not manifest.invariato(output, "abc")
+
+
+def test_senza_manifest_ricostruisce(output):
+    assert not manifest.invariato(output, "abc")
+
+
+def test_esiti_non_riusciti_non_registrati(output):
+    _registra(output, "abc", stato="errore")
+    assert not manifest.invariato(output, "abc")
+
+
+def test_job_con_piu_output(output, tmp_path):
+    altro = str(tmp_path / "milano_notte.png")
+    _registra([output, altro], "abc")
+    assert not manifest.invariato([output, altro], "abc")  # milano_notte.png non esiste
+    (tmp_path / "milano_notte.png").write_bytes(b"png")
+    assert manifest.invariato([output, altro], "abc")
+
+
+def test_shard_legge_anche_il_manifest_principale(output, monkeypatch):
+    _registra(output, "abc")
+    monkeypatch.setattr(manifest, "MANIFEST_SHARD", "manifest.shard-1-di-2.json")
+    assert manifest.invariato(output, "abc")
+    _registra(output, "def")  # scritto nel manifest dello shard, quello principale resta invariato
+    assert manifest.invariato(output, "def")
+    monkeypatch.setattr(manifest, "MANIFEST_SHARD", None)
+    assert manifest.invariato(output, "abc")
@@ -0,0 +1,106 @@
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+from PIL import Image
+
+from bench_marker import imscatter_annotation
+from marker_batch import _gruppi_senza_sovrapposizioni, componi_icone, da_premoltiplicato, imscatter
+
+ICONA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "autovelox-icon.png")
+ZOOM = 0.015
+DPI = 200
+
+
+def _disegna(funzione, x, y):
+    fig, ax = plt.subplots(figsize=(4, 4), dpi=DPI)
+    ax.set_xlim(0, 100)
+    ax.set_ylim(0, 100)
+    ax.set_axis_off()
+    funzione(x, y, ax=ax, zoom=ZOOM, image_path=ICONA)
+    fig.canvas.draw()
+    immagine = np.asarray(fig.canvas.buffer_rgba()).copy()
+    pixel = ax.transData.transform(np.column_stack([x, y]))
+    plt.close(fig)
+    return immagine, pixel
+
+
+def _icona_casuale(rng, altezza=6, larghezza=5):
+    straight = rng.integers(0, 256, (altezza, larghezza, 4)).astype(np.uint8)
+    straight[rng.random((altezza, larghezza)) < 0.3, 3] = 255
+    straight[rng.random((altezza, larghezza)) < 0.2, 3] = 0
+    return np.asarray(Image.fromarray(straight, "RGBA").convert("RGBa"))
+
+
+# Riferimento: operatore "over" icona per icona, arrotondato a ogni passo come componi_icone
+def _over_sequenziale(icona, colonne, righe, altezza_livello, larghezza_livello, ordine):
+    livello = np.zeros((altezza_livello, larghezza_livello, 4), dtype=np.float64)
+    altezza, larghezza = icona.shape[:2]
+    alfa = icona[:, :, 3:4] / 255.0
+    for i in ordine:
+        finestra = livello[righe[i]:righe[i] + altezza, colonne[i]:colonne[i] + larghezza]
+        nuovo = np.floor(icona + finestra * (1 - alfa) + 0.5)
+        finestra[:] = np.where(alfa >= 1, icona, np.where(alfa > 0, nuovo, finestra))
+    return livello.astype(np.uint8)
+
+
+# Marker che non si sovrappongono: stessa posizione e stessa quantità di colore dell'AnnotationBbox
+# per punto, entro un pixel (l'icona è ricampionata in anticipo e ancorata al pixel intero)
+def test_come_annotation_bbox():
+    gx, gy = np.meshgrid(np.linspace(10, 90, 5), np.linspace(10, 80, 4))
+    x, y = gx.ravel(), gy.ravel()
+    riferimento, pixel = _disegna(imscatter_annotation, x, y)
+    batch, _ = _disegna(imscatter, x, y)
+    altezza = riferimento.shape[0]
+    lato = int(np.ceil(Image.open(ICONA).height * ZOOM * DPI / 72)) + 4
+
+    for colonna, riga in zip(pixel[:, 0], altezza - pixel[:, 1]):
+        finestra = np.s_[int(riga) - lato:int(riga) + 4, int(colonna) - lato // 2:int(colonna) + lato // 2]
+        pesi = [(255 - immagine[finestra][:, :, :3].astype(float)).sum(axis=2) for immagine in (riferimento, batch)]
+        righe, colonne = np.indices(pesi[0].shape)
+        centri = [(np.average(righe, weights=p), np.average(colonne, weights=p)) for p in pesi]
+        assert np.abs(np.subtract(*centri)).max() < 1  # angoli arrotondati al pixel intero
+        assert pesi[1].sum() == pytest.approx(pesi[0].sum(), rel=0.05)
+
+
+def test_componi_icone_come_over_sequenziale():
+    rng = np.random.default_rng(0)
+    icona = _icona_casuale(rng)
+    colonne, righe = rng.integers(0, 40, 300), rng.integers(0, 30, 300)
+    livello = componi_icone(icona, colonne, righe, 36, 45)
+    ordine = np.concatenate(_gruppi_senza_sovrapposizioni(colonne, righe, *icona.shape[:2]))
+    atteso = _over_sequenziale(icona, colonne, righe, 36, 45, ordine)
+    assert np.abs(livello.astype(int) - atteso.astype(int)).max() <= 1
+
+
+def test_gruppi_senza_sovrapposizioni():
+    rng = np.random.default_rng(1)
+    altezza, larghezza = 6, 5
+    colonne, righe = rng.integers(0, 60, 500), rng.integers(0, 60, 500)
+    gruppi = _gruppi_senza_sovrapposizioni(colonne, righe, altezza, larghezza)
+    assert sorted(np.concatenate(gruppi)) == list(range(500))
+    posizione = np.empty(500, np.int64)
+    for numero, gruppo in enumerate(gruppi):
+        posizione[gruppo] = numero
+        dx = np.abs(colonne[gruppo][:, None] - colonne[gruppo][None, :])
+        dy = np.abs(righe[gruppo][:, None] - righe[gruppo][None, :])
+        toccano = (dx < larghezza) & (dy < altezza)
+        assert toccano.sum() == len(gruppo)  # solo ogni icona con se stessa
+    # Nella stessa cella l'ordine di input è rispettato
+    cella = (colonne // larghezza) * 1000 + righe // altezza
+    for valore in np.unique(cella):
+        assert np.all(np.diff(posizione[cella == valore]) > 0)
+
+
+def test_da_premoltiplicato():
+    rng = np.random.default_rng(2)
+    straight = rng.integers(0, 256, (40, 40, 4)).astype(np.uint8)
+    premoltiplicato = np.asarray(Image.fromarray(straight, "RGBA").convert("RGBa"))
+    risultato = da_premoltiplicato(premoltiplicato)
+    opachi = premoltiplicato[:, :, 3] == 255
+    assert np.array_equal(risultato[opachi], premoltiplicato[opachi])
+    visibili = straight[:, :, 3] >= 128
+    assert np.abs(risultato[visibili].astype(int) - straight[visibili].astype(int)).max() <= 2
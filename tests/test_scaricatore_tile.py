@@ -0,0 +1,75 @@
+import contextily as ctx
+import mercantile as mt
+import numpy as np
+import pytest
+import requests
+
+import scaricatore_tile
+from basemap import mosaico
+from scaricatore_tile import ScaricatoreTile
+from server_tile_locale import avvia_server, provider_locale
+from tile_cache import TileCache
+
+ESTENSIONE = (1005000, 5685000, 1045000, 5725000)  # Milano, EPSG:3857
+ZOOM = 11
+
+
+@pytest.fixture
+def server():
+    server = avvia_server(latenza=0.02)
+    yield server
+    server.shutdown()
+
+
+@pytest.mark.parametrize("thread", [1, 8])
+def test_mosaico_come_contextily(server, tmp_path, thread):
+    source = provider_locale(server)
+    cache = TileCache(str(tmp_path / "cache"))
+    img, estensione = mosaico(*ESTENSIONE, ZOOM, source=source, cache=cache, scaricatore=ScaricatoreTile(thread))
+    assert server.richieste == cache.miss == 9  # una richiesta per tile
+    atteso, estensione_attesa = ctx.bounds2img(*ESTENSIONE, zoom=ZOOM, source=source, ll=False)
+    assert np.array_equal(img, atteso)
+    np.testing.assert_allclose(estensione, estensione_attesa)
+
+    # Seconda volta tutto dalla cache: nessuna richiesta al server
+    richieste = server.richieste
+    di_nuovo, _ = mosaico(*ESTENSIONE, ZOOM, source=source, cache=cache, scaricatore=ScaricatoreTile(thread))
+    assert np.array_equal(di_nuovo, img)
+    assert server.richieste == richieste
+
+
+def test_nuovi_tentativi_su_5xx(tmp_path, monkeypatch):
+    monkeypatch.setattr(scaricatore_tile, "BACKOFF_S", 0.01)
+    server = avvia_server(errori=3)
+    try:
+        source = provider_locale(server)
+        scaricatore = ScaricatoreTile(4)
+        img, _ = mosaico(*ESTENSIONE, ZOOM, source=source, cache=TileCache(str(tmp_path / "cache")),
+                         scaricatore=scaricatore)
+        atteso, _ = ctx.bounds2img(*ESTENSIONE, zoom=ZOOM, source=source, ll=False)
+    finally:
+        server.shutdown()
+    assert np.array_equal(img, atteso)
+    assert scaricatore.statistiche()["ripetute"] == 3
+
+
+def test_errori_oltre_i_tentativi(tmp_path, monkeypatch):
+    monkeypatch.setattr(scaricatore_tile, "BACKOFF_S", 0.01)
+    server = avvia_server(errori=10)
+    try:
+        scaricatore = ScaricatoreTile(1, tentativi=2)
+        errori = scaricatore.precarica(provider_locale(server), [mt.Tile(1000, 700, ZOOM)],
+                                       TileCache(str(tmp_path / "cache")))
+    finally:
+        server.shutdown()
+    assert list(errori.values()) == ["HTTPError: 503 Server Error: Service Unavailable for url: "
+                                     f"{provider_locale(server).build_url(x=1000, y=700, z=ZOOM)}"]
+    assert server.richieste == 2
+
+
+def test_404_non_ripetuto(server, tmp_path):
+    source = provider_locale(server).url.replace(".png", ".jpg")  # percorso sconosciuto al server: 404
+    scaricatore = ScaricatoreTile(1)
+    with pytest.raises(requests.HTTPError):
+        list(scaricatore.tile_decodificate(source, [mt.Tile(1000, 700, ZOOM)], TileCache(str(tmp_path / "cache"))))
+    assert scaricatore.statistiche()["ripetute"] == 0
@@ -0,0 +1,75 @@
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+import shapely
+
+from codifica import rasterizza
+from marker_batch import imscatter
+from sfondi import carica_sfondo, chiave_sfondo, salva_sfondo
+
+ICONA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "autovelox-icon.png")
+DPI = 150
+LIMITI = (1_000_000, 1_060_000, 5_000_000, 5_040_000)  # non quadrati: aspetto "equal" con bande vuote
+CONFINE = shapely.Polygon([(1_005_000, 5_004_000), (1_055_000, 5_010_000), (1_040_000, 5_036_000)])
+
+
+# Basemap finta (un gradiente al posto delle tile) e confine, come prov.py
+def _figura():
+    fig, ax = plt.subplots(figsize=(5, 5), dpi=72)
+    ax.set_aspect("equal")
+    gradiente = np.linspace(0, 1, 64 * 64).reshape(64, 64)
+    ax.imshow(gradiente, extent=(LIMITI[0], LIMITI[1], LIMITI[2], LIMITI[3]), cmap="viridis",
+              interpolation="bilinear", aspect="equal")
+    ax.plot(*CONFINE.exterior.xy, color="black", linewidth=0.25, zorder=1)
+    ax.set_xlim(*LIMITI[:2])
+    ax.set_ylim(*LIMITI[2:])
+    ax.set_axis_off()
+    return fig, ax
+
+
+def _marker(n=400):
+    rng = np.random.default_rng(0)
+    return rng.uniform(1_008_000, 1_052_000, n), rng.uniform(5_006_000, 5_030_000, n)
+
+
+# Sfondo più marker ricomposti: identico al render completo con imscatter negli assi
+@pytest.mark.parametrize("raggio_cluster", [None, 15])
+def test_componi_come_render_diretto(tmp_path, raggio_cluster):
+    x, y = _marker()
+    fig, ax = _figura()
+    imscatter(x, y, ax=ax, zoom=0.015, image_path=ICONA, raggio_cluster=raggio_cluster)
+    diretto = rasterizza(fig, DPI, pad_inches=0)
+    plt.close(fig)
+
+    fig, ax = _figura()
+    sfondo = salva_sfondo(fig, ax, str(tmp_path), "unita", "chiave", DPI, pad_inches=0)
+    plt.close(fig)
+    composto = sfondo.componi(x, y, ICONA, zoom=0.015, raggio_cluster=raggio_cluster)
+    assert composto.shape == diretto.shape
+    assert np.array_equal(composto, diretto)
+
+    # Dallo sfondo salvato su disco, con altri marker
+    caricato = carica_sfondo(str(tmp_path), "unita", "chiave")
+    assert np.array_equal(caricato.componi(x, y, ICONA, raggio_cluster=raggio_cluster), composto)
+    assert not np.array_equal(caricato.componi(x[:10], y[:10], ICONA, raggio_cluster=raggio_cluster), composto)
+
+
+def test_sfondo_sostituito_se_cambia_la_chiave(tmp_path):
+    impostazioni = {"figsize": (5, 5), "dpi": DPI}
+    chiave = chiave_sfondo(CONFINE, LIMITI, impostazioni, "http://tile/{z}/{x}/{y}.png")
+    assert chiave == chiave_sfondo(CONFINE, LIMITI, dict(impostazioni), "http://tile/{z}/{x}/{y}.png")
+    nuova = chiave_sfondo(CONFINE, (*LIMITI[:3], LIMITI[3] + 1000), impostazioni, "http://tile/{z}/{x}/{y}.png")
+    assert nuova != chiave
+    assert nuova != chiave_sfondo(CONFINE, LIMITI, {**impostazioni, "dpi": 300}, "http://tile/{z}/{x}/{y}.png")
+
+    fig, ax = _figura()
+    salva_sfondo(fig, ax, str(tmp_path), "unita", chiave, DPI, pad_inches=0)
+    salva_sfondo(fig, ax, str(tmp_path), "unita", nuova, DPI, pad_inches=0)
+    plt.close(fig)
+    assert carica_sfondo(str(tmp_path), "unita", chiave) is None
+    assert carica_sfondo(str(tmp_path), "unita", nuova) is not None
+    assert len(os.listdir(tmp_path)) == 2  # pixel e metadati della sola chiave nuova
@@ -0,0 +1,154 @@
+import json
+import os
+import random
+import shutil
+
+import pandas as pd
+import pytest
+
+from shard import LavoroRender, carichi_shard, indici_shard, leggi_shard, piano_shard, suddividi
+
+COSTI = [5.0, 3.0, 3.0, 2.0, 2.0, 2.0, 1.0, 0.5, 0.5, 0.1]
+
+
+def _lavori(costi=COSTI):
+    return [LavoroRender(indice, f"unita_{indice:02d}", 0, 0, 0.0, costo) for indice, costo in enumerate(costi)]
+
+
+def test_suddividi_deterministico_e_bilanciato():
+    lavori = _lavori()
+    shard_di = suddividi(lavori, 3)
+    assert shard_di == suddividi(lavori, 3)
+    assert set(shard_di) == {1, 2, 3}
+    carichi = [sum(lavoro.costo for lavoro in lavori if shard_di[lavoro.indice] == numero) for numero in (1, 2, 3)]
+    assert max(carichi) - min(carichi) <= max(COSTI) / 2
+
+
+# L'ordine in cui i nodi elencano i lavori non cambia l'assegnazione (parità di costo comprese)
+def test_suddividi_indipendente_dall_ordine():
+    lavori = _lavori()
+    atteso = suddividi(lavori, 4)
+    for seme in range(5):
+        mescolati = list(lavori)
+        random.Random(seme).shuffle(mescolati)
+        assert suddividi(mescolati, 4) == atteso
+
+
+def test_suddividi_piu_shard_che_lavori():
+    assert sorted(suddividi(_lavori([1.0, 2.0]), 4)) == [1, 2]
+
+
+def test_leggi_shard():
+    assert leggi_shard("2/4") == (2, 4)
+    for testo in ("0/4", "5/4", "2", "a/b"):
+        with pytest.raises(ValueError):
+            leggi_shard(testo)
+
+
+@pytest.fixture
+def confini(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # cache di marker_loader nella cartella temporanea
+    os.makedirs("marker")
+    with open("marker/milano.csv", "w", encoding="utf-8") as fh:
+        fh.write("longitude,latitude\n" + "9.19,45.46\n" * 500)
+    return pd.DataFrame({"prov_name": ["Milano", "Bergamo", "Como", "Varese", "Lecco"],
+                         "xmin": [1_000_000, 1_050_000, 1_000_000, 950_000, 1_020_000],
+                         "ymin": [5_680_000, 5_700_000, 5_740_000, 5_700_000, 5_760_000],
+                         "xmax": [1_040_000, 1_120_000, 1_030_000, 990_000, 1_050_000],
+                         "ymax": [5_720_000, 5_790_000, 5_790_000, 5_760_000, 5_800_000]})
+
+
+def test_piano_shard_stabile_e_salvato(confini):
+    impostazioni = {"data_folder": "marker"}
+    piano = piano_shard(confini, "prov_name", 1000, impostazioni, 2, percorso="piano.json")
+    assert piano.lavori[0].marker == 500
+    assert sorted(indici_shard(piano, 1) + indici_shard(piano, 2)) == list(range(len(confini)))
+    assert len(carichi_shard(piano)) == 2
+
+    ricalcolato = piano_shard(confini, "prov_name", 1000, impostazioni, 2, percorso=None)
+    assert (ricalcolato.shard_di, ricalcolato.impronta) == (piano.shard_di, piano.impronta)
+
+    # Il piano salvato vale anche se i marker di un nodo differiscono
+    os.remove("marker/milano.csv")
+    letto = piano_shard(confini, "prov_name", 1000, impostazioni, 2, percorso="piano.json")
+    assert letto == piano
+    with pytest.raises(ValueError):
+        piano_shard(confini, "prov_name", 1000, impostazioni, 3, percorso="piano.json")
+    with pytest.raises(ValueError):
+        piano_shard(confini.iloc[::-1], "prov_name", 1000, impostazioni, 2, percorso="piano.json")
+
+
+# Render finto: ogni unità dello shard crea rese/<nome> (in esclusiva: una seconda resa
+# fallisce) e un'immagine in output/, poi lo shard scrive il suo rapporto come render_parallelo
+RENDER_FINTO = """
+import os
+import sys
+import time
+
+import pandas as pd
+
+from render_parallelo import EsitoRender
+from shard import SHARD, SOLO_PIANO, indici_shard, piano_shard, scrivi_rapporto
+
+confini = pd.DataFrame({"nome": NOMI, "xmin": [1_000_000 + 30_000 * i for i in range(len(NOMI))],
+                        "ymin": [5_600_000] * len(NOMI), "xmax": [1_020_000 + 30_000 * i for i in range(len(NOMI))],
+                        "ymax": [5_620_000 + 10_000 * i for i in range(len(NOMI))]})
+piano = piano_shard(confini, "nome", 500, {"data_folder": "marker"}, SHARD[1], "finto.py")
+if SOLO_PIANO:
+    sys.exit(0)
+inizio = time.time()
+esiti = []
+for indice in indici_shard(piano, SHARD[0]):
+    nome = confini["nome"][indice]
+    with open(os.path.join("rese", nome), "x") as fh:
+        fh.write(str(SHARD[0]))
+    output = os.path.join("output", nome + ".png")
+    with open(output, "wb") as fh:
+        fh.write(nome.encode("utf-8"))
+    esiti.append(EsitoRender(nome, "ok", output, 0.01, None, "impronta-" + nome))
+scrivi_rapporto(piano, SHARD[0], esiti, inizio, time.time() - inizio)
+"""
+NOMI = ["Milano", "Bergamo", "Como", "Varese", "Lecco", "Monza", "Pavia"]
+
+
+@pytest.fixture
+def render_finto(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for cartella in ("marker", "rese", "output"):
+        os.makedirs(cartella)
+    for numero, nome in enumerate(NOMI[:4]):  # costi diversi: marker solo per alcune unità
+        with open(f"marker/{nome.lower()}.csv", "w", encoding="utf-8") as fh:
+            fh.write("longitude,latitude\n" + "9.19,45.46\n" * (100 * (numero + 1)))
+    with open("finto.py", "w", encoding="utf-8") as fh:
+        fh.write(f"NOMI = {NOMI!r}\n" + RENDER_FINTO)
+    return "finto.py"
+
+
+# N processi locali al posto dei nodi (shard.prova), con il piano salvato dal primo
+def test_prova_ogni_unita_una_volta(render_finto):
+    from shard import prova, unisci
+
+    esiti = prova(render_finto, 3, piano="piano.json")
+    assert sorted(esito.nome for esito in esiti) == sorted(NOMI)
+    assert sorted(os.listdir("rese")) == sorted(NOMI)
+    assert all(esito.stato == "ok" and os.path.exists(esito.output) for esito in esiti)
+
+    with open("piano.json", encoding="utf-8") as fh:
+        piano = json.load(fh)
+    for numero, nome in zip(piano["shard_di"], [lavoro["nome"] for lavoro in piano["lavori"]]):
+        with open(os.path.join("rese", nome), encoding="utf-8") as fh:
+            assert fh.read() == str(numero)
+
+    with open("rapporti_shard/finto.unito.json", encoding="utf-8") as fh:
+        unito = json.load(fh)
+    assert [voce["shard"] for voce in unito["shard"]] == [1, 2, 3]
+    assert unito["mancanti"] == [] and unito["impronta_piano"] == piano["impronta"]
+    assert len(unito["esiti"]) == len(NOMI)
+    with open("output/manifest.json", encoding="utf-8") as fh:
+        assert sorted(json.load(fh)) == sorted(f"{nome}.png" for nome in NOMI)
+
+    # Gli stessi rapporti da una seconda radice: shard doppi
+    shutil.copytree("rapporti_shard", "nodo2/rapporti_shard")
+    with pytest.raises(ValueError, match="più radici"):
+        unisci([".", "nodo2"], script=render_finto)
@@ -0,0 +1,115 @@
+import os
+
+import mercantile as mt
+import numpy as np
+import shapely
+from PIL import Image
+
+from tile_overlay import LATO_TILE, MEZZO_MONDO, aggiorna_livello, confini_livello, indice_tile, percorso_tile
+from webmercator import lonlat_a_webmerc
+
+ZOOM = 9
+
+
+def _icona(altezza=24, larghezza=18):
+    straight = np.zeros((altezza, larghezza, 4), dtype=np.uint8)
+    straight[2:-2, 2:-2] = (200, 30, 30, 255)
+    straight[:, :, 3] = np.maximum(straight[:, :, 3], 90)
+    return np.asarray(Image.fromarray(straight, "RGBA").convert("RGBa"))
+
+
+def _marker(n=300, seme=0):
+    rng = np.random.default_rng(seme)
+    return lonlat_a_webmerc(rng.uniform(8.5, 11.5, n), rng.uniform(44.5, 46.5, n))
+
+
+# Ogni icona va in tutte e sole le tile che tocca, con l'angolo in pixel globali come imscatter
+def test_indice_tile_come_forza_bruta():
+    x, y = _marker()
+    altezza, larghezza = 24, 18
+    colonne, righe, chiavi, indici = indice_tile(x, y, ZOOM, altezza, larghezza)
+    numero = 2 ** ZOOM
+    scala = LATO_TILE * numero / (2 * MEZZO_MONDO)
+    attese = np.unique(np.column_stack([np.round(((MEZZO_MONDO - y) * scala - altezza)),
+                                        np.round((x + MEZZO_MONDO) * scala - larghezza / 2)]), axis=0)
+    assert np.array_equal(np.column_stack([righe, colonne]), attese)
+    assert np.all(np.diff(chiavi) >= 0)
+
+    coppie = set(zip(chiavi.tolist(), indici.tolist()))
+    attese = set()
+    for marker, (colonna, riga) in enumerate(zip(colonne, righe)):
+        for tx in range(colonna // LATO_TILE, (colonna + larghezza - 1) // LATO_TILE + 1):
+            for ty in range(riga // LATO_TILE, (riga + altezza - 1) // LATO_TILE + 1):
+                attese.add((tx * numero + ty, marker))
+    assert coppie == attese
+
+
+def test_indice_tile_come_mercantile():
+    lon, lat = np.array([9.19, 12.5, -70.3]), np.array([45.46, 41.9, -33.4])
+    x, y = lonlat_a_webmerc(lon, lat)
+    _, _, chiavi, _ = indice_tile(x, y, ZOOM, 24, 18)
+    for tile in (mt.tile(*punto, ZOOM) for punto in zip(lon, lat)):
+        assert tile.x * 2 ** ZOOM + tile.y in chiavi
+
+
+# Icone a cavallo del bordo del mondo: solo le tile esistenti; icona tutta fuori: nessuna tile
+def test_indice_tile_ai_bordi_del_mondo():
+    x = np.array([-MEZZO_MONDO + 1, MEZZO_MONDO - 1, 0.0])
+    y = np.array([0.0, MEZZO_MONDO * 0.99, MEZZO_MONDO - 1])
+    colonne, righe, chiavi, indici = indice_tile(x, y, 2, 24, 18)
+    assert np.all((chiavi >= 0) & (chiavi < 16))
+    fuori = np.flatnonzero(righe + 24 <= 0)
+    assert len(fuori) == 1 and fuori[0] not in indici
+    assert len(set(indici.tolist())) == 2
+
+
+def _tile_su_disco(cartella):
+    risultato = {}
+    for radice, _, nomi in os.walk(cartella):
+        for nome in nomi:
+            with open(os.path.join(radice, nome), "rb") as fh:
+                risultato[os.path.relpath(os.path.join(radice, nome), cartella)] = fh.read()
+    return risultato
+
+
+# Aggiornamenti incrementali: si riscrivono solo le tile toccate e il risultato è identico a
+# una generazione completa degli stessi marker
+def test_aggiornamento_incrementale(tmp_path):
+    icona = _icona()
+    incrementale, completa = str(tmp_path / "incrementale"), str(tmp_path / "completa")
+    x, y = _marker()
+    confine = shapely.box(*lonlat_a_webmerc(9.0, 45.0), *lonlat_a_webmerc(11.0, 46.0))
+    confini = confini_livello([(np.array([confine]), 1.5, (0, 0, 0, 0.8))], ZOOM)
+
+    stato, scritte, rimosse = aggiorna_livello(incrementale, ZOOM, x, y, icona, confini, None, True)
+    assert scritte == len(stato[0]) and rimosse == 0
+    assert len(_tile_su_disco(incrementale)) == scritte
+    stato, scritte, rimosse = aggiorna_livello(incrementale, ZOOM, x, y, icona, confini, stato, False)
+    assert (scritte, rimosse) == (0, 0)
+
+    # Un marker isolato in più, poi via di nuovo: solo le sue tile
+    nuovo_x, nuovo_y = lonlat_a_webmerc(np.array([14.0]), np.array([40.0]))
+    _, _, chiavi_nuovo, _ = indice_tile(nuovo_x, nuovo_y, ZOOM, *icona.shape[:2])
+    con_nuovo = np.r_[x, nuovo_x], np.r_[y, nuovo_y]
+    stato, scritte, rimosse = aggiorna_livello(incrementale, ZOOM, *con_nuovo, icona, confini, stato, False)
+    assert (scritte, rimosse) == (len(chiavi_nuovo), 0)
+    aggiorna_livello(completa, ZOOM, *con_nuovo, icona, confini, None, True)
+    assert _tile_su_disco(incrementale) == _tile_su_disco(completa)
+
+    stato, scritte, rimosse = aggiorna_livello(incrementale, ZOOM, x, y, icona, confini, stato, False)
+    assert (scritte, rimosse) == (0, len(chiavi_nuovo))
+    for chiave in chiavi_nuovo:
+        assert not os.path.exists(percorso_tile(incrementale, ZOOM, chiave // 2 ** ZOOM, chiave % 2 ** ZOOM))
+
+    # Un marker spostato in una zona fitta: le tile vicine restano identiche alla generazione completa
+    x[0], y[0] = x[0] + 3000, y[0] - 2000
+    stato, scritte, _ = aggiorna_livello(incrementale, ZOOM, x, y, icona, confini, stato, False)
+    assert 0 < scritte <= 8
+    aggiorna_livello(str(tmp_path / "completa2"), ZOOM, x, y, icona, confini, None, True)
+    assert _tile_su_disco(incrementale) == _tile_su_disco(str(tmp_path / "completa2"))
+
+    # Tile cancellata a mano: riscritta anche se la sua impronta non cambia
+    chiave = stato[0][0]
+    os.remove(percorso_tile(incrementale, ZOOM, chiave // 2 ** ZOOM, chiave % 2 ** ZOOM))
+    _, scritte, _ = aggiorna_livello(incrementale, ZOOM, x, y, icona, confini, stato, False)
+    assert scritte == 1
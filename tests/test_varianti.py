@@ -0,0 +1,74 @@
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+from PIL import Image
+
+from codifica import attendi_codifiche
+from marker_batch import imscatter
+from varianti import salva_variante
+
+DPI = 100
+
+
+def _rossi(percorso):
+    with Image.open(percorso) as immagine:
+        rgba = np.asarray(immagine.convert("RGBA")).astype(int)
+    return int(((rgba[:, :, 0] > 200) & (rgba[:, :, 1] < 50) & (rgba[:, :, 2] < 50)).sum())
+
+
+@pytest.fixture
+def icona(tmp_path):
+    percorso = str(tmp_path / "icona.png")
+    Image.new("RGBA", (20, 20), (255, 0, 0, 255)).save(percorso)
+    return percorso
+
+
+# Estensione non quadrata con aspetto "equal", limiti cambiati dopo l'ultimo apply_aspect
+# (come le varianti con zoom_mappa fisso o successive alla prima): il ritaglio deve
+# contenere tutti i marker, interi.
+@pytest.mark.parametrize("limiti", [(0, 4000, 0, 1000), (0, 1000, 0, 3000)])
+def test_ritaglio_contiene_tutti_i_marker(tmp_path, icona, limiti):
+    fig, ax = plt.subplots(figsize=(6, 6), dpi=DPI)
+    ax.set_aspect("equal")
+    ax.axis((0, 1000, 0, 1000))
+    ax.get_position()  # aspetto applicato con i limiti precedenti
+    xmin, xmax, ymin, ymax = limiti
+    gx, gy = np.meshgrid(np.linspace(xmin + (xmax - xmin) * 0.3, xmin + (xmax - xmin) * 0.6, 4),
+                         np.linspace(ymin + (ymax - ymin) * 0.3, ymin + (ymax - ymin) * 0.6, 3))
+    marker = imscatter(gx.ravel(), gy.ravel(), ax=ax, zoom=0.5, image_path=icona)
+    ax.set_axis_off()
+    ax.set_xlim(xmin, xmax)
+    ax.set_ylim(ymin, ymax)
+
+    intera, ritagliata = str(tmp_path / "intera.png"), str(tmp_path / "ritagliata.png")
+    salva_variante(fig, ax, ritagliata, DPI, marker, ritaglio_px=5, formato="png")
+    salva_variante(fig, ax, intera, DPI, formato="png")
+    attendi_codifiche()
+    plt.close(fig)
+
+    assert _rossi(intera) > 0
+    assert _rossi(ritagliata) == _rossi(intera)
+    with Image.open(intera) as a, Image.open(ritagliata) as b:
+        assert b.width < a.width and b.height < a.height
+
+
+# Dopo il ritaglio figura e assi tornano come prima: la variante successiva non cambia
+def test_ritaglio_ripristina_la_figura(tmp_path, icona):
+    fig, ax = plt.subplots(figsize=(6, 6), dpi=DPI)
+    ax.set_aspect("equal")
+    marker = imscatter([100, 900], [100, 200], ax=ax, zoom=0.5, image_path=icona)
+    ax.set_axis_off()
+    ax.set_xlim(0, 1000)
+    ax.set_ylim(0, 300)
+    posizione, limiti = ax.get_position(original=True), (ax.get_xlim(), ax.get_ylim())
+
+    salva_variante(fig, ax, str(tmp_path / "prima.png"), DPI, marker, ritaglio_px=5, formato="png")
+    assert ax.get_position(original=True).bounds == posizione.bounds
+    assert (ax.get_xlim(), ax.get_ylim()) == limiti
+    salva_variante(fig, ax, str(tmp_path / "seconda.png"), DPI, marker, ritaglio_px=5, formato="png")
+    attendi_codifiche()
+    plt.close(fig)
+    with open(tmp_path / "prima.png", "rb") as a, open(tmp_path / "seconda.png", "rb") as b:
+        assert a.read() == b.read()
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+# === Costanti ===
+TILE_CACHE_DIR = os.environ.get("VELOX_TILE_CACHE", "tile_cache")
+TILE_CACHE_MAX_MB = 2048  # oltre questa dimensione si eliminano le tile usate meno di recente
+TILE_OFFLINE = os.environ.get("VELOX_TILE_OFFLINE", "0") == "1"  # True = solo tile già in cache, nessuna richiesta di rete
+LOCK_SCADUTO_S = 600  # un lock più vecchio è considerato abbandonato da un processo terminato
+
+
+class TileNonInCache(Exception):
+    pass
+
+
+# === Nome della sorgente usato come primo livello della chiave provider/z/x/y ===
+def nome_provider(sorgente):
+    if isinstance(sorgente, str):
+        nome = "url-" + hashlib.sha1(sorgente.encode("utf-8")).hexdigest()[:12]
+    else:
+        nome = sorgente.get("name") or "url-" + hashlib.sha1(sorgente["url"].encode("utf-8")).hexdigest()[:12]
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", nome)
+
+
+def url_tile(sorgente, z, x, y):
+    if isinstance(sorgente, str):
+        return sorgente.format(z=z, x=x, y=y)
+    return sorgente.build_url(x=x, y=y, z=z)
+
+
+# === Cache su disco delle tile, condivisa tra script e processi worker ===
+# Solo archivio: i download (tentativi, timeout, limiti per host) sono di scaricatore_tile.py.
+# Scritture atomiche (file temporaneo + os.replace), recenza LRU data dalla
+# mtime (aggiornata a ogni hit), eliminazione protetta da un file di lock.
+class TileCache:
+    def __init__(self, cartella=TILE_CACHE_DIR, max_mb=TILE_CACHE_MAX_MB, offline=TILE_OFFLINE):
+        self.cartella = cartella
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.offline = offline
+        self.hit = 0
+        self.miss = 0
+        self.bytes_scaricati = 0
+        self._bytes_da_ultima_pulizia = 0
+        self._lock = threading.Lock()  # contatori e pulizia condivisi dai thread di scaricatore_tile.py
+
+    def percorso(self, sorgente, z, x, y):
+        return os.path.join(self.cartella, nome_provider(sorgente), str(z), str(x), f"{y}.tile")
+
+    # === Byte della tile se è in cache (hit), altrimenti None (miss) ===
+    # In modalità offline un miss solleva TileNonInCache.
+    def leggi_cache(self, sorgente, z, x, y):
+        percorso = self.percorso(sorgente, z, x, y)
+        try:
+            with open(percorso, "rb") as fh:
+                dati = fh.read()
+        except FileNotFoundError:
+            dati = None
+
+        if dati is not None:
+            with self._lock:
+                self.hit += 1
+            try:
+                os.utime(percorso)
+            except OSError:
+                pass  # eliminata da un altro processo dopo la lettura
+            return dati
+
+        with self._lock:
+            self.miss += 1
+        if self.offline:
+            raise TileNonInCache(f"Tile {nome_provider(sorgente)}/{z}/{x}/{y} non presente in cache (modalità offline)")
+        return None
+
+    # === Scrive in cache una tile appena scaricata ===
+    def memorizza(self, sorgente, z, x, y, dati):
+        with self._lock:
+            self.bytes_scaricati += len(dati)
+        self._scrivi(self.percorso(sorgente, z, x, y), dati)
+
+    def _scrivi(self, percorso, dati):
+        cartella = os.path.dirname(percorso)
+        os.makedirs(cartella, exist_ok=True)
+        fd, temporaneo = tempfile.mkstemp(dir=cartella, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(dati)
+            os.replace(temporaneo, percorso)
+        except BaseException:
+            if os.path.exists(temporaneo):
+                os.remove(temporaneo)
+            raise
+
+        # Controllo della dimensione solo ogni ~5% del limite scritto, non a ogni tile
+        with self._lock:
+            self._bytes_da_ultima_pulizia += len(dati)
+            pulizia = self._bytes_da_ultima_pulizia >= self.max_bytes // 20
+            if pulizia:
+                self._bytes_da_ultima_pulizia = 0
+        if pulizia:
+            self.pulisci()
+
+    # === Eliminazione LRU fino al 90% del limite (un solo processo alla volta) ===
+    def pulisci(self):
+        lock_path = os.path.join(self.cartella, ".lock")
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_SCADUTO_S:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return 0  # un altro processo sta già pulendo
+        os.close(fd)
+
+        eliminati = 0
+        try:
+            file_tile = []
+            for radice, _, nomi in os.walk(self.cartella):
+                for nome in nomi:
+                    if not nome.endswith(".tile"):
+                        continue
+                    percorso = os.path.join(radice, nome)
+                    try:
+                        info = os.stat(percorso)
+                    except FileNotFoundError:
+                        continue
+                    file_tile.append((info.st_mtime, info.st_size, percorso))
+
+            totale = sum(dimensione for _, dimensione, _ in file_tile)
+            if totale <= self.max_bytes:
+                return 0
+
+            obiettivo = self.max_bytes * 0.9
+            for _, dimensione, percorso in sorted(file_tile):
+                if totale <= obiettivo:
+                    break
+                try:
+                    os.remove(percorso)
+                except FileNotFoundError:
+                    pass
+                totale -= dimensione
+                eliminati += 1
+        finally:
+            os.remove(lock_path)
+
+        print(f"  [i] Cache tile: eliminate {eliminati} tile meno recenti")
+        return eliminati
+
+    def statistiche(self):
+        with self._lock:
+            return {"hit": self.hit, "miss": self.miss, "bytes_scaricati": self.bytes_scaricati}
+
+
+# === Istanza condivisa per processo, usata da tutti gli script di rendering ===
+_cache = None
+
+
+def cache_predefinita():
+    global _cache
+    if _cache is None:
+        _cache = TileCache()
+    return _cache
@@ -0,0 +1,345 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import shapely
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.path import Path
+from matplotlib.transforms import Affine2D
+from PIL import Image
+
+from confini import carica_confini
+from file_util import impronta_file, scrivi_atomico
+from marker_batch import carica_icona, componi_icone, da_premoltiplicato
+from marker_loader import DATA_FOLDER, ESTENSIONI, coordinate_marker
+from webmercator import RAGGIO, lonlat_a_webmerc
+
+# === Costanti ===
+OUTPUT_DIR = "output_tiles"
+ZOOM_MIN = 6
+ZOOM_MAX = 14
+LATO_TILE = 256
+BLOCCO = 8  # tile per lato disegnate in un solo passaggio (2048 px): le icone a cavallo non si spezzano
+MARKER_IMAGE_PATH = "autovelox-icon.png"
+ALTEZZA_ICONA_PX = 24  # altezza dell'icona sulle tile, a ogni zoom
+CONFINI = [
+    # (GeoJSON, spessore in pixel, colore RGBA), disegnati in quest'ordine sotto i marker
+    ("province.geojson", 0.75, (0, 0, 0, 0.6)),
+    ("regioni.geojson", 1.5, (0, 0, 0, 0.8)),
+]
+INDICE_NAME = "indice_tile.npz"  # impronta di ogni tile scritta, per gli aggiornamenti incrementali
+VERSIONE_TILE = 1  # da incrementare quando cambia il disegno: invalida tutte le tile
+FRAZIONE_PIXEL = 0.5  # tolleranza di semplificazione dei confini in frazioni di pixel
+
+MEZZO_MONDO = np.pi * RAGGIO  # metà del lato del mondo in EPSG:3857
+
+
+# === File marker: i file indicati e quelli delle cartelle (non ricorsivo) ===
+# In una cartella, per ogni nome si prende una sola estensione, con la priorità di ESTENSIONI.
+def file_marker(sorgenti):
+    percorsi = []
+    for sorgente in sorgenti:
+        if os.path.isfile(sorgente):
+            percorsi.append(sorgente)
+            continue
+        if not os.path.isdir(sorgente):
+            print(f"[!] Sorgente marker non trovata: {sorgente}")
+            continue
+        scelti = {}
+        for voce in sorted(os.scandir(sorgente), key=lambda v: v.name):
+            radice, estensione = os.path.splitext(voce.name)
+            estensione = estensione.lower()
+            if not voce.is_file() or estensione not in ESTENSIONI:
+                continue
+            if radice not in scelti or ESTENSIONI.index(estensione) < ESTENSIONI.index(scelti[radice][0]):
+                scelti[radice] = (estensione, voce.path)
+        percorsi.extend(percorso for _, percorso in scelti.values())
+    return percorsi
+
+
+# === Marker di tutti i file in EPSG:3857, senza duplicati (partizioni sovrapposte) ===
+def carica_posizioni(percorsi):
+    blocchi = []
+    for percorso in percorsi:
+        try:
+            blocchi.append(np.asarray(coordinate_marker(percorso)))
+        except (ValueError, OSError) as errore:
+            print(f"  [!] File marker non valido {percorso}: {errore}")
+    if not blocchi:
+        return np.empty(0), np.empty(0)
+    coordinate = np.unique(np.concatenate(blocchi), axis=0)
+    return lonlat_a_webmerc(coordinate[:, 0], coordinate[:, 1])
+
+
+# === Hash a 64 bit (splitmix64) di ogni posizione in pixel, vettoriale ===
+def _hash_posizioni(colonne, righe):
+    valore = (colonne.astype(np.uint64) << np.uint64(32)) ^ (righe.astype(np.uint64) & np.uint64(0xFFFFFFFF))
+    valore = valore + np.uint64(0x9E3779B97F4A7C15)
+    valore = (valore ^ (valore >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    valore = (valore ^ (valore >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return valore ^ (valore >> np.uint64(31))
+
+
+# === Indice punto -> tile di un livello di zoom ===
+# Ogni marker è ridotto all'angolo in alto a sinistra della sua icona in pixel globali
+# (ancorata in basso al centro, come in imscatter); marker nello stesso pixel coincidono.
+# Un'icona vicina al bordo cade su più tile (fino a 4): ognuna riceve la coppia.
+# Restituisce le posizioni (colonne, righe) ordinate da nord a sud, che è anche l'ordine di
+# disegno, e le coppie (tile, marker) ordinate per tile; chiave tile = x * 2**zoom + y.
+def indice_tile(x, y, zoom, altezza, larghezza):
+    numero = 2 ** zoom
+    scala = LATO_TILE * numero / (2 * MEZZO_MONDO)
+    colonne = np.round((x + MEZZO_MONDO) * scala - larghezza / 2).astype(np.int64)
+    righe = np.round((MEZZO_MONDO - y) * scala - altezza).astype(np.int64)
+    posizioni = np.unique(np.column_stack([righe, colonne]), axis=0)  # per riga, poi per colonna
+    righe, colonne = posizioni[:, 0], posizioni[:, 1]
+
+    tx0, tx1 = colonne // LATO_TILE, (colonne + larghezza - 1) // LATO_TILE
+    ty0, ty1 = righe // LATO_TILE, (righe + altezza - 1) // LATO_TILE
+    marker = np.arange(len(colonne))
+    tx = np.concatenate([tx0, tx1, tx0, tx1])
+    ty = np.concatenate([ty0, ty0, ty1, ty1])
+    indici = np.concatenate([marker] * 4)
+    distinte = np.concatenate([np.ones(len(marker), bool), tx1 != tx0, ty1 != ty0, (tx1 != tx0) & (ty1 != ty0)])
+    valide = distinte & (tx >= 0) & (tx < numero) & (ty >= 0) & (ty < numero)
+
+    chiavi = tx[valide] * numero + ty[valide]
+    indici = indici[valide]
+    ordine = np.argsort(chiavi, kind="stable")
+    return colonne, righe, chiavi[ordine], indici[ordine]
+
+
+# === Impronta di ogni tile: somma degli hash delle icone che la toccano ===
+# Non dipende dall'ordine dei file: basta che cambi, compaia o sparisca un marker della tile.
+def impronte_tile(colonne, righe, chiavi, indici):
+    if not len(chiavi):
+        return np.empty(0, np.int64), np.empty(0, np.uint64)
+    tile, inizi = np.unique(chiavi, return_index=True)
+    return tile, np.add.reduceat(_hash_posizioni(colonne, righe)[indici], inizi)
+
+
+# === Impronta globale: disegno, icona e confini; se cambia si ridisegna tutto ===
+def impronta_globale(icona_path=MARKER_IMAGE_PATH, confini=CONFINI):
+    sha1 = hashlib.sha1()
+    impostazioni = {"versione": VERSIONE_TILE, "lato": LATO_TILE, "altezza_icona": ALTEZZA_ICONA_PX,
+                    "frazione_pixel": FRAZIONE_PIXEL, "confini": confini}
+    sha1.update(json.dumps(impostazioni, sort_keys=True).encode("utf-8"))
+    sha1.update(impronta_file(icona_path).encode("ascii"))
+    for geojson_path, _, _ in confini:
+        sha1.update((impronta_file(geojson_path) if os.path.exists(geojson_path) else "assente").encode("ascii"))
+    return sha1.hexdigest()
+
+
+# === Indice dell'esecuzione precedente: {zoom: (impronta globale, chiavi, impronte)} ===
+# L'impronta globale è per livello: un'esecuzione interrotta lascia validi i livelli finiti.
+def leggi_indice(cartella):
+    percorso = os.path.join(cartella, INDICE_NAME)
+    if not os.path.exists(percorso):
+        return {}
+    try:
+        with np.load(percorso) as dati:
+            return {int(nome[1:-len("_chiavi")]): (str(dati[nome.replace("_chiavi", "_globale")]), dati[nome],
+                                                   dati[nome.replace("_chiavi", "_impronte")])
+                    for nome in dati.files if nome.endswith("_chiavi")}
+    except (OSError, ValueError, KeyError):
+        print(f"[!] Indice tile non leggibile, si ridisegna tutto: {percorso}")
+        return {}
+
+
+def scrivi_indice(cartella, livelli):
+    array = {}
+    for zoom, (globale, chiavi, impronte) in livelli.items():
+        array[f"z{zoom}_globale"] = np.array(globale)
+        array[f"z{zoom}_chiavi"] = chiavi
+        array[f"z{zoom}_impronte"] = impronte
+    scrivi_atomico(os.path.join(cartella, INDICE_NAME), lambda fh: np.savez(fh, **array))
+
+
+def percorso_tile(cartella, zoom, x, y):
+    return os.path.join(cartella, str(zoom), str(x), f"{y}.png")
+
+
+# === Confini di un livello di zoom: linee semplificate sotto il pixel, con indice spaziale ===
+def confini_livello(cataloghi, zoom):
+    tolleranza = 2 * MEZZO_MONDO / (LATO_TILE * 2 ** zoom) * FRAZIONE_PIXEL
+    livello = []
+    for geometrie, spessore, colore in cataloghi:
+        linee = shapely.boundary(shapely.simplify(geometrie, tolleranza, preserve_topology=True))
+        livello.append((linee, shapely.STRtree(linee), spessore, colore))
+    return livello
+
+
+def _percorso_linee(linee):
+    coordinate, parti = shapely.get_coordinates(shapely.get_parts(linee), return_index=True)
+    codici = np.full(len(coordinate), Path.LINETO, dtype=Path.code_type)
+    codici[np.r_[True, parti[1:] != parti[:-1]]] = Path.MOVETO
+    return Path(coordinate, codici)
+
+
+# === Disegna un blocco di tile: confini con antialiasing, poi le icone composte ===
+# Restituisce l'RGBA (righe dall'alto) del blocco con origine nel pixel globale (x0, y0).
+def disegna_blocco(x0, y0, lato, zoom, colonne, righe, icona, confini):
+    scala = LATO_TILE * 2 ** zoom / (2 * MEZZO_MONDO)
+    renderer = RendererAgg(lato, lato, 72)  # a 72 dpi un punto è un pixel
+    trasformazione = Affine2D().scale(scala, scala).translate(MEZZO_MONDO * scala - x0,
+                                                              lato - MEZZO_MONDO * scala + y0)
+
+    # Estensione del blocco in EPSG:3857, con un margine per lo spessore delle linee
+    margine = 4 / scala
+    estensione = (x0 / scala - MEZZO_MONDO - margine, MEZZO_MONDO - (y0 + lato) / scala - margine,
+                  (x0 + lato) / scala - MEZZO_MONDO + margine, MEZZO_MONDO - y0 / scala + margine)
+    for linee, albero, spessore, colore in confini:
+        vicine = linee[albero.query(shapely.box(*estensione))]
+        vicine = shapely.clip_by_rect(vicine, *estensione)
+        vicine = vicine[~shapely.is_empty(vicine)]
+        if not len(vicine):
+            continue
+        gc = renderer.new_gc()
+        gc.set_linewidth(spessore)
+        gc.set_foreground(colore, isRGBA=True)
+        gc.set_antialiased(True)
+        gc.set_snap(False)  # l'aggancio ai pixel dipenderebbe dalle altre linee del blocco
+        gc.set_joinstyle("round")
+        gc.set_capstyle("round")
+        renderer.draw_path(gc, _percorso_linee(vicine), trasformazione)
+        gc.restore()
+
+    # Livello sul solo riquadro delle icone, anche fuori dal blocco: Agg lo ritaglia. L'origine
+    # è un multiplo di due icone, così la griglia di componi_icone (e quindi l'ordine di
+    # sovrapposizione) è la stessa in tutti i blocchi.
+    altezza, larghezza = icona.shape[:2]
+    c0 = colonne.min() // (2 * larghezza) * 2 * larghezza
+    r0 = righe.min() // (2 * altezza) * 2 * altezza
+    altezza_livello = righe.max() + altezza - r0
+    livello = componi_icone(icona, colonne - c0, righe - r0, altezza_livello, colonne.max() + larghezza - c0)
+    gc = renderer.new_gc()
+    renderer.draw_image(gc, c0 - x0, lato - (r0 - y0) - altezza_livello,
+                        np.ascontiguousarray(da_premoltiplicato(livello)[::-1]))
+    gc.restore()
+    return np.asarray(renderer.buffer_rgba())
+
+
+def _scrivi_tile(percorso, rgba):
+    os.makedirs(os.path.dirname(percorso), exist_ok=True)
+    immagine = Image.fromarray(rgba, "RGBA")
+    scrivi_atomico(percorso, lambda fh: immagine.save(fh, format="PNG", optimize=True))
+
+
+def _rimuovi_tile(percorso):
+    try:
+        os.remove(percorso)
+        os.rmdir(os.path.dirname(percorso))  # solo se la colonna x è rimasta vuota
+    except OSError:
+        pass
+
+
+# === Un livello di zoom: ridisegna solo le tile con impronta nuova o cambiata ===
+# Le tile sono disegnate per blocchi di BLOCCO x BLOCCO con tutti i marker che toccano il
+# blocco, così un'icona a cavallo di due tile (anche di blocchi diversi) è identica su entrambe.
+def aggiorna_livello(cartella, zoom, x, y, icona, confini, precedente, tutto):
+    altezza, larghezza = icona.shape[:2]
+    colonne, righe, chiavi, indici = indice_tile(x, y, zoom, altezza, larghezza)
+    tile, impronte = impronte_tile(colonne, righe, chiavi, indici)
+    numero = 2 ** zoom
+
+    vecchie, vecchie_impronte = precedente if precedente is not None else (np.empty(0, np.int64),
+                                                                          np.empty(0, np.uint64))
+    posizione = np.clip(np.searchsorted(vecchie, tile), 0, max(len(vecchie) - 1, 0))
+    uguali = np.zeros(len(tile), bool)
+    if len(vecchie) and not tutto:
+        uguali = (vecchie[posizione] == tile) & (vecchie_impronte[posizione] == impronte)
+        # Tile invariata ma cancellata dal disco: va riscritta
+        for i in np.flatnonzero(uguali):
+            if not os.path.exists(percorso_tile(cartella, zoom, tile[i] // numero, tile[i] % numero)):
+                uguali[i] = False
+    da_scrivere = tile[~uguali]
+    da_rimuovere = np.setdiff1d(vecchie, tile, assume_unique=True)
+
+    # Coppie (tile, marker) delle sole tile da scrivere, raggruppate per blocco
+    selezione = np.isin(chiavi, da_scrivere)
+    chiavi_sel = chiavi[selezione]
+    blocchi = (chiavi_sel // numero // BLOCCO) * numero + (chiavi_sel % numero // BLOCCO)
+    lato = min(BLOCCO, numero) * LATO_TILE
+    cella_x, cella_y = colonne // larghezza, righe // altezza
+    for blocco in np.unique(blocchi):
+        bx, by = blocco // numero, blocco % numero
+        x0, y0 = bx * BLOCCO * LATO_TILE, by * BLOCCO * LATO_TILE
+        # Tutti i marker delle celle (grandi un'icona) che toccano il blocco, non solo quelli
+        # delle tile da scrivere: celle intere danno lo stesso ordine di disegno dei blocchi vicini
+        dentro = ((cella_x >= (x0 - larghezza) // larghezza) & (cella_x <= (x0 + lato) // larghezza)
+                  & (cella_y >= (y0 - altezza) // altezza) & (cella_y <= (y0 + lato) // altezza))
+        rgba = disegna_blocco(x0, y0, lato, zoom, colonne[dentro], righe[dentro], icona, confini)
+        for chiave in np.unique(chiavi_sel[blocchi == blocco]):
+            tx, ty = chiave // numero, chiave % numero
+            riga, colonna = (ty - by * BLOCCO) * LATO_TILE, (tx - bx * BLOCCO) * LATO_TILE
+            _scrivi_tile(percorso_tile(cartella, zoom, tx, ty),
+                         rgba[riga:riga + LATO_TILE, colonna:colonna + LATO_TILE])
+
+    for chiave in da_rimuovere:
+        _rimuovi_tile(percorso_tile(cartella, zoom, chiave // numero, chiave % numero))
+    return (tile, impronte), len(da_scrivere), len(da_rimuovere)
+
+
+# === Piramide XYZ trasparente dei marker (e dei confini), aggiornata in modo incrementale ===
+# Si scrivono solo le tile che contengono almeno un'icona; alla prima esecuzione tutte, poi
+# solo quelle le cui icone sono cambiate (marker aggiunti, spostati o rimossi). Le tile
+# rimaste senza marker sono cancellate. Icona, confini o impostazioni diversi ridisegnano
+# tutto. I livelli fuori dall'intervallo di zoom restano come sono.
+def genera_piramide(sorgenti=(DATA_FOLDER,), cartella=OUTPUT_DIR, zoom_min=ZOOM_MIN, zoom_max=ZOOM_MAX,
+                    icona_path=MARKER_IMAGE_PATH, confini=CONFINI, completa=False):
+    inizio = time.perf_counter()
+    os.makedirs(cartella, exist_ok=True)
+    x, y = carica_posizioni(file_marker(sorgenti))
+    print(f"[i] {len(x)} marker distinti")
+
+    globale = impronta_globale(icona_path, confini)
+    livelli = leggi_indice(cartella)
+    if any(livelli[zoom][0] != globale for zoom in range(zoom_min, zoom_max + 1) if zoom in livelli):
+        print("[i] Icona, confini o impostazioni cambiati: si ridisegnano le tile dei livelli interessati")
+
+    # Icona premoltiplicata alla dimensione delle tile (righe dall'alto, come le tile)
+    originale = carica_icona(icona_path)
+    larghezza = max(1, round(originale.shape[1] * ALTEZZA_ICONA_PX / originale.shape[0]))
+    icona = np.asarray(Image.fromarray(originale).convert("RGBa").resize((larghezza, ALTEZZA_ICONA_PX),
+                                                                         Image.LANCZOS))
+
+    cataloghi = []
+    for geojson_path, spessore, colore in confini:
+        if not os.path.exists(geojson_path):
+            print(f"[!] Confini non trovati, non disegnati: {geojson_path}")
+            continue
+        cataloghi.append((np.asarray(carica_confini(geojson_path).geometry.values), spessore, colore))
+
+    scritte = rimosse = 0
+    try:
+        for zoom in range(zoom_min, zoom_max + 1):
+            inizio_livello = time.perf_counter()
+            precedente = livelli.get(zoom)
+            tutto = completa or precedente is None or precedente[0] != globale
+            tile, nuove, vecchie = aggiorna_livello(cartella, zoom, x, y, icona, confini_livello(cataloghi, zoom),
+                                                    precedente[1:] if precedente else None, tutto)
+            livelli[zoom] = (globale, *tile)
+            scritte, rimosse = scritte + nuove, rimosse + vecchie
+            print(f"  [+] Zoom {zoom}: {len(tile[0])} tile con marker, {nuove} scritte, "
+                  f"{vecchie} rimosse ({time.perf_counter() - inizio_livello:.1f}s)")
+    finally:
+        scrivi_indice(cartella, livelli)  # anche se interrotto: i livelli finiti non si ridisegnano
+
+    print(f"\n[i] Tile scritte: {scritte}, rimosse: {rimosse} in {time.perf_counter() - inizio:.1f}s")
+    print(f"[i] Overlay XYZ: {os.path.join(cartella, '{z}', '{x}', '{y}.png')}")
+
+
+# === Uso: python tile_overlay.py [--marker dati_marker] [--zoom-min 6] [--zoom-max 14] ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Piramide di tile XYZ trasparenti con i marker autovelox")
+    parser.add_argument("--marker", nargs="+", default=[DATA_FOLDER],
+                        help="file marker o cartelle (non ricorsive) da includere")
+    parser.add_argument("--output", default=OUTPUT_DIR)
+    parser.add_argument("--zoom-min", type=int, default=ZOOM_MIN)
+    parser.add_argument("--zoom-max", type=int, default=ZOOM_MAX)
+    parser.add_argument("--completa", action="store_true", help="ridisegna tutte le tile")
+    args = parser.parse_args()
+    genera_piramide(args.marker, args.output, args.zoom_min, args.zoom_max, completa=args.completa)
@@ -0,0 +1,157 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from basemap import MAX_TILE_RENDER, aggiungi_basemap, zoom_per_assi
+from codifica import FORMATO, estensione_formato, salva
+from confini import PIXEL_USCITA, confine_per_estensione
+from contesto_render import figura
+from marker_batch import imscatter
+from strumentazione import fase
+
+# === Variante di output di un'unità ===
+# estensione: "marker" (ritaglio sui marker) o "provincia" (confine intero)
+# zoom_mappa: None = automatico, dalla risoluzione dell'immagine (basemap.pianifica_zoom)
+# zoom_marker: None = inversamente proporzionale allo zoom mappa, come in prov3.py
+# margine: frazione dell'estensione, None = 0.15 per "marker" e 0.05 per "provincia"
+# ritaglio_px: se indicato, l'immagine è ritagliata sui marker più questo margine in pixel
+# suffisso: aggiunto al nome del file prima dell'estensione (es. ".full")
+# raggio_cluster: punti tipografici entro cui i marker diventano un'icona con il numero (None = nessun cluster)
+# formato, compressione: formato del file ("png", "png8", "webp") e livello, vedi codifica.py
+Variante = namedtuple(
+    "Variante",
+    ["nome", "cartella", "estensione", "dpi", "icona", "zoom_mappa", "zoom_marker", "margine", "ritaglio_px",
+     "suffisso", "raggio_cluster", "formato", "compressione"],
+    defaults=["provincia", 300, "autovelox-icon.png", None, None, None, None, "", None, FORMATO, None],
+)
+
+MARGINI = {"marker": 0.15, "provincia": 0.05}
+
+
+# === Limiti degli assi (xmin, xmax, ymin, ymax), zoom mappa e zoom marker di una variante ===
+# Lo zoom automatico usa la dimensione degli assi al dpi della variante, con i suoi limiti.
+def _parametri(variante, limiti_marker, limiti_unita, ax, max_tile):
+    xmin, ymin, xmax, ymax = limiti_marker if variante.estensione == "marker" else limiti_unita
+    margine = MARGINI[variante.estensione] if variante.margine is None else variante.margine
+    dx, dy = (xmax - xmin) * margine, (ymax - ymin) * margine
+    limiti = (xmin - dx, xmax + dx, ymin - dy, ymax + dy)
+
+    zoom_mappa = variante.zoom_mappa
+    if zoom_mappa is None:
+        ax.axis(limiti)
+        zoom_mappa = zoom_per_assi(ax, variante.dpi, max_tile=max_tile).zoom
+    # Zoom marker inversamente proporzionale allo zoom della mappa
+    zoom_marker = variante.zoom_marker or 0.015 * (11 / zoom_mappa)
+    return limiti, zoom_mappa, zoom_marker
+
+
+# === Percorso del file di una variante: nome_file con suffisso ed estensione del formato ===
+def percorso_variante(variante, nome_file):
+    base = os.path.splitext(nome_file)[0]
+    return os.path.join(variante.cartella, f"{base}{variante.suffisso}{estensione_formato(variante.formato)}")
+
+
+# === Salva la figura come savefig(bbox_inches="tight"), oppure ritagliata sui marker ===
+# Il riquadro dei marker in pixel si ricava da ax.transData al dpi di uscita, prima di
+# rasterizzare; poi figura e assi vengono ridotti a quel riquadro, con la stessa scala, così
+# si disegna (e si ricampiona la basemap) solo l'area ritagliata, codificata una volta.
+# La codifica avviene in background (codifica.salva).
+@fase("salvataggio")
+def salva_variante(fig, ax, percorso, dpi, marker=None, ritaglio_px=None, formato=FORMATO, compressione=None):
+    if ritaglio_px is None or marker is None:
+        salva(fig, percorso, dpi, pad_inches=0, formato=formato, compressione=compressione)
+        return
+
+    dimensioni, posizione, dpi_originale = fig.get_size_inches(), ax.get_position(original=True), fig.dpi
+    limiti, nel_layout = (ax.get_xlim(), ax.get_ylim()), ax.get_in_layout()
+    fig.set_dpi(dpi)
+    try:
+        ax.apply_aspect()  # riquadro degli assi con i limiti correnti, prima di leggere estensioni e transData
+        renderer = fig.canvas.get_renderer()
+        riquadro = marker.get_window_extent(renderer)
+        assi = ax.get_window_extent(renderer)
+        if riquadro.width <= 0:
+            # nessun marker visibile
+            salva(fig, percorso, dpi, pad_inches=0, formato=formato, compressione=compressione)
+            return
+
+        x0 = np.floor(max(riquadro.x0 - ritaglio_px, assi.x0))
+        x1 = np.ceil(min(riquadro.x1 + ritaglio_px, assi.x1))
+        y0 = np.floor(max(riquadro.y0 - ritaglio_px, assi.y0))
+        y1 = np.ceil(min(riquadro.y1 + ritaglio_px, assi.y1))
+        (dx0, dy0), (dx1, dy1) = ax.transData.inverted().transform([[x0, y0], [x1, y1]])
+
+        fig.set_size_inches((x1 - x0) / dpi, (y1 - y0) / dpi)
+        ax.set_position([0, 0, 1, 1])
+        ax.set_xlim(dx0, dx1)
+        ax.set_ylim(dy0, dy1)
+        salva(fig, percorso, dpi, bbox_inches=None, formato=formato, compressione=compressione)
+    finally:
+        fig.set_dpi(dpi_originale)
+        fig.set_size_inches(dimensioni)
+        ax.set_position(posizione)  # posizione originale: il prossimo apply_aspect riparte da quella
+        ax.set_in_layout(nel_layout)  # set_position lo disattiva: servirebbe a bbox_inches="tight"
+        ax.set_xlim(*limiti[0])
+        ax.set_ylim(*limiti[1])
+
+
+# === Tutte le varianti di un'unità da una sola figura ===
+# Marker (x, y in EPSG:3857), confine e basemap sono preparati una volta: una basemap per
+# ogni zoom distinto (sull'unione delle estensioni che lo usano) e un livello di marker per
+# ogni icona/zoom marker/raggio di cluster. Per ogni variante si cambiano solo visibilità, limiti e dpi prima
+# della codifica. Restituisce i percorsi salvati, nell'ordine delle varianti: i file sono
+# completi dopo codifica.attendi_codifiche() (render_parallelo lo fa per ogni unità).
+# max_tile: tile per basemap con lo zoom automatico (basemap.MAX_TILE_RENDER).
+def renderizza_varianti(unita, x, y, varianti, nome_file, figsize=(8.75, 8.75), pixel_uscita=PIXEL_USCITA,
+                        attribution_size=2, max_tile=MAX_TILE_RENDER):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    limiti_marker = (x.min(), y.min(), x.max(), y.max())
+    limiti_unita = tuple(unita[["xmin", "ymin", "xmax", "ymax"]].to_numpy(dtype=float))
+
+    fig, ax = figura(figsize)  # figura del thread, riusata e svuotata (contesto_render)
+    ax.set_aspect("equal")  # come il plot del confine: serve già allo zoom automatico
+    parametri = [_parametri(variante, limiti_marker, limiti_unita, ax, max_tile) for variante in varianti]
+
+    # Confine semplificato per l'estensione più piccola: va bene anche per le altre
+    larghezza = min(max(xmax - xmin, ymax - ymin) for (xmin, xmax, ymin, ymax), _, _ in parametri)
+    confine_per_estensione(unita, larghezza, pixel_uscita).boundary.plot(ax=ax, color='black', linewidth=0.25,
+                                                                          zorder=1)
+
+    basemap = {}
+    for zoom_mappa in sorted({zoom for _, zoom, _ in parametri}):
+        estensioni = [limiti for limiti, zoom, _ in parametri if zoom == zoom_mappa]
+        ax.axis((min(e[0] for e in estensioni), max(e[1] for e in estensioni),
+                 min(e[2] for e in estensioni), max(e[3] for e in estensioni)))
+        print(f"  [i] Zoom livello OSM usato: {zoom_mappa}")
+        basemap[zoom_mappa] = aggiungi_basemap(ax, zoom=zoom_mappa, attribution_size=attribution_size)
+
+    livelli_marker = {}
+    for variante, (_, _, zoom_marker) in zip(varianti, parametri):
+        chiave = (variante.icona, zoom_marker, variante.raggio_cluster)
+        if chiave not in livelli_marker:
+            livelli_marker[chiave] = imscatter(x, y, ax=ax, zoom=zoom_marker, image_path=variante.icona,
+                                               raggio_cluster=variante.raggio_cluster)
+    ax.set_axis_off()
+
+    output = []
+    for variante, (limiti, zoom_mappa, zoom_marker) in zip(varianti, parametri):
+        for zoom, artist in basemap.items():
+            for a in artist:
+                a.set_visible(zoom == zoom_mappa)
+        marker = (variante.icona, zoom_marker, variante.raggio_cluster)
+        for chiave, livello in livelli_marker.items():
+            if livello is not None:
+                livello.set_visible(chiave == marker)
+
+        ax.set_xlim(limiti[0], limiti[1])
+        ax.set_ylim(limiti[2], limiti[3])
+
+        os.makedirs(variante.cartella, exist_ok=True)
+        percorso = percorso_variante(variante, nome_file)
+        salva_variante(fig, ax, percorso, variante.dpi, livelli_marker[marker], variante.ritaglio_px,
+                       variante.formato, variante.compressione)
+        print(f"  [+] Variante {variante.nome}: {percorso}")
+        output.append(percorso)
+    return output
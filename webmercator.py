@@ -0,0 +1,14 @@
+import numpy as np
+
+# === Costanti EPSG:3857 ===
+RAGGIO = 6378137.0
+LAT_MAX = 85.0511287798066  # latitudine limite della proiezione Web Mercator
+
+
+# === lon/lat (gradi) -> x/y EPSG:3857 (metri), vettoriale ===
+def lonlat_a_webmerc(longitudine, latitudine):
+    longitudine = np.asarray(longitudine, dtype=float)
+    latitudine = np.clip(np.asarray(latitudine, dtype=float), -LAT_MAX, LAT_MAX)
+    x = np.radians(longitudine) * RAGGIO
+    y = np.log(np.tan(np.pi / 4 + np.radians(latitudine) / 2)) * RAGGIO
+    return x, y